@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+__doc__ = """
+Streaming uncertainty accumulators.
+
+Member (or dropout iteration) predictions are added batch by batch through update(rows,proba), so
+uncertainty can be computed while the pool is read, without keeping full per-member probability
+arrays. Results are the same as the whole array computations in EnsembleFunctions/BayesianFunctions.
+"""
+
+class BALDAccumulator(object):
+    """
+    BALD: entropy of the mean prediction minus mean of the prediction entropies.
+    """
+    def __init__(self,data_size,classes,members):
+        self.members = members
+        self.score_all = np.zeros(shape=(data_size,classes),dtype=np.float32)
+        self.entropy_all = np.zeros(shape=data_size,dtype=np.float32)
+
+    def update(self,rows,proba):
+        """
+        @param rows <slice or np.array>: pool rows proba refers to
+        @param proba <np.array>: one member's probabilities for those rows
+        """
+        self.score_all[rows] += proba
+        self.entropy_all[rows] += np.sum(- np.multiply(proba,np.log2(proba)),axis=1)
+
+    def scores(self):
+        avg_pi = np.divide(self.score_all,self.members)
+        g_x = np.sum(- np.multiply(avg_pi,np.log2(avg_pi)),axis=1)
+        f_x = np.divide(self.entropy_all,self.members)
+        return (g_x - f_x).flatten()
+
+class VarRatiosAccumulator(object):
+    """
+    Variation ratios: 1 - (votes for the most voted class)/members.
+    """
+    def __init__(self,data_size,classes,members):
+        self.members = members
+        self.votes = np.zeros(shape=(data_size,classes),dtype=np.int32)
+
+    def update(self,rows,proba):
+        if isinstance(rows,slice):
+            idx = np.arange(*rows.indices(self.votes.shape[0]))
+        else:
+            idx = np.asarray(rows)
+        self.votes[idx,proba.argmax(axis=-1)] += 1
+
+    def scores(self):
+        return (1 - self.votes.max(axis=1)/float(self.members)).astype(np.float32)
+
+def accumulator_for(function_name,data_size,classes,members):
+    """
+    Returns the accumulator corresponding to an uncertainty function name, or None.
+    """
+    if function_name.endswith('bald'):
+        return BALDAccumulator(data_size,classes,members)
+    elif function_name.endswith('varratios'):
+        return VarRatiosAccumulator(data_size,classes,members)
+    return None
@@ -4,9 +4,9 @@
 import numpy as np
 import os
 from tqdm import tqdm
-from .Common import load_model_weights
-
-from scipy.stats import mode
+from .Common import load_model_weights,report_output,iterate_batches
+from .Accumulators import BALDAccumulator,VarRatiosAccumulator
+from .Checkpoint import ScoringCheckpoint
 
 __doc__ = """
 All acquisition functions should receive:
@@ -18,20 +18,69 @@ All acquisition functions should receive:
 Returns: numpy array of element indexes
 """
 
-def _build_load_model(genmodel,data_size,config,sw_thread=None):
+def _build_load_model(genmodel,data_size,config,sw_thread=None,train_gen=None):
 
-    if sw_thread is None and config.info:
+    if config.info:
         print("[BayesianFunctions] Building bayesian model...")
-    elif sw_thread.is_alive():
-        if config.info:
-            print("[ALTrainer] Waiting for model weights...")
-        sw_thread.join()        
         
     single,parallel = genmodel.build(data_size=data_size,training=True,allocated_gpus=config.gpu_count,keep_model=False)
 
-    pred_model = load_model_weights(config,genmodel,(single,parallel),sw_thread=None)
+    #Weights come from memory if available, otherwise wait for the weights file
+    pred_model = load_model_weights(config,genmodel,(single,parallel),sw_thread=sw_thread)
+
+    #Int8 CPU inference, dropout masks stay stochastic
+    if getattr(config,'quantize',0) > 0 and not train_gen is None:
+        from .Quantization import quantize_model
+        pred_model = quantize_model(config,pred_model,train_gen,genmodel.get_weights_cache())
 
     return pred_model
+
+def _mc_dropout_sampling(pred_model,generator,acc,mc_dp,config,ckpt,kwargs,all_probs=None):
+    """
+    Runs mc_dp stochastic forward passes over the pool, adding each one to the accumulator.
+
+    Each pass goes over the whole pool, as predict_generator would. With checkpoints (-ckpt), each batch is
+    sampled mc_dp times before the next one is read instead, so scoring can be resumed from any batch.
+
+    @param acc <Accumulator>: AL.Accumulators instance
+    @param ckpt <ScoringCheckpoint>: scoring checkpoint (may be disabled)
+    @param all_probs <np.array>: if given, (mc_dp,data_size,classes) array filled with probabilities
+    """
+    pbar = config.progressbar
+    workers = 5*config.cpu_count
+
+    def _sample(d,rows,inp):
+        proba = pred_model.predict_on_batch(inp)
+        if not all_probs is None:
+            all_probs[d,rows] = proba
+        acc.update(rows,proba)
+        report_output(kwargs,'probs',(rows,d,proba))
+
+    if not ckpt.enabled:
+        if pbar:
+            l = tqdm(range(mc_dp),desc="MC Dropout",position=0)
+        else:
+            l = range(mc_dp)
+        for d in l:
+            if not pbar and config.info:
+                print("Step {0}/{1}".format(d+1,mc_dp))
+            for rows,inp in iterate_batches(generator,workers):
+                _sample(d,rows,inp)
+        return
+
+    extra = None if all_probs is None else {'all_probs':all_probs}
+    start = ckpt.restore(acc,extra)
+    if pbar:
+        l = tqdm(total=len(generator),initial=start,desc="MC Dropout",position=0)
+    for rows,inp in iterate_batches(generator,workers,start=start):
+        for d in range(mc_dp):
+            _sample(d,rows,inp)
+        ckpt.step(acc,extra)
+        if pbar:
+            l.update(1)
+    ckpt.clear()
+    if pbar:
+        l.close()
     
 def bayesian_varratios(pred_model,generator,data_size,**kwargs):
     """
@@ -72,7 +121,7 @@ def bayesian_varratios(pred_model,generator,data_size,**kwargs):
         print("[bayesian_varratios] GenericModel is needed by ensemble_varratios. Set model kw argument")
         return None
     
-    pred_model = _build_load_model(model,data_size,config,kwargs.get('sw_thread',None))
+    pred_model = _build_load_model(model,data_size,config,kwargs.get('sw_thread',None),kwargs.get('train_gen',None))
     
     fidp = None
     if save_var:
@@ -82,51 +131,25 @@ def bayesian_varratios(pred_model,generator,data_size,**kwargs):
             fidp = 'al-probs-{1}-r{0}.pik'.format(r,config.ac_function)
             cache_m.registerFile(os.path.join(config.logdir,fidp),fidp)
         
-    All_Dropout_Classes = np.zeros(shape=(data_size,1))
+    acc = VarRatiosAccumulator(data_size,generator.classes,mc_dp)
 
-    if pbar:
-        l = tqdm(range(mc_dp), desc="MC Dropout",position=0)
-    else:
-        if config.info:
-            print("Starting MC dropout sampling...")
-        l = range(mc_dp)
+    if config.info:
+        print("Starting MC dropout sampling...")
 
     #Keep probabilities for analysis
     all_probs = None
     if config.debug:
-        all_probs = np.zeros(shape=(mc_dp,data_size,generator.classes))
-        
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,mc_dp))
-           
-        #Keep verbosity in 0 to gain speed 
-        proba = pred_model.predict_generator(generator,
-                                                workers=5*cpu_count,
-                                                max_queue_size=100*gpu_count,
-                                                verbose=0)
+        all_probs = np.zeros(shape=(mc_dp,data_size,generator.classes),dtype=np.float32)
 
-        if config.debug:
-            all_probs[d] = proba
-            
-        dropout_classes = proba.argmax(axis=-1)    
-        dropout_classes = np.array([dropout_classes]).T
-        All_Dropout_Classes = np.append(All_Dropout_Classes, dropout_classes, axis=1)
+    ckpt = ScoringCheckpoint(config,model,generator,kwargs.get('sw_thread',None))
+    _mc_dropout_sampling(pred_model,generator,acc,mc_dp,config,ckpt,kwargs,all_probs)
 
     if verbose > 0:
-        print("All dropout {0}:".format(All_Dropout_Classes.shape))
-        for i in np.random.choice(All_Dropout_Classes.shape[0],100,replace=False):
-            print("Predictions for image ({0}): {1}".format(i,All_Dropout_Classes[i]))
+        print("Votes array {0}:".format(acc.votes.shape))
+        for i in np.random.choice(acc.votes.shape[0],100,replace=False):
+            print("Class votes for image ({0}): {1}".format(i,acc.votes[i]))
     
-    Variation = np.zeros(shape=(data_size))
-
-    for t in range(data_size):
-        L = np.array([0])
-        for d_iter in range(mc_dp):
-            L = np.append(L, All_Dropout_Classes[t, d_iter+1])
-        Predicted_Class, Mode = mode(L[1:])
-        v = np.array(  [1 - Mode/float(mc_dp)])
-        Variation[t] = v
+    Variation = acc.scores()
     
     if verbose > 1:
         print("Variation {0}:".format(data_size))
@@ -135,6 +158,7 @@ def bayesian_varratios(pred_model,generator,data_size,**kwargs):
         
     a_1d = Variation.flatten()
     x_pool_index = a_1d.argsort()[-query:][::-1]
+    report_output(kwargs,'scores',a_1d)
 
     if config.debug:
         from .Common import debug_acquisition
@@ -182,7 +206,7 @@ def bayesian_bald(pred_model,generator,data_size,**kwargs):
         print("[bayesian_varratios] GenericModel is needed by ensemble_varratios. Set model kw argument")
         return None
     
-    pred_model = _build_load_model(model,data_size,config,kwargs.get('sw_thread',None))
+    pred_model = _build_load_model(model,data_size,config,kwargs.get('sw_thread',None),kwargs.get('train_gen',None))
     
     fidp = None
     if save_var:
@@ -192,62 +216,24 @@ def bayesian_bald(pred_model,generator,data_size,**kwargs):
             fidp = 'al-probs-{1}-r{0}.pik'.format(r,config.ac_function)
             cache_m.registerFile(os.path.join(config.logdir,fidp),fidp)
             
-    All_Entropy_Dropout = np.zeros(shape=data_size,dtype=np.float32)
-    score_All = np.zeros(shape=(data_size, generator.classes),dtype=np.float32)
+    acc = BALDAccumulator(data_size,generator.classes,mc_dp)
     #Keep probabilities for analysis
     all_probs = None
     if config.debug:
         all_probs = np.zeros(shape=(mc_dp,data_size,generator.classes),dtype=np.float32)
         
-    if pbar:
-        l = tqdm(range(mc_dp), desc="MC Dropout",position=0)
-    else:
-        if config.info:
-            print("Starting MC dropout sampling...")
-        l = range(mc_dp)
-                
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,mc_dp))
-
-        dropout_score = pred_model.predict_generator(generator,
-                                                        workers=5*cpu_count,
-                                                        max_queue_size=100*gpu_count,
-                                                        verbose=0)
-        if config.debug:
-            all_probs[d] = dropout_score
-            
-        #computing G_X
-        score_All = score_All + dropout_score
-
-        #computing F_X
-        dropout_score_log = np.log2(dropout_score)
-        Entropy_Compute = - np.multiply(dropout_score, dropout_score_log)
-        Entropy_Per_Dropout = np.sum(Entropy_Compute, axis=1)
-        
-        All_Entropy_Dropout = All_Entropy_Dropout + Entropy_Per_Dropout
-        del(dropout_score)
-
-
-    Avg_Pi = np.divide(score_All, mc_dp)
-    Log_Avg_Pi = np.log2(Avg_Pi)
-    Entropy_Avg_Pi = - np.multiply(Avg_Pi, Log_Avg_Pi)
-    Entropy_Average_Pi = np.sum(Entropy_Avg_Pi, axis=1)
-
-    G_X = Entropy_Average_Pi
-    
-    Average_Entropy = np.divide(All_Entropy_Dropout, mc_dp)
-
-    F_X = Average_Entropy
+    if config.info:
+        print("Starting MC dropout sampling...")
 
-    U_X = G_X - F_X
+    ckpt = ScoringCheckpoint(config,model,generator,kwargs.get('sw_thread',None))
+    _mc_dropout_sampling(pred_model,generator,acc,mc_dp,config,ckpt,kwargs,all_probs)
 
-    # THIS FINDS THE MINIMUM INDEX 
-    # a_1d = U_X.flatten()
-    # x_pool_index = a_1d.argsort()[-Queries:]
+    #G_X - F_X: entropy of average prediction minus average entropy
+    U_X = acc.scores()
 
     a_1d = U_X.flatten()
     x_pool_index = a_1d.argsort()[-query:][::-1]    
+    report_output(kwargs,'scores',a_1d)
 
     if save_var:
         cache_m.dump((x_pool_index,a_1d),fid)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import time
+import random
+import pickle
+import hashlib
+import numpy as np
+
+__doc__ = """
+Checkpoints of streaming acquisition scoring (see -ckpt).
+
+Scoring functions that go over the pool batch by batch (updating an AL.Accumulators instance) periodically
+save the accumulator state, the number of processed batches and the Python/NumPy RNG states. A checkpoint
+is identified by acquisition function, weights files and pool contents, so a restarted run only resumes
+scoring of the same pool with the same weights.
+
+The pool order is saved with the first checkpoint: a restored run (see ActiveLearningTrainer.configure_sets)
+rebuilds the pool from its sets and puts it back in this order (apply_pool_order). The interrupted round's
+training state (epoch adjustment) is also kept (save_round_state), as the restored run does not train again.
+
+Resumed selections are exact only for deterministic scoring (ensemble functions). MC dropout masks
+(bayesian_* functions) come from TF random ops, whose state can not be saved: batches scored after a resume
+get fresh masks, so selections are statistically equivalent but not identical to an uninterrupted run.
+"""
+
+#Scoring functions whose resumed selections may differ from an uninterrupted run (see __doc__)
+STOCHASTIC = ('bayesian_varratios','bayesian_bald')
+
+def _pool_keys(items):
+    from Utils import sample_key
+    return [sample_key(item) for item in items]
+
+def _pool_fingerprint(generator,keys=None):
+    if keys is None:
+        keys = _pool_keys(generator.returnDataAsArray()[0])
+    fp = hashlib.md5()
+    for k in keys:
+        fp.update(k.encode())
+    return fp.hexdigest()
+
+def _atomic_dump(obj,path):
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as fd:
+        pickle.dump(obj,fd,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp,path)
+
+def _load(path):
+    try:
+        with open(path,'rb') as fd:
+            return pickle.load(fd)
+    except (OSError,EOFError,pickle.UnpicklingError):
+        return None
+
+def checkpoint_file(config):
+    return os.path.join(config.cache,'al-ckpt-{}.pik'.format(config.ac_function))
+
+def pool_order_file(config):
+    return os.path.join(config.cache,'al-ckpt-{}-pool.pik'.format(config.ac_function))
+
+def round_state_file(config):
+    return os.path.join(config.cache,'al-ckpt-{}-round.pik'.format(config.ac_function))
+
+def checkpoint_exists(config):
+    return getattr(config,'ckpt',0) > 0 and os.path.isfile(checkpoint_file(config))
+
+def save_round_state(config,state):
+    """
+    Keeps training results of the current round (dict), needed if its scoring is interrupted.
+    """
+    if getattr(config,'ckpt',0) > 0:
+        _atomic_dump(state,round_state_file(config))
+
+def load_round_state(config):
+    """
+    Returns the state saved by save_round_state or None.
+    """
+    return _load(round_state_file(config))
+
+def register_resumed_weights(genmodel,single,parallel=None):
+    """
+    Weights loaded from disk to resume scoring are registered as trained weights are (WeightsRegistry), so the
+    checkpoint fingerprint (extractor_fingerprint) is the same as in the interrupted run.
+    """
+    from Utils import WeightsRegistry
+
+    registry = WeightsRegistry()
+    if not single is None:
+        registry.register(genmodel.get_weights_cache(),single.get_weights())
+    if not parallel is None:
+        registry.register(genmodel.get_mgpu_weights_cache(),parallel.get_weights())
+
+def apply_pool_order(config,pool_x,pool_y):
+    """
+    Puts a rebuilt pool in the order of the pending checkpoint's pool.
+
+    Returns (pool_x,pool_y,order) where pool_x[order] gives the checkpoint order, or order is None if there
+    is no checkpoint or its pool has other items (scoring will start from the first batch).
+    """
+    keys = _load(pool_order_file(config)) if checkpoint_exists(config) else None
+    if keys is None:
+        return pool_x,pool_y,None
+
+    current = {k:i for i,k in enumerate(_pool_keys(pool_x))}
+    if len(keys) != len(current) or any([not k in current for k in keys]):
+        if config.info:
+            print("[ScoringCheckpoint] Pool differs from the checkpoint's ({} items, checkpoint: {}), scoring will start from the first batch.".format(
+                len(current),len(keys)))
+        return pool_x,pool_y,None
+
+    order = np.asarray([current[k] for k in keys],dtype=np.int64)
+    return pool_x[order],pool_y[order],order
+
+class ScoringCheckpoint(object):
+    """
+    Usage:
+    ckpt = ScoringCheckpoint(config,genmodel,generator,sw_thread)
+    start = ckpt.restore(accumulator)
+    for rows,inp in iterate_batches(generator,workers,start=start):
+        ...accumulator.update(rows,proba)
+        ckpt.step(accumulator)
+    ckpt.clear()
+    """
+    def __init__(self,config,genmodel,generator,sw_thread=None):
+        """
+        Weights must be on disk for the fingerprint, so weight saving threads are waited for.
+
+        @param genmodel <GenericModel>: model whose weights are used for scoring
+        @param generator <ThreadedGenerator>: pool generator
+        """
+        from .Projection import extractor_fingerprint
+
+        self.period = getattr(config,'ckpt',0)
+        self.info = config.info
+        self.path = checkpoint_file(config)
+        self.function = config.ac_function
+        self.enabled = self.period > 0
+        self.cursor = 0
+        self._last = time.time()
+
+        if not self.enabled:
+            return
+        if not sw_thread is None:
+            for t in (sw_thread if isinstance(sw_thread,list) else [sw_thread]):
+                t.join()
+        self.order_path = pool_order_file(config)
+        self._keys = _pool_keys(generator.returnDataAsArray()[0])
+        self.fingerprint = (extractor_fingerprint(config,genmodel),_pool_fingerprint(generator,self._keys),len(generator))
+
+    def restore(self,accumulator,extra=None):
+        """
+        Restores accumulator state (and extra arrays, a dict updated in place) from a matching checkpoint.
+        Returns the batch to resume from (0 if no checkpoint).
+        """
+        if not self.enabled or not os.path.isfile(self.path):
+            return 0
+        try:
+            with open(self.path,'rb') as fd:
+                state = pickle.load(fd)
+        except (EOFError,pickle.UnpicklingError) as e:
+            if self.info:
+                print("[ScoringCheckpoint] Unreadable checkpoint, scoring from start ({})".format(e))
+            return 0
+
+        if state['fingerprint'] != self.fingerprint:
+            if self.info:
+                print("[ScoringCheckpoint] Checkpoint refers to other weights/pool, scoring from start.")
+            return 0
+
+        accumulator.__dict__.update(state['accumulator'])
+        if not extra is None:
+            for k in extra:
+                extra[k][...] = state['extra'][k]
+        np.random.set_state(state['np_rng'])
+        random.setstate(state['py_rng'])
+        self.cursor = state['cursor']
+        if self.info:
+            print("[ScoringCheckpoint] Resuming scoring at batch {}/{}".format(self.cursor,self.fingerprint[2]))
+            if self.function in STOCHASTIC:
+                print("[ScoringCheckpoint] MC dropout masks can not be restored, remaining batches get fresh masks.")
+        return self.cursor
+
+    def step(self,accumulator,extra=None):
+        """
+        Call after each processed batch. Saves a checkpoint every config.ckpt seconds.
+        """
+        self.cursor += 1
+        if not self.enabled or (time.time() - self._last) < self.period:
+            return
+
+        #Pool order is written once, before the first checkpoint
+        if not self._keys is None:
+            _atomic_dump(self._keys,self.order_path)
+            self._keys = None
+        state = {'fingerprint':self.fingerprint,
+                 'cursor':self.cursor,
+                 'accumulator':accumulator.__dict__,
+                 'extra':extra,
+                 'np_rng':np.random.get_state(),
+                 'py_rng':random.getstate()}
+        _atomic_dump(state,self.path)
+        self._last = time.time()
+
+    def clear(self):
+        """
+        Scoring is complete, checkpoint is no longer needed.
+        """
+        if not self.enabled:
+            return
+        for path in (self.path,self.order_path):
+            if os.path.isfile(path):
+                os.remove(path)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+import os
+
+__doc__ = """
+Warm-started KMeans for acquisition functions that cluster the pool every round.
+
+Clustering state (centers and the items closest to each center - medoids) is kept between rounds.
+If the feature space did not change, previous centers are the initialization. Otherwise, the current
+features of the previous medoids are used (medoids that left the pool are replaced by random items).
+Centers are refined by a few mini-batch iterations on a feature sample and all items are then
+assigned to their nearest center, in parallel chunks.
+"""
+
+def _nearest_center(features,centers,workers,block_size=8192):
+    """
+    Returns (labels,squared distances) of every feature row to its nearest center.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    centers = np.asarray(centers,dtype=np.float32)
+    c_sq = np.einsum('ij,ij->i',centers,centers)
+    labels = np.empty(features.shape[0],dtype=np.int32)
+    dist = np.empty(features.shape[0],dtype=np.float32)
+
+    def assign(s):
+        xb = np.asarray(features[s:s+block_size],dtype=np.float32)
+        d = np.dot(xb,centers.T)
+        d *= -2.0
+        d += c_sq[None,:]
+        labels[s:s+block_size] = np.argmin(d,axis=1)
+        dist[s:s+block_size] = d[np.arange(d.shape[0]),labels[s:s+block_size]] + np.einsum('ij,ij->i',xb,xb)
+        return None
+
+    chunks = range(0,features.shape[0],block_size)
+    if workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(assign,chunks))
+    else:
+        for s in chunks:
+            assign(s)
+    np.maximum(dist,0.0,out=dist)
+    return labels,dist
+
+def space_fingerprint(config,genmodel):
+    """
+    Feature space identifier: extractor state and PCA projection size.
+    """
+    from .Projection import extractor_fingerprint
+    
+    return "{}-{}".format(extractor_fingerprint(config,genmodel),config.pca)
+
+def warm_kmeans(features,items,clusters,fid,space_fp,**kwargs):
+    """
+    Clusters features in the given number of clusters. Returns a fitted MiniBatchKMeans whose labels_ cover
+    all feature rows.
+
+    @param features <np.array>: 2D feature array
+    @param items <np.array>: data items (same order as features), used to locate previous medoids
+    @param fid <str>: CacheManager file ID where clustering state is kept
+    @param space_fp <str>: feature space identifier, previous centers are reused only if it matches
+
+    Optional keyword arguments:
+    @param workers <int>: threads used in assignment (Default: 1)
+    @param iters <int>: mini-batch iterations when warm starting (Default: 10)
+    @param sample <int>: refinement is done on this many items (Default: 20000)
+    @param verbose <int>: verbosity level
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    from Utils import CacheManager
+
+    cache_m = CacheManager()
+    workers = kwargs.get('workers',1)
+    iters = kwargs.get('iters',10)
+    sample = kwargs.get('sample',20000)
+    verbose = kwargs.get('verbose',0)
+
+    clusters = min(clusters,features.shape[0])
+    init = None
+    state = cache_m.load(fid) if cache_m.checkFileExistence(fid) else None
+    if not state is None:
+        p_fp,p_centers,p_medoids = state
+        if p_fp == space_fp and p_centers.shape == (clusters,features.shape[1]):
+            init = p_centers
+            if verbose > 0:
+                print("[Clustering] Warm start from previous centers")
+        elif len(p_medoids) == clusters:
+            pos = {it:i for i,it in enumerate(items)}
+            idx = np.asarray([pos.get(m,-1) for m in p_medoids],dtype=np.int64)
+            missing = np.where(idx < 0)[0]
+            if missing.shape[0] > 0:
+                idx[missing] = np.random.choice(np.setdiff1d(np.arange(features.shape[0]),idx),missing.shape[0],replace=False)
+            init = np.asarray(features[idx],dtype=np.float32)
+            if verbose > 0:
+                print("[Clustering] Warm start from previous medoids ({} replaced)".format(missing.shape[0]))
+
+    s_idx = np.random.choice(features.shape[0],min(sample,features.shape[0]),replace=False)
+    s_feat = np.asarray(features[s_idx],dtype=np.float32)
+    bsize = min(max(500,10*clusters),s_feat.shape[0])
+    if init is None:
+        km = MiniBatchKMeans(n_clusters=clusters,init='k-means++',batch_size=bsize).fit(s_feat)
+    else:
+        km = MiniBatchKMeans(n_clusters=clusters,init=init,n_init=1,max_iter=iters,batch_size=bsize).fit(s_feat)
+
+    km.labels_,dist = _nearest_center(features,km.cluster_centers_,workers)
+
+    #Medoids: item closest to each center
+    medoid = np.full(clusters,-1,dtype=np.int64)
+    order = np.lexsort((dist,km.labels_))
+    first = np.searchsorted(km.labels_[order],np.arange(clusters))
+    valid = first < order.shape[0]
+    valid[valid] = km.labels_[order[first[valid]]] == np.arange(clusters)[valid]
+    medoid[valid] = order[first[valid]]
+    medoid[~valid] = np.argmin(dist)
+    cache_m.dump((space_fp,km.cluster_centers_.astype(np.float32),[items[m] for m in medoid]),fid)
+
+    return km
@@ -13,24 +13,49 @@ def load_model_weights(config,genmodel,tmodel,sw_thread=None):
     """
     genmodel: GenericModel
     tmodel: tuple (single_model,parallel_model) or a Keras.Model instance
+
+    Weights of models trained in this process are taken from the WeightsRegistry, without waiting
+    for (or reading) weights files.
     """
     import time
     from datetime import timedelta
+    from Utils import WeightsRegistry,load_flat
     
     npfile = False
     checkpath = None
     stime = None
+
+    if config.ffeat is None:
+        if config.gpu_count > 1:
+            key,pred_model = genmodel.get_mgpu_weights_cache(),tmodel[1] if isinstance(tmodel,tuple) else tmodel
+        else:
+            key,pred_model = genmodel.get_weights_cache(),tmodel[0] if isinstance(tmodel,tuple) else tmodel
+        weights = WeightsRegistry().get(key)
+        if not weights is None and not pred_model is None:
+            pred_model.set_weights(weights)
+            if config.info and not config.progressbar:
+                print("Model weights taken from memory: {0}".format(key))
+            return pred_model
     
     if not sw_thread is None:
-        last_thread = None
-        if isinstance(sw_thread,list):
-            last_thread = sw_thread[-1]
-        else:
-            last_thread = sw_thread
-        if config.ffeat is None and last_thread.is_alive():
+        threads = sw_thread if isinstance(sw_thread,list) else [sw_thread]
+        if config.ffeat is None and any([t.is_alive() for t in threads]):
             if config.info:
                 print("[load_model_weights] Waiting for model weights to become available...")
-            last_thread.join()
+            for t in threads:
+                t.join()
+
+    #Flat weight files are memory mapped and applied directly
+    if config.ffeat is None and getattr(config,'wflat',False):
+        if config.gpu_count > 1:
+            fpath,pred_model = genmodel.get_flatmgpu_weights_cache(),tmodel[1] if isinstance(tmodel,tuple) else tmodel
+        else:
+            fpath,pred_model = genmodel.get_flatweights_cache(),tmodel[0] if isinstance(tmodel,tuple) else tmodel
+        if not fpath is None and os.path.isfile(fpath) and not pred_model is None:
+            pred_model.set_weights(load_flat(fpath))
+            if config.info and not config.progressbar:
+                print("Model weights loaded from: {0}".format(fpath))
+            return pred_model
     
     if hasattr(genmodel,'get_npweights_cache'):
         checkpath = genmodel.get_npweights_cache(add_ext=True)
@@ -176,20 +201,152 @@ def debug_acquisition(s_expected,s_probs,classes,cache_m,config,fidp):
         cache_m.dump((s_expected,s_probs),fidp)
 
 
-def extract_feature_from_function(function,generator):
+def extract_feature_from_function(function,generator,projector=None):
+    """
+    Runs function over all generator batches, returns the stacked outputs.
 
+    @param projector <AL.Projection.PCAProjector>: if given, each batch is flattened and projected as it is
+    produced (an unfitted projector is fitted first, on a sample of generator batches).
+    """
     data_size = generator.returnDataSize()
     bsize = generator.batch_size
     stp = int(np.ceil(data_size / bsize))
     features = None
+
+    if not projector is None and not projector.fitted():
+        projector.fit_from_function(function,generator)
+        
     for i in range(stp):
         start_idx = i*bsize
         inp = generator.next()[0]
         if not isinstance(inp,list):
             inp = [inp]
         ff = function(inp)[0] #Considering the model has a single output
+        if not projector is None:
+            ff = projector.transform(ff)
         if features is None:
             features = np.zeros(tuple([data_size]+list(ff.shape[1:])),dtype=np.float32)
         features[start_idx:start_idx+bsize] = ff
 
     return features
+
+def open_feature_store(config,genmodel):
+    """
+    Returns the FeatureStore for the current extractor state (stores of previous states are removed)
+    or None if feature storage is not enabled (-fstore).
+    """
+    from Utils import FeatureStore
+    from .Projection import extractor_fingerprint
+
+    if getattr(config,'fstore',None) is None:
+        return None
+    
+    layer = 'feature_ens{}'.format(config.emodels) if genmodel.is_ensemble() else 'feature'
+    store = FeatureStore(config.cache,extractor_fingerprint(config,genmodel),layer,config.fstore,config.verbose)
+    store.prune()
+    return store
+
+def extract_features_cached(function,generator,store,projector=None):
+    """
+    Same as extract_feature_from_function, but features are read from a FeatureStore when available.
+    Only samples missing from the store go through function; their (unprojected) features are stored.
+
+    @param store <Utils.FeatureStore>: store for the current extractor state. If None, all features are extracted
+    @param projector <AL.Projection.PCAProjector>: projection applied to the returned features
+    """
+    from Utils import sample_key
+
+    if store is None:
+        return extract_feature_from_function(function,generator,projector)
+    
+    X,Y = generator.returnDataAsArray()
+    keys = [sample_key(x) for x in X]
+    miss = np.where(~store.contains(keys))[0]
+
+    if miss.shape[0] > 0:
+        data = generator.data
+        generator.setData((X[miss],Y[miss]))
+        store.add([keys[i] for i in miss],extract_feature_from_function(function,generator))
+        generator.setData(data)
+    if store.verbose > 0:
+        print("[FeatureStore] {} of {} samples served from store".format(len(keys)-miss.shape[0],len(keys)))
+
+    if projector is None:
+        return store.get(keys)
+
+    if not projector.fitted():
+        s_keys = np.random.choice(len(keys),min(projector.sample,len(keys)),replace=False)
+        projector.fit(store.get([keys[i] for i in s_keys]))
+    bsize = 8192
+    features = np.zeros((len(keys),projector.components_.shape[1]),dtype=np.float32)
+    for i in range(0,len(keys),bsize):
+        features[i:i+bsize] = projector.transform(store.get(keys[i:i+bsize]))
+    return features
+
+def score_and_extract(function,generator,accumulator,members,projector=None):
+    """
+    Single pass over generator batches. function should return [p_0,...,p_(members-1),features]:
+    member probabilities are added to accumulator and features (projected if a projector is given) returned.
+
+    @param accumulator <AL.Accumulators>: BALDAccumulator, VarRatiosAccumulator...
+    """
+    data_size = generator.returnDataSize()
+    bsize = generator.batch_size
+    stp = int(np.ceil(data_size / bsize))
+    features = None
+
+    if not projector is None and not projector.fitted():
+        projector.fit_from_function(lambda inp: [function(inp)[-1]],generator)
+        
+    for i in range(stp):
+        start_idx = i*bsize
+        inp = generator.next()[0]
+        if not isinstance(inp,list):
+            inp = [inp]
+        outs = function(inp)
+        rows = slice(start_idx,start_idx+outs[0].shape[0])
+        for proba in outs[:members]:
+            accumulator.update(rows,proba)
+        ff = outs[-1]
+        if not projector is None:
+            ff = projector.transform(ff)
+        if features is None:
+            features = np.zeros(tuple([data_size]+list(ff.shape[1:])),dtype=np.float32)
+        features[rows] = ff
+
+    return features
+
+def iterate_batches(generator,workers=1,max_queue=None,start=0):
+    """
+    Yields (rows,inputs) for every generator batch, in order. Up to max_queue batches (Default: 2*workers)
+    are decoded ahead by a pool of worker threads, while the caller consumes the current one.
+
+    @param rows <slice>: rows of the batch in generator order
+    @param start <int>: first batch (resumed scoring)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    nbatches = len(generator)
+    workers = max(1,workers)
+    if max_queue is None:
+        max_queue = 2*workers
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        nxt = start
+        for i in range(start,nbatches):
+            while nxt < nbatches and len(pending) < max_queue:
+                pending.append(ex.submit(generator.__getitem__,nxt))
+                nxt += 1
+            inp = pending.popleft().result()[0]
+            n = inp[0].shape[0] if isinstance(inp,list) else inp.shape[0]
+            start_idx = i*generator.batch_size
+            yield slice(start_idx,start_idx+n),inp
+
+def report_output(kwargs,name,data):
+    """
+    Hands intermediate acquisition results (e.g. 'scores': per item uncertainty, in generator order) to
+    the observers given in the observers keyword argument. Observers are callables: observer(name,data).
+    """
+    for obs in kwargs.get('observers',[]):
+        obs(name,data)
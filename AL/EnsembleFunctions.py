@@ -4,9 +4,10 @@
 import numpy as np
 import os,sys
 from tqdm import tqdm
-from scipy.stats import mode
 
-from .Common import load_model_weights
+from .Common import load_model_weights,iterate_batches,report_output
+from .Accumulators import BALDAccumulator,VarRatiosAccumulator
+from .Checkpoint import ScoringCheckpoint
 
 __doc__ = """
 All acquisition functions should receive:
@@ -71,14 +72,9 @@ def ensemble_varratios(pred_model,generator,data_size,**kwargs):
             fidp = 'al-probs-{1}-r{0}.pik'.format(r,config.ac_function)
             cache_m.registerFile(os.path.join(config.logdir,fidp),fidp)
         
-    All_Dropout_Classes = np.zeros(shape=(data_size,1),dtype=np.float32)
-
-    #If sw_thread was provided, we should check the availability of model weights
-    if not sw_thread is None:
-        for k in range(len(sw_thread)):
-            if sw_thread[k].is_alive():
-                print("Waiting ensemble model {} weights' to become available...".format(k))
-                sw_thread[k].join()
+    acc = VarRatiosAccumulator(data_size,generator.classes,emodels)
+
+    #Member weights are taken from memory when available (load_model_weights waits on sw_thread otherwise)
                 
     if pbar:
         l = tqdm(range(emodels), desc="Ensemble member predictions",position=0)
@@ -92,44 +88,27 @@ def ensemble_varratios(pred_model,generator,data_size,**kwargs):
     if config.debug:
         all_probs = np.zeros(shape=(emodels,data_size,generator.classes),dtype=np.float32)
 
-    #single,parallel = model.build(preload_w=False)
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,emodels))
-
-        model.register_ensemble(d)
-            
-        curmodel = pred_model[d]
-        curmodel = load_model_weights(config,model,curmodel,sw_thread)
-        
-        #Keep verbosity in 0 to gain speed 
-        proba = curmodel.predict_generator(generator,
-                                               workers=5*cpu_count,
-                                               max_queue_size=100*gpu_count,
-                                               verbose=0)
-
-        if config.debug:
-            all_probs[d] = proba
-            
-        dropout_classes = proba.argmax(axis=-1)    
-        dropout_classes = dropout_classes.reshape(-1,1)
-        All_Dropout_Classes = np.append(All_Dropout_Classes, dropout_classes, axis=1)
-        del(dropout_classes)
+    curmodels = _load_members(config,model,pred_model,sw_thread,l,pbar,kwargs.get('train_gen',None))
+
+    #Each decoded batch goes through all members before the next one is read
+    ckpt = ScoringCheckpoint(config,model,generator,sw_thread)
+    extra = {'all_probs':all_probs} if config.debug else None
+    for rows,inp in iterate_batches(generator,5*cpu_count,start=ckpt.restore(acc,extra)):
+        for d in range(emodels):
+            proba = curmodels[d].predict_on_batch(inp)
+            if config.debug:
+                all_probs[d,rows] = proba
+            acc.update(rows,proba)
+            report_output(kwargs,'probs',(rows,d,proba))
+        ckpt.step(acc,extra)
+    ckpt.clear()
 
     if verbose > 1:
-        print("Variation array {0}:".format(All_Dropout_Classes.shape))
-        for i in np.random.choice(All_Dropout_Classes.shape[0],100,replace=False):
-            print("Predictions for image ({0}): {1}".format(i,All_Dropout_Classes[i]))
+        print("Votes array {0}:".format(acc.votes.shape))
+        for i in np.random.choice(acc.votes.shape[0],100,replace=False):
+            print("Class votes for image ({0}): {1}".format(i,acc.votes[i]))
     
-    Variation = np.zeros(shape=(data_size),dtype=np.float32)
-
-    for t in range(data_size):
-        L = np.array([0])
-        for d_iter in range(emodels):
-            L = np.append(L, All_Dropout_Classes[t, d_iter+1])
-        Predicted_Class, Mode = mode(L[1:])
-        v = np.array(  [1 - Mode/float(emodels)])
-        Variation[t] = v
+    Variation = acc.scores()
     
     if verbose > 1:
         print("Variation {0}:".format(data_size))
@@ -138,6 +117,7 @@ def ensemble_varratios(pred_model,generator,data_size,**kwargs):
         
     a_1d = Variation.flatten()
     x_pool_index = a_1d.argsort()[-query:][::-1]
+    report_output(kwargs,'scores',a_1d)
 
     if config.debug:
         from .Common import debug_acquisition
@@ -201,12 +181,7 @@ def ensemble_bald(pred_model,generator,data_size,**kwargs):
         print("[ensemble_bald] GenericModel is needed by ensemble_bald. Set model kw argument")
         return None
     
-    #If sw_thread was provided, we should check the availability of model weights
-    if not sw_thread is None:
-        for k in range(len(sw_thread)):
-            if sw_thread[k].is_alive():
-                print("Waiting ensemble model {} weights' to become available...".format(k))
-                sw_thread[k].join()
+    #Member weights are taken from memory when available (load_model_weights waits on sw_thread otherwise)
 
     fidp = None
     if save_var:
@@ -216,8 +191,7 @@ def ensemble_bald(pred_model,generator,data_size,**kwargs):
             fidp = 'al-probs-{1}-r{0}.pik'.format(r,config.ac_function)
             cache_m.registerFile(os.path.join(config.logdir,fidp),fidp)
             
-    All_Entropy_Dropout = np.zeros(shape=data_size,dtype=np.float32)
-    score_All = np.zeros(shape=(data_size, generator.classes),dtype=np.float32)
+    acc = BALDAccumulator(data_size,generator.classes,emodels)
 
     #Keep probabilities for analysis
     all_probs = None
@@ -231,60 +205,29 @@ def ensemble_bald(pred_model,generator,data_size,**kwargs):
             print("Starting ensemble sampling...")
         l = range(emodels)
 
-    #single,parallel = model.build(preload_w=False)
-    
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,emodels))
-            sys.stdout.flush()
-            
-        model.register_ensemble(d)
-
-        curmodel = pred_model[d]
-        curmodel = load_model_weights(config,model,curmodel,sw_thread)
-        
-        proba = curmodel.predict_generator(generator,
-                                                workers=5*cpu_count,
-                                                max_queue_size=100*gpu_count,
-                                                verbose=0)
-        if config.debug:
-            all_probs[d] = proba
-            
-        #computing G_X
-        score_All = np.add(score_All,proba,out=score_All)
-
-        #computing F_X
-        dropout_score_log = np.log2(proba)
-        Entropy_Compute = - np.multiply(proba, dropout_score_log,out=dropout_score_log)
-        Entropy_Per_Dropout = np.sum(Entropy_Compute, axis=1)
-        All_Entropy_Dropout = np.add(All_Entropy_Dropout, Entropy_Per_Dropout,out=All_Entropy_Dropout)
-        
-        del(proba)
-        del(dropout_score_log)
-        del(Entropy_Compute)
-        del(curmodel)
-
-    Avg_Pi = np.divide(score_All, emodels)
-    Log_Avg_Pi = np.log2(Avg_Pi)
-    Entropy_Avg_Pi = - np.multiply(Avg_Pi, Log_Avg_Pi)
-    Entropy_Average_Pi = np.sum(Entropy_Avg_Pi, axis=1)
-
-    G_X = Entropy_Average_Pi
-
-    #Average entropy
-    F_X = np.divide(All_Entropy_Dropout, emodels)
-
-    #F_X = Average_Entropy
-    U_X = G_X - F_X
-    a_1d = U_X.flatten()
+    curmodels = _load_members(config,model,pred_model,sw_thread,l,pbar,kwargs.get('train_gen',None))
+
+    #Each decoded batch goes through all members before the next one is read
+    ckpt = ScoringCheckpoint(config,model,generator,sw_thread)
+    extra = {'all_probs':all_probs} if config.debug else None
+    for rows,inp in iterate_batches(generator,5*cpu_count,start=ckpt.restore(acc,extra)):
+        for d in range(emodels):
+            proba = curmodels[d].predict_on_batch(inp)
+            if config.debug:
+                all_probs[d,rows] = proba
+            acc.update(rows,proba)
+            report_output(kwargs,'probs',(rows,d,proba))
+        ckpt.step(acc,extra)
+    ckpt.clear()
+
+    #G_X - F_X: entropy of average prediction minus average entropy
+    a_1d = acc.scores()
     x_pool_index = a_1d.argsort()[-query:][::-1]    
+    report_output(kwargs,'scores',a_1d)
 
-    #Release memory - there's a leak somewhere
-    del(score_All)
-    del(All_Entropy_Dropout)
-    del(U_X)
-    del(G_X)
-    del(F_X)
+    #Release memory
+    del(acc)
+    del(curmodels)
     
     if save_var:
         cache_m.dump((x_pool_index,a_1d),fid)
@@ -302,3 +245,68 @@ def ensemble_bald(pred_model,generator,data_size,**kwargs):
         print("Maximum entropy in pool: {0}".format(a_1d.max()))
     
     return x_pool_index
+
+def _load_members(config,model,pred_model,sw_thread,l,pbar,train_gen=None):
+    """
+    Loads weights of every ensemble member, returns a list of members ready for prediction.
+
+    @param train_gen <ThreadedGenerator>: calibration data for int8 members (see -quantize)
+    """
+    quantize = getattr(config,'quantize',0) > 0 and not train_gen is None
+    if quantize:
+        from .Quantization import quantize_model
+    curmodels = []
+    for d in l:
+        if not pbar and config.info:
+            print("Step {0}/{1}".format(d+1,config.emodels))
+            sys.stdout.flush()
+            
+        model.register_ensemble(d)
+        member = load_model_weights(config,model,pred_model[d],sw_thread)
+        curmodels.append(quantize_model(config,member,train_gen,model.get_weights_cache()) if quantize else member)
+
+    return curmodels
+
+def distilled_uncert(pred_model,generator,data_size,**kwargs):
+    """
+    Ensemble uncertainty as predicted by a distilled student (see Trainers.Distillation): one forward
+    pass per batch, items are ranked by the student's disagreement head.
+
+    pred_model <keras.Model>: student with outputs [probabilities,disagreement]
+    generator <keras.Sequence>: data generator for predictions
+    data_size <int>: number of data samples
+    """
+    from Utils import CacheManager
+    cache_m = CacheManager()
+
+    if 'config' in kwargs:
+        config = kwargs['config']
+        cpu_count = config.cpu_count
+        verbose = config.verbose
+        query = config.acquire
+        save_var = config.save_var
+    else:
+        return None
+
+    if config.info:
+        print("Starting student sampling...")
+
+    a_1d = np.zeros(data_size,dtype=np.float32)
+    for rows,inp in iterate_batches(generator,5*cpu_count):
+        proba,dis = pred_model.predict_on_batch(inp)
+        a_1d[rows] = dis.flatten()
+        report_output(kwargs,'probs',(rows,0,proba))
+
+    x_pool_index = a_1d.argsort()[-query:][::-1]
+    report_output(kwargs,'scores',a_1d)
+
+    if save_var:
+        fid = 'al-uncertainty-{1}-r{0}.pik'.format(kwargs.get('acquisition',0),'distilled_uncert')
+        cache_m.registerFile(os.path.join(config.logdir,fid),fid)
+        cache_m.dump((x_pool_index,a_1d),fid)
+
+    if verbose > 0:
+        print("Selected item's predicted disagreement: {0}".format(a_1d[x_pool_index]))
+        print("Maximum predicted disagreement in pool: {0}".format(a_1d.max()))
+
+    return x_pool_index
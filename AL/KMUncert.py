@@ -7,7 +7,10 @@ from tqdm import tqdm
 
 from scipy.stats import mode
 
-from .Common import extract_feature_from_function
+from .Common import extract_features_cached,open_feature_store,score_and_extract,report_output
+from .Accumulators import accumulator_for
+from .Projection import get_projector,save_projector
+from .Clustering import warm_kmeans,space_fingerprint
 
 __doc__ = """
 All acquisition functions should receive:
@@ -42,7 +45,6 @@ def _km_uncert(trained_models,generator,data_size,**kwargs):
     sw_threads <thread Object>: if a thread object is passed, you must wait its conclusion before loading weights
     """
     from sklearn.cluster import KMeans,MiniBatchKMeans
-    from sklearn.decomposition import PCA
     import importlib
     import copy
     import time
@@ -73,28 +75,40 @@ def _km_uncert(trained_models,generator,data_size,**kwargs):
         print("[km_uncert] GenericModel is needed by km_uncert. Set model kw argument")
         return None
 
+    reuse_clusters = config.recluster > 0 and acq > 0 and (acq % config.recluster) != 0
+
+    #Uncertainty scores are not km_uncert's selection scores, observers get them as 'uncertainty'
+    kwargs['observers'] = [_relabel(o) for o in kwargs.get('observers',[])]
+    
     ## UNCERTAINTY CALCULATION FIRST 
-    #Any uncertainty function could be used
-    #TODO: BAYESIAN FUNCTIONS SHOULD BUILD A NEW MODEL, ENABLING DROPOUT
-    n_config = copy.copy(config)
-    n_config.acquire = data_size
-    kwargs['config'] = n_config
-    un_function = getattr(importlib.import_module('AL'),config.un_function)
-    un_indexes = un_function(trained_models,generator,data_size,**kwargs)
-    del(un_function)
+    #Ensemble uncertainty and features come from the same forward pass, if the model supports it.
+    #Bayesian functions need dropout active, which would make features noisy, so they run separately
+    features = None
+    if (not reuse_clusters and config.fstore is None and model.is_ensemble() and isinstance(trained_models,dict) and
+            config.un_function in ('ensemble_bald','ensemble_varratios') and hasattr(model,'build_scoring_function')):
+        un_indexes,features = _combined_pass(trained_models,generator,data_size,model,config,kwargs)
+    else:
+        #Any uncertainty function could be used
+        #TODO: BAYESIAN FUNCTIONS SHOULD BUILD A NEW MODEL, ENABLING DROPOUT
+        n_config = copy.copy(config)
+        n_config.acquire = data_size
+        kwargs['config'] = n_config
+        un_function = getattr(importlib.import_module('AL'),config.un_function)
+        un_indexes = un_function(trained_models,generator,data_size,**kwargs)
+        del(un_function)
 
     if not model.is_ensemble() and not (os.path.isfile(model.get_weights_cache()) or not os.path.isfile(model.get_mgpu_weights_cache())):
         if config.info:
             print("[km_uncert] No trained model or weights file found (H5).")
         return None
 
-    if config.recluster > 0 and acq > 0 and (acq % config.recluster) != 0:
+    if reuse_clusters:
         km,acquired = cache_m.load('clusters.pik')
         if config.info:
             print("[km_uncert] Loaded clusters from previous acquisition")
         km.labels_ = np.delete(km.labels_,acquired)
-    else:
-        #Run feature extraction and clustering
+    elif features is None:
+        #Run feature extraction
         ext_time = None
         if config.info:
             print("Starting feature extraction ({} batches)...".format(len(generator)))
@@ -110,31 +124,34 @@ def _km_uncert(trained_models,generator,data_size,**kwargs):
         if model.is_ensemble():
             generator.set_input_n(config.emodels)
             
-        #Extract features for all images in the pool
-        features = extract_feature_from_function(pred_model,generator)
+        #Extract features for all images in the pool, PCA projection (if any) is applied per batch
+        projector = get_projector(config,model)
+        features = extract_features_cached(pred_model,generator,open_feature_store(config,model),projector)
+        save_projector(config,model,projector)
 
         del(pred_model)
         
-        #features = features.reshape(features.shape[0],np.prod(features.shape[1:]))
-
         if config.info:
             print("Feature vector shape: {}".format(features.shape))
-            
-        if config.pca > 0:
-            if config.info:
-                print("Starting PCA decomposition ({} features)...".format(config.pca))
+            td = timedelta(seconds=(time.time() - ext_time))
+            print("Feature extraction took: {}".format(td))
 
-            pca = PCA(n_components = config.pca)
-            features = pca.fit_transform(features)
-            
+    if not features is None:
+        report_output(kwargs,'features',features)
+
+    if not reuse_clusters:
+        #Clustering
         stime = None
         etime = None
-        if config.info:
-            td = timedelta(seconds=(time.time() - ext_time))
-            print("Feature extraction took: {}".format(td))
+        if config.verbose > 0:
             stime = time.time()
             
-        if data_size < 10000:
+        if config.kmwarm:
+            fid = 'kmwarm-{}.pik'.format(model.name)
+            cache_m.registerFile(os.path.join(config.cache,fid),fid)
+            km = warm_kmeans(features,generator.returnDataAsArray()[0],clusters,fid,space_fingerprint(config,model),
+                                 workers=cpu_count,verbose=verbose)
+        elif data_size < 10000:
             km = KMeans(n_clusters = clusters, init='k-means++',n_jobs=max(int(cpu_count/2),1)).fit(features)
         else:
             km = MiniBatchKMeans(n_clusters = clusters, init='k-means++',batch_size=500).fit(features)
@@ -146,11 +163,13 @@ def _km_uncert(trained_models,generator,data_size,**kwargs):
             td = timedelta(seconds=(etime-stime))
             print("KMeans took {}".format(td))
 
-    un_clusters = {k:[] for k in range(clusters)}
-
-    #Distributes items in clusters in descending order of uncertainty
-    for iid in un_indexes:
-        un_clusters[km.labels_[iid]].append(iid)
+    #Distributes items in clusters in descending order of uncertainty. A stable sort by cluster label keeps
+    #uncertainty order inside each cluster, so rank_order holds each cluster's positions in un_indexes (ranks)
+    un_indexes = np.asarray(un_indexes)
+    un_labels = km.labels_[un_indexes]
+    rank_order = np.argsort(un_labels,kind='stable')
+    bounds = np.searchsorted(un_labels[rank_order],np.arange(clusters+1))
+    un_clusters = {k:un_indexes[rank_order[bounds[k]:bounds[k+1]]] for k in range(clusters)}
 
     #Save clusters
     if config.save_var:
@@ -167,10 +186,7 @@ def _km_uncert(trained_models,generator,data_size,**kwargs):
     posa = {}
     for k in range(clusters):
         ind = np.asarray(un_clusters[k],dtype=np.int32)
-        posa[k] = []
-        for ii in range(min(ind.shape[0],query)):
-            posa[k].append(np.where(un_indexes == ind[ii])[0][0])
-        posa[k] = np.asarray(posa[k],dtype=np.int32)
+        posa[k] = rank_order[bounds[k]:min(bounds[k+1],bounds[k]+query)].astype(np.int32)
         
         #If debug
         if config.debug:
@@ -191,64 +207,101 @@ def _km_uncert(trained_models,generator,data_size,**kwargs):
             del(expected)
 
     if 'ng_logic' in kwargs and kwargs['ng_logic']:
-        return _acq_ng_logic(posa,clusters,un_clusters,query,config,verbose,cache_m)
+        return _acq_ng_logic(posa,clusters,un_clusters,query,config,verbose,cache_m,km)
     else:
-        return _acq_logic(clusters,un_clusters,query,config,verbose,cache_m)
-
-def _acq_ng_logic(posa,clusters,un_clusters,query,config,verbose,cache_m):
-    #Acquisition logic
-    ac_count = 0
-    acquired = []
-    j,n = 0,0
-    cmean = np.asarray([np.mean(posa[k]) for k in range(clusters)])
-    glb = np.sum(cmean)
-    frac = (glb/cmean)/np.sum(glb/cmean)
-    frac[np.isnan(frac)] = 1/clusters #Prevent NaN values if cmean is zero
-    sel = np.zeros(clusters,dtype=np.int32)
-    while ac_count < query:
-        cln = n % clusters
-        q = un_clusters[cln]
-        cl_aq = int(np.ceil(frac[cln]*query))
-        first = sel[cln]
-        if len(q) >= first + cl_aq:
-            acquired.extend(q[first:first+cl_aq])
-            ac_count += cl_aq
-            sel[cln] = first+cl_aq
-            j += 1
-            n = j
-            if config.debug or verbose > 0:
-                print("[km_uncert] Selected {} patches for acquisition from cluster {}".format(cl_aq,cln))
-        else:
-            l = len(q)
-            acquired.extend(q[first:l])
-            ac_count += l-first
-            sel[cln] = l
-            np.random.seed(n*(n+1))
-            r = np.random.randint(0,clusters)
-            n = r if r != n else n+1
-            if verbose > 0:
-                print("[km_uncert] Cluster {} exausted, all {} patches acquired. Will try to acquire remaining patches from cluster {}".format(cln,l-first,(n)%clusters))
-    acquired = np.asarray(acquired[:query],dtype=np.int32)
+        return _acq_logic(clusters,un_clusters,query,config,verbose,cache_m,km)
+
+def _relabel(observer):
+    return lambda name,data: observer('uncertainty' if name == 'scores' else name,data)
+
+def _combined_pass(trained_models,generator,data_size,model,config,kwargs):
+    """
+    Single pool pass returning (uncertainty ranked indexes,features), for ensemble uncertainty functions.
+    Ranking is the same as returned by the corresponding ensemble function when asked for data_size items.
+    """
+    import time
+    from datetime import timedelta
+    from Utils import CacheManager
+
+    cache_m = CacheManager()
+    sw_thread = kwargs.get('sw_thread',None)
+
+    stime = None
+    if config.info:
+        print("[km_uncert] Starting combined uncertainty/feature pass ({} batches)...".format(len(generator)))
+        stime = time.time()
+        
+    function = model.build_scoring_function(model=trained_models,parallel=config.gpu_count>1,sw_thread=sw_thread,new=True)
+    generator.set_input_n(config.emodels)
+    acc = accumulator_for(config.un_function,data_size,generator.classes,config.emodels)
+    projector = get_projector(config,model)
+    features = score_and_extract(function,generator,acc,config.emodels,projector)
+    save_projector(config,model,projector)
+    del(function)
+    
+    a_1d = acc.scores()
+    un_indexes = a_1d.argsort()[-data_size:][::-1]
+    report_output(kwargs,'scores',a_1d)
+
+    if config.save_var:
+        fid = 'al-uncertainty-{1}-r{0}.pik'.format(kwargs.get('acquisition',config.acquisition_steps),config.ac_function)
+        cache_m.registerFile(os.path.join(config.logdir,fid),fid)
+        cache_m.dump((un_indexes,a_1d),fid)
+
+    if config.info:
+        td = timedelta(seconds=(time.time() - stime))
+        print("Feature vector shape: {}".format(features.shape))
+        print("Combined pass took: {}".format(td))
+    if config.verbose > 0:
+        print("Maximum uncertainty in pool: {0}".format(a_1d.max()))
+        
+    return un_indexes,features
+
+def _round_robin(clusters,un_clusters,query,chunks):
+    """
+    Sort based cluster-stratified selection. Clusters are visited in order and each visit takes the next
+    chunks[k] items of cluster k (in uncertainty order); exhausted clusters are skipped. Returns at most query
+    indexes, never more than the clustered items.
+
+    @param chunks <np.array>: items taken from each cluster per visit
+    """
+    sizes = np.asarray([len(un_clusters[k]) for k in range(clusters)],dtype=np.int64)
+    if np.sum(sizes) == 0:
+        return sizes,np.zeros(0,dtype=np.int64)
+    items = np.concatenate([np.asarray(un_clusters[k],dtype=np.int64) for k in range(clusters)])
+    labels = np.repeat(np.arange(clusters),sizes)
+    within = np.arange(items.shape[0]) - np.repeat(np.cumsum(sizes)-sizes,sizes)
+    visit = within // np.repeat(chunks,sizes)
+    return sizes,items[np.lexsort((within,labels,visit))[:query]]
+
+def _acq_ng_logic(posa,clusters,un_clusters,query,config,verbose,cache_m,km):
+    #Clusters with more uncertain items (lower mean rank) get larger shares of each visit
+    cmean = np.asarray([np.mean(posa[k]) if len(posa[k]) > 0 else np.nan for k in range(clusters)])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        glb = np.nansum(cmean)
+        frac = (glb/cmean)/np.nansum(glb/cmean)
+    frac[~np.isfinite(frac)] = 1/clusters #Prevent NaN values if cmean is zero or cluster is empty
+    chunks = np.maximum(1,np.ceil(frac*query)).astype(np.int64)
+    sizes,acquired = _round_robin(clusters,un_clusters,query,chunks)
+
+    if verbose > 0:
+        for k in range(clusters):
+            print("[km_uncert] Cluster {}: {} patches per visit, {} acquired".format(k,chunks[k],np.sum(np.isin(acquired,un_clusters[k]))))
+    acquired = np.asarray(acquired,dtype=np.int32)
     if config.recluster > 0:
         cache_m.dump((km,acquired),'clusters.pik')
     
     return acquired
 
-def _acq_logic(clusters,un_clusters,query,config,verbose,cache_m):
-    ac_count = 0
-    acquired = []
-    j = 0
-    while ac_count < query:
-        cln = (ac_count+j) % clusters
-        q = un_clusters[cln]
-        if len(q) > 0:
-            acquired.append(q.pop(0))
-            ac_count += 1
-        else:
-            if verbose > 0:
-                print("[km_uncert] Cluster {} exausted, will try to acquire image from cluster {}".format(cln,(cln+1)%clusters))
-            j += 1
-            continue
+def _acq_logic(clusters,un_clusters,query,config,verbose,cache_m,km):
+    #Round robin over clusters, in uncertainty order: the n-th item of every cluster is acquired before
+    #the (n+1)-th item of any cluster. Exhausted clusters are skipped.
+    sizes,acquired = _round_robin(clusters,un_clusters,query,np.ones(clusters,dtype=np.int64))
+
+    if verbose > 0 and acquired.shape[0] > 0:
+        rounds = int(np.ceil(query/max(1,np.sum(sizes > 0))))
+        for k in np.where(sizes < rounds)[0]:
+            print("[km_uncert] Cluster {} exausted ({} items)".format(k,sizes[k]))
         
     acquired = np.asarray(acquired)
     if config.recluster > 0:
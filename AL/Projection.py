@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+import os
+import hashlib
+
+__doc__ = """
+Feature space projections shared by feature based acquisition functions.
+
+A projector is fitted once for a given feature extractor state (identified by its weights)
+on a bounded sample of the extracted features. It is then applied batch by batch during extraction,
+so every set (pool, training set, superpool space) lands in the same reduced space.
+"""
+
+#Registry weights already hashed: key -> (weights list,digest)
+_digests = {}
+
+def weights_digest(weights):
+    """
+    MD5 of a list of weight arrays (shapes and contents).
+    """
+    fp = hashlib.md5()
+    for w in weights:
+        w = np.ascontiguousarray(w)
+        fp.update(str(w.shape).encode())
+        fp.update(w.data)
+    return fp.hexdigest()
+
+def extractor_fingerprint(config,genmodel):
+    """
+    Identifies the current feature extractor state. Weights trained in this process are taken from the
+    WeightsRegistry, as load_model_weights does, and hashed; otherwise weights files are identified by path,
+    size and modification time. Ensembles are fingerprinted over all members.
+
+    @param genmodel <GenericModel>: model that builds the extractor
+    """
+    ffeat = getattr(config,'ffeat',None)
+    states = []
+    if not ffeat is None and os.path.isfile(ffeat):
+        states.extend(_files_state([ffeat]))
+    elif genmodel.is_ensemble() and hasattr(genmodel,'register_ensemble'):
+        cur = genmodel.return_model_n()
+        for m in range(config.emodels):
+            genmodel.register_ensemble(m)
+            states.extend(_weights_state(genmodel))
+        if cur >= 0:
+            genmodel.register_ensemble(cur)
+    else:
+        states.extend(_weights_state(genmodel))
+
+    fp = hashlib.md5()
+    for st in states:
+        fp.update(st.encode())
+    return fp.hexdigest()
+
+def _weights_state(genmodel):
+    """
+    In memory weights (the ones used for extraction) have precedence over files, which may still be
+    written or belong to a previous round.
+    """
+    from Utils import WeightsRegistry
+
+    registry = WeightsRegistry()
+    for key in (genmodel.get_weights_cache(),genmodel.get_mgpu_weights_cache()):
+        weights = registry.get(key)
+        if weights is None:
+            continue
+        if not key in _digests or not _digests[key][0] is weights:
+            _digests[key] = (weights,weights_digest(weights))
+        return ["{}:{}".format(os.path.abspath(key),_digests[key][1])]
+    return _files_state(_weights_files(genmodel))
+
+def _weights_files(genmodel):
+    files = [genmodel.get_weights_cache(),genmodel.get_mgpu_weights_cache()]
+    if hasattr(genmodel,'get_npweights_cache'):
+        files.append(genmodel.get_npweights_cache(add_ext=True))
+    if hasattr(genmodel,'get_npmgpu_weights_cache'):
+        files.append(genmodel.get_npmgpu_weights_cache(add_ext=True))
+    return [f for f in files if not f is None]
+
+def _files_state(paths):
+    states = []
+    for p in paths:
+        if os.path.isfile(p):
+            st = os.stat(p)
+            states.append("{}:{}:{}".format(os.path.abspath(p),st.st_size,st.st_mtime_ns))
+    return states
+
+class PCAProjector(object):
+    """
+    Randomized PCA fitted on a bounded feature sample. Keeps only the mean and the
+    projection matrix (float32), so pickling it is cheap.
+    """
+    def __init__(self,n_components,fingerprint=None,sample=5000):
+        self.n_components = n_components
+        self.fingerprint = fingerprint
+        self.sample = sample
+        self.mean_ = None
+        self.components_ = None
+
+    def fitted(self):
+        return not self.components_ is None
+
+    def fit(self,X):
+        from sklearn.decomposition import PCA
+
+        X = X.reshape(X.shape[0],-1)
+        pca = PCA(n_components=min(self.n_components,X.shape[0],X.shape[1]),svd_solver='randomized')
+        pca.fit(X)
+        self.mean_ = pca.mean_.astype(np.float32)
+        self.components_ = np.ascontiguousarray(pca.components_.T,dtype=np.float32)
+        return self
+
+    def transform(self,X):
+        X = np.asarray(X,dtype=np.float32).reshape(X.shape[0],-1)
+        return np.dot(X - self.mean_,self.components_)
+
+    def fit_from_function(self,function,generator):
+        """
+        Fits the projector on features of randomly chosen generator batches, up to self.sample items.
+        Batches are fetched by index, generator iteration state is not changed.
+        """
+        nbatches = len(generator)
+        n = min(nbatches,int(np.ceil(self.sample/generator.batch_size)))
+        features = []
+        for b in np.random.choice(nbatches,n,replace=False):
+            inp = generator[int(b)][0]
+            if not isinstance(inp,list):
+                inp = [inp]
+            ff = function(inp)[0]
+            features.append(ff.reshape(ff.shape[0],-1))
+        return self.fit(np.concatenate(features,axis=0))
+
+def get_projector(config,genmodel):
+    """
+    Returns the cached projector if it was fitted for the current extractor state, or a new
+    (unfitted) one. Returns None if PCA is not requested (config.pca == 0).
+    Projectors fitted during extraction should be stored with save_projector.
+    """
+    from Utils import CacheManager
+
+    if config.pca <= 0:
+        return None
+
+    cache_m = CacheManager()
+    fp = extractor_fingerprint(config,genmodel)
+    fid = 'pca-projector-{}.pik'.format(genmodel.name)
+    cache_m.registerFile(os.path.join(config.cache,fid),fid)
+    if cache_m.checkFileExistence(fid):
+        proj = cache_m.load(fid)
+        if proj.fingerprint == fp and proj.n_components == config.pca and proj.fitted():
+            if config.info:
+                print("[Projection] Reusing PCA projection fitted for current extractor weights")
+            return proj
+
+    return PCAProjector(config.pca,fp,getattr(config,'pca_sample',5000))
+
+def save_projector(config,genmodel,proj):
+    from Utils import CacheManager
+
+    if proj is None or not proj.fitted():
+        return
+    cache_m = CacheManager()
+    fid = 'pca-projector-{}.pik'.format(genmodel.name)
+    cache_m.registerFile(os.path.join(config.cache,fid),fid)
+    cache_m.dump(proj,fid)
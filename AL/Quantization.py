@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import time
+import numpy as np
+from .Projection import weights_digest
+
+__doc__ = """
+Int8 post-training quantized inference (see -quantize), for CPU pool scoring and prediction.
+
+A trained Keras model is converted to a TFLite graph with int8 weights and activations (float input and
+output), calibrated on a sample of training set batches. Operations without int8 kernels fall back to float.
+
+MC dropout: TFLite graphs have no random number generation, so every Dropout layer applied with training=True
+is replaced by a multiplication with a mask input before conversion. QuantizedModel draws fresh Bernoulli
+masks at every predict_on_batch call, so repeated calls are MC samples as with the float model. Dropout
+layers of nested models (e.g. ensemble towers) are kept as they are.
+
+QuantizedModel implements predict_on_batch, so it can be used as pred_model by AL functions and Predictor.
+
+Converted models are kept in memory, one per model (weights cache path and dropout layout), and reused while
+that model's weights do not change, so a model is converted once per training round.
+"""
+
+#Converted models: (key,dropout specs) -> (weights digest,QuantizedModel)
+_converted = {}
+
+def _dropout_layout(model):
+    """
+    Returns [(input shape,rate)] of Dropout layers applied with training=True, in _mask_inputs order, without
+    building anything.
+    """
+    from keras import backend as K
+    from keras.layers import Dropout
+
+    specs = []
+    for depth in sorted(model._nodes_by_depth.keys(),reverse=True):
+        for node in model._nodes_by_depth[depth]:
+            kwargs = node.arguments if node.arguments else {}
+            if isinstance(node.outbound_layer,Dropout) and kwargs.get('training',None) is True:
+                specs.append((K.int_shape(node.input_tensors[0])[1:],node.outbound_layer.rate))
+    return specs
+
+def _mask_inputs(model):
+    """
+    Rebuilds model (reusing its layers and weights) with stochastic Dropout layers replaced by mask inputs.
+
+    Returns: (keras.Model with inputs model.inputs + masks,[(mask shape,rate)])
+    """
+    from keras import backend as K
+    from keras.models import Model
+    from keras.layers import Input,Dropout,Multiply,InputLayer
+
+    new_inputs = [Input(batch_shape=K.int_shape(x)) for x in model.inputs]
+    tensor_map = dict(zip(model.inputs,new_inputs))
+    masks,specs = [],[]
+    for depth in sorted(model._nodes_by_depth.keys(),reverse=True):
+        for node in model._nodes_by_depth[depth]:
+            layer = node.outbound_layer
+            if isinstance(layer,InputLayer):
+                continue
+            computed = [tensor_map[x] for x in node.input_tensors if x in tensor_map]
+            if len(computed) != len(node.input_tensors):
+                continue
+            kwargs = dict(node.arguments) if node.arguments else {}
+            if isinstance(layer,Dropout):
+                x = computed[0]
+                if kwargs.get('training',None) is True:
+                    shape = K.int_shape(x)[1:]
+                    mask = Input(shape=shape)
+                    masks.append(mask)
+                    specs.append((shape,layer.rate))
+                    x = Multiply()([x,mask])
+                out = [x]
+            else:
+                out = layer(computed[0] if len(computed) == 1 else computed,**kwargs)
+                out = out if isinstance(out,list) else [out]
+            for x,y in zip(node.output_tensors,out):
+                tensor_map[x] = y
+
+    return Model(inputs=new_inputs+masks,outputs=[tensor_map[x] for x in model.outputs]),specs
+
+def _draw_masks(specs,batch):
+    return [(np.random.binomial(1,1.0-rate,size=(batch,)+tuple(shape))/(1.0-rate)).astype(np.float32) for shape,rate in specs]
+
+def _as_list(inp):
+    return list(inp) if isinstance(inp,list) else [inp]
+
+class QuantizedModel(object):
+    """
+    TFLite int8 interpreter with a Keras like predict_on_batch.
+    """
+    def __init__(self,tflite_model,specs,input_names,n_inputs,threads=1):
+        """
+        @param specs <list>: (shape,rate) of dropout masks
+        @param input_names <list>: names of the converted graph's inputs (images first, then masks)
+        """
+        import tensorflow as tf
+        try:
+            self._interpreter = tf.lite.Interpreter(model_content=tflite_model,num_threads=threads)
+        except TypeError:
+            self._interpreter = tf.lite.Interpreter(model_content=tflite_model)
+        self._specs = specs
+        self._n_inputs = n_inputs
+        details = {d['name']:d for d in self._interpreter.get_input_details()}
+        self._inputs = [details[n] for n in input_names]
+        self._output = self._interpreter.get_output_details()[0]['index']
+        self._batch = None
+        self.size = len(tflite_model)
+
+    def _resize(self,batch):
+        if batch == self._batch:
+            return
+        for d in self._inputs:
+            self._interpreter.resize_tensor_input(d['index'],[batch]+list(d['shape'][1:]))
+        self._interpreter.allocate_tensors()
+        self._batch = batch
+
+    def predict_on_batch(self,inp,masks=None):
+        """
+        @param masks <list>: dropout masks (drawn at random if None)
+        """
+        inp = _as_list(inp)[:self._n_inputs]
+        batch = inp[0].shape[0]
+        if masks is None:
+            masks = _draw_masks(self._specs,batch)
+        self._resize(batch)
+        for d,x in zip(self._inputs,inp+masks):
+            self._interpreter.set_tensor(d['index'],np.asarray(x,dtype=d['dtype']))
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output).copy()
+
+def _sample_batches(generator,n_items):
+    nb = min(len(generator),max(1,int(np.ceil(n_items/generator.batch_size))))
+    return np.random.choice(len(generator),nb,replace=False)
+
+def quantize_model(config,model,generator,key=None):
+    """
+    Converts a Keras model. Returns a QuantizedModel or model itself if conversion is not possible.
+    A previous conversion of the same model is returned if its weights are unchanged.
+
+    @param model <keras.Model>: trained model (single tower)
+    @param generator <ThreadedGenerator>: training data generator, config.quantize items are used for calibration
+    and the same number of items for the float/int8 comparison
+    @param key <str>: identifies the model between calls, usually its weights cache path (Default: model name)
+    """
+    import tensorflow as tf
+    from keras import backend as K
+
+    if config.gpu_count > 1:
+        if config.info:
+            print("[Quantization] Multi-GPU models are not quantized.")
+        return model
+
+    #Cache lookup does not touch the graph, the masked model is only built for conversion
+    slot = (model.name if key is None else key,tuple(_dropout_layout(model)))
+    digest = weights_digest(model.get_weights())
+    if slot in _converted and _converted[slot][0] == digest:
+        if config.info:
+            print("[Quantization] Weights unchanged, reusing converted model ({})".format(slot[0]))
+        return _converted[slot][1]
+
+    stime = time.time()
+    mnet,specs = _mask_inputs(model)
+    n_inputs = len(model.inputs)
+    batches = _sample_batches(generator,2*config.quantize)
+    calibration = batches[:max(1,batches.shape[0]//2)]
+    comparison = batches[calibration.shape[0]:]
+
+    def _representative():
+        for b in calibration:
+            inp = _as_list(generator[b][0])[:n_inputs]
+            for i in range(inp[0].shape[0]):
+                masks = _draw_masks(specs,1)
+                yield [x[i:i+1].astype(np.float32) for x in inp] + masks
+
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(),mnet.inputs,mnet.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    #TF1 converters expect a RepresentativeDataset wrapper, not the generator function
+    if hasattr(tf.lite,'RepresentativeDataset'):
+        converter.representative_dataset = tf.lite.RepresentativeDataset(_representative)
+    else:
+        converter.representative_dataset = _representative
+    try:
+        tflite_model = converter.convert()
+    except Exception as e:
+        #Graphs with operations TFLite can not convert: scoring goes on with the float model, but say so
+        print("[Quantization] Int8 conversion FAILED, the float model will be used ({}: {})".format(type(e).__name__,e))
+        return model
+    qmodel = QuantizedModel(tflite_model,specs,[x.name.split(':')[0] for x in mnet.inputs],n_inputs,
+                                threads=config.cpu_count)
+    _converted[slot] = (digest,qmodel)
+
+    if config.info:
+        print("[Quantization] Model converted in {:.1f}s ({:.1f} MB; {} stochastic dropout layers)".format(time.time()-stime,
+                  qmodel.size/1e6,len(specs)))
+        if comparison.shape[0] > 0:
+            compare(mnet,qmodel,generator,comparison,specs,n_inputs)
+    return qmodel
+
+def compare(mnet,qmodel,generator,batches,specs,n_inputs):
+    """
+    Reports accuracy and latency of float and int8 models over the given generator batches. Both models get the
+    same dropout masks.
+    """
+    ftime,qtime = 0.0,0.0
+    fhit,qhit,agree,diff,n = 0,0,0,0.0,0
+    for b in batches:
+        inp,y = generator[b]
+        inp = _as_list(inp)[:n_inputs]
+        masks = _draw_masks(specs,inp[0].shape[0])
+        stime = time.time()
+        fp = mnet.predict_on_batch(inp+masks)
+        ftime += time.time() - stime
+        stime = time.time()
+        qp = qmodel.predict_on_batch(inp,masks)
+        qtime += time.time() - stime
+        expected = y.argmax(axis=-1)
+        fhit += np.sum(fp.argmax(axis=-1) == expected)
+        qhit += np.sum(qp.argmax(axis=-1) == expected)
+        agree += np.sum(fp.argmax(axis=-1) == qp.argmax(axis=-1))
+        diff += np.sum(np.abs(fp-qp))
+        n += expected.shape[0]
+
+    print("[Quantization] {} items: float accuracy {:.4f}, int8 accuracy {:.4f} (delta {:+.4f}); prediction agreement {:.4f}; mean abs. probability difference {:.5f}".format(
+        n,fhit/n,qhit/n,(qhit-fhit)/n,agree/n,diff/(n*fp.shape[-1])))
+    print("[Quantization] Latency per batch: float {:.2f} ms, int8 {:.2f} ms (speedup {:.2f}x)".format(
+        1000*ftime/len(batches),1000*qtime/len(batches),ftime/max(qtime,1e-9)))
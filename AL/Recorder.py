@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import json
+import numpy as np
+
+from Utils import sample_key
+
+__doc__ = """
+Per acquisition recording of scoring outputs (see -record), for offline replay (Utils/ALReplay.py).
+
+Acquisition functions hand their outputs to observers (Common.report_output):
+- 'probs': (rows,member,probabilities) for each batch and ensemble member/MC dropout iteration;
+- 'scores': per item acquisition scores ('uncertainty' for functions that do not select by score);
+- 'features','train_features': feature vectors of pool and training items.
+
+One compressed .npz file is written per acquisition in <logdir>/record: sample IDs, labels, selected indexes,
+float16 probabilities (members,items,classes) and features, float32 scores and a JSON metadata string.
+"""
+
+class RoundRecorder(object):
+    def __init__(self,config,r):
+        self.r = r
+        self.path = os.path.join(config.logdir,'record','al-record-r{}.npz'.format(r))
+        self._probs = {}
+        self._arrays = {}
+
+    def observe(self,name,data):
+        if name == 'probs':
+            rows,member,proba = data
+            self._probs.setdefault(member,[]).append((rows,np.asarray(proba,dtype=np.float16)))
+        elif name in ('scores','uncertainty'):
+            self._arrays[name] = np.asarray(data,dtype=np.float32)
+        elif name in ('features','train_features'):
+            data = np.asarray(data)
+            self._arrays[name] = data.reshape(data.shape[0],-1).astype(np.float16)
+
+    def save(self,items,labels,selected,function_name,acquire):
+        """
+        @param items <np.array>: scored items (generator order)
+        @param labels <np.array>: their labels
+        @param selected <np.array>: indexes selected by the acquisition function
+        """
+        arrays = dict(self._arrays)
+        if len(self._probs) > 0:
+            members = sorted(self._probs.keys())
+            classes = self._probs[members[0]][0][1].shape[1]
+            probs = np.zeros((len(members),len(items),classes),dtype=np.float16)
+            for m,member in enumerate(members):
+                for rows,proba in self._probs[member]:
+                    probs[m,rows] = proba
+            arrays['probs'] = probs
+
+        meta = {'round':self.r,'function':function_name,'acquire':acquire}
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        np.savez_compressed(self.path,
+                            keys=np.array([sample_key(it) for it in items]),
+                            labels=np.asarray(labels),
+                            selected=np.asarray(selected if not selected is None else [],dtype=np.int64),
+                            meta=np.array(json.dumps(meta)),
+                            **arrays)
+        self._probs.clear()
+        self._arrays.clear()
+        return self.path
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import numpy as np
+
+from Utils import CacheManager,sample_key
+
+__doc__ = """
+Stale-score pruning: keeps the last acquisition score of every pool item (and the round it was scored in),
+so that only promising candidates need to be rescored in most rounds:
+- top scored items of the previous ranking (fraction sskeep of the pool, at least acquire items);
+- a random exploration fraction (ssexp) of the remaining items;
+- items never scored (new items after pool regeneration).
+
+A full rescore is done every sscore rounds, when ranking drift (stale vs. fresh scores) is reported.
+Only acquisition functions that report per item scores (see Common.report_output) feed the tracker, pools
+are always fully scored otherwise.
+"""
+
+def _rank(a):
+    r = np.empty(a.shape[0],dtype=np.float64)
+    r[np.argsort(a,kind='stable')] = np.arange(a.shape[0])
+    return r
+
+class StaleScoreTracker(object):
+    """
+    Tracker state is kept in a cache file, so it can be used by different processes (see -pipeline).
+    """
+    def __init__(self,config,fid='al-stale-scores.pik'):
+        """
+        @param config <argparse>: uses sscore (full rescore period), sskeep, ssexp and acquire
+        """
+        self.period = config.sscore
+        self.keep = config.sskeep
+        self.explore = config.ssexp
+        self.query = config.acquire
+        self.info = config.info
+        self.fid = fid
+        self._cache_m = CacheManager()
+        self._cache_m.registerFile(os.path.join(config.logdir,fid),fid)
+
+    def _load(self):
+        state = None
+        if self._cache_m.checkFileExistence(self.fid):
+            state = self._cache_m.load(self.fid)
+        if state is None:
+            state = {'scores':{},'round':{},'full':None,'drift':[]}
+        return state
+
+    def _stale(self,state,keys):
+        return np.array([state['scores'].get(k,np.nan) for k in keys],dtype=np.float64)
+
+    def _retained(self,stale):
+        """
+        Indexes of the top scored items (previous ranking) and of items without scores
+        """
+        n_keep = min(stale.shape[0],max(int(self.keep*stale.shape[0]),self.query))
+        #NaN (unscored) items are sorted last
+        order = np.argsort(-stale,kind='stable')
+        scored = order[:np.count_nonzero(~np.isnan(stale))]
+        return scored[:n_keep],np.where(np.isnan(stale))[0]
+
+    def candidates(self,pool_x,r):
+        """
+        Returns the pool indexes to rescore at round r (sorted) or None if the whole pool should be scored.
+
+        @param pool_x <np.array>: current pool items
+        """
+        state = self._load()
+        if len(state['scores']) == 0 or state['full'] is None or (r - state['full']) >= self.period:
+            return None
+
+        stale = self._stale(state,[sample_key(x) for x in pool_x])
+        top,new = self._retained(stale)
+        rest = np.setdiff1d(np.arange(stale.shape[0]),np.concatenate((top,new)))
+        n_exp = int(self.explore*rest.shape[0])
+        explore = np.random.choice(rest,n_exp,replace=False) if n_exp > 0 else np.array([],dtype=rest.dtype)
+        cand = np.unique(np.concatenate((top,new,explore)).astype(np.int64))
+
+        if cand.shape[0] < self.query:
+            return None
+
+        if self.info:
+            print("[StaleScores] Rescoring {} of {} pool items (top: {}; unscored: {}; exploration: {})".format(
+                cand.shape[0],stale.shape[0],top.shape[0],new.shape[0],n_exp))
+        return cand
+
+    def update(self,pool_x,idx,scores,r,full=None):
+        """
+        Stores fresh scores.
+
+        @param idx <np.array>: pool indexes the scores refer to (None: whole pool was scored)
+        @param scores <np.array>: scores in idx order
+        @param full <bool>: this was a full rescore round, i.e. candidates returned None (Default: idx is None).
+        Later candidate stages (-wsi_cap, -cand_budget, -proxy) may narrow the scored set of a full round.
+        """
+        if scores is None:
+            return
+
+        state = self._load()
+        keys = [sample_key(x) for x in pool_x]
+        if full is None:
+            full = idx is None
+        if idx is None:
+            idx = np.arange(len(keys))
+        if full:
+            if len(state['scores']) > 0:
+                self._drift(state,[keys[i] for i in idx],scores,r)
+            state['full'] = r
+
+        #Items no longer in pool are dropped
+        pscores = {k:state['scores'][k] for k in keys if k in state['scores']}
+        prounds = {k:state['round'][k] for k in keys if k in state['round']}
+        for i,s in zip(idx,scores):
+            pscores[keys[i]] = float(s)
+            prounds[keys[i]] = r
+        state['scores'],state['round'] = pscores,prounds
+        self._cache_m.dump(state,self.fid)
+
+    def _drift(self,state,keys,scores,r):
+        """
+        Compares stale and fresh rankings: rank correlation (items with stale scores) and fraction of the
+        fresh top acquire items that would have been rescored (retained) with the stale ranking.
+
+        @param keys <list>: sample keys of the scored items (scores order)
+        """
+        stale = self._stale(state,keys)
+        known = ~np.isnan(stale)
+        if np.count_nonzero(known) < 2:
+            return
+
+        rho = np.corrcoef(_rank(stale[known]),_rank(scores[known]))[0,1]
+        top,new = self._retained(stale)
+        fresh_top = np.argsort(scores)[-self.query:]
+        recall = np.isin(fresh_top,np.concatenate((top,new))).mean()
+        ages = np.array([r - state['round'][k] for k in keys if k in state['round']])
+        state['drift'].append((r,rho,recall))
+
+        if self.info:
+            print("[StaleScores] Full rescore (round {}): rank correlation {:.4f}; top-{} recall of retained set {:.4f}; mean score age {:.1f} rounds".format(
+                r,rho,self.query,recall,ages.mean() if ages.shape[0] > 0 else 0.0))
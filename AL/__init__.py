@@ -4,7 +4,7 @@
 #__all__ = ['bayesian_varratios']
 
 from .BayesianFunctions import bayesian_varratios,bayesian_bald
-from .EnsembleFunctions import ensemble_varratios,ensemble_bald
+from .EnsembleFunctions import ensemble_varratios,ensemble_bald,distilled_uncert
 from .Common import random_sample,oracle_sample
 from .KMUncert import km_uncert,kmng_uncert
-from .gCoreSet import core_set,cs_select_batch
+from .gCoreSet import core_set,cs_select_batch,cs_approx_select_batch
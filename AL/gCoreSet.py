@@ -32,9 +32,9 @@ from __future__ import print_function
 
 import os
 import numpy as np
-from sklearn.metrics import pairwise_distances
 
-from .Common import load_model_weights
+from .Common import load_model_weights,extract_features_cached,open_feature_store,report_output
+from .Projection import get_projector,save_projector
 
 def __flatten_X(X):
     shape = X.shape
@@ -44,103 +44,302 @@ def __flatten_X(X):
     return flat_X
 
 
-def __update_distances(cluster_centers,
-                           min_distances,
-                           pool_features,
-                           sel_features,
-                           already_selected,
-                           metric='l2',
-                           only_new=True,
-                           reset_dist=False,
-                           initialize = False):
+def __sq_norms(X,block_size):
     """
-    Update min distances given cluster centers.
+    Squared L2 norms of the rows of X, computed in blocks of rows (float32).
+    """
+    norms = np.empty(X.shape[0],dtype=np.float32)
+    for i in range(0,X.shape[0],block_size):
+      xb = np.asarray(X[i:i+block_size],dtype=np.float32)
+      norms[i:i+block_size] = np.einsum('ij,ij->i',xb,xb)
+    return norms
 
-    Args:
-      cluster_centers: indices of new cluster centers 
-      only_new: only calculate distance for newly selected points and update
-        min_distances.
-      rest_dist: whether to reset min_distances.
+def __init_min_distances(pool_features,pool_sq,sel_features,block_size):
+    """
+    Minimum squared distance of every pool item to the rows of sel_features.
+
+    Distances are obtained as ||x||^2 - 2x.c + ||c||^2, one (pool block x selected block)
+    product at a time, so only a block_size x block_size matrix is alive at any moment.
+    Memory use does not depend on the number of selected (training) items.
+    """
+    min_distances = np.full(pool_features.shape[0],np.inf,dtype=np.float32)
+    for j in range(0,sel_features.shape[0],block_size):
+      cb = np.asarray(sel_features[j:j+block_size],dtype=np.float32)
+      cb_sq = np.einsum('ij,ij->i',cb,cb)
+      for i in range(0,pool_features.shape[0],block_size):
+        xb = pool_features[i:i+block_size]
+        dist = np.dot(xb,cb.T)
+        dist *= -2.0
+        dist += pool_sq[i:i+block_size,None]
+        dist += cb_sq[None,:]
+        np.minimum(min_distances[i:i+block_size],dist.min(axis=1),out=min_distances[i:i+block_size])
+    np.maximum(min_distances,0.0,out=min_distances)
+    return min_distances
+
+def __update_distances(min_distances,pool_features,pool_sq,c,c_sq):
     """
+    Update min (squared) distances given a newly selected cluster center.
 
-    if reset_dist:
-      min_distances = None
-    if only_new:
-      cluster_centers = [d for d in cluster_centers
-                         if d not in already_selected]
-    if len(cluster_centers) > 0 or initialize:
-      # Update min_distances for all examples given new cluster center.
-      if only_new:
-        x = pool_features[cluster_centers]
-      else:
-        x = sel_features
-      dist = pairwise_distances(pool_features, x, metric=metric)
-
-      if min_distances is None:
-        min_distances = np.min(dist, axis=1).reshape(-1,1)
-      else:
-        min_distances = np.minimum(min_distances, dist)
+    Args:
+      min_distances: float32 vector, updated in place
+      c: new cluster center features (c_sq is its squared norm)
+    """
+    dist = np.dot(pool_features,c)
+    dist *= -2.0
+    dist += pool_sq
+    dist += c_sq
+    #Clipped before the minimum, so selected items (marked with -1) stay marked
+    np.maximum(dist,0.0,out=dist)
+    np.minimum(min_distances,dist,out=min_distances)
 
     return min_distances
 
+def __shard_run(executor,shards,fn):
+    """
+    Runs fn(start,end) for every pool shard, in the thread pool if there is one.
+    Numpy releases the GIL inside dot products, so threads run truly in parallel.
+    """
+    if executor is None:
+        return [fn(s,e) for s,e in shards]
+    return list(executor.map(lambda se: fn(*se),shards))
+
 def cs_select_batch(train_features, pool_features, N, **kwargs):
     """
     Diversity promoting active learning method that greedily forms a batch
     to minimize the maximum distance to a cluster center among all unlabeled
     datapoints.
+
+    The pool is split in contiguous shards, one per worker. Each worker keeps the
+    min-distances of its shard up to date and returns its local argmax; the global
+    argmax is reduced from those.
     
     Args:
       train_features: features of data already selected
       pool_features: features of data not selected
       N: batch size
 
+    Optional keyword arguments:
+      block_size: rows processed at a time when computing distances to train features (Default: 4096)
+      workers: number of threads used for distance updates (Default: 1)
+
     Returns:
       indices of points selected to minimize distance to cluster centers
     """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    block_size = kwargs.get('block_size',4096)
+    workers = max(1,kwargs.get('workers',1))
+
+    pool_features = np.ascontiguousarray(pool_features,dtype=np.float32)
+    n_pool = pool_features.shape[0]
+    
+    if not train_features is None and len(train_features.shape) != 2:
+        print("[core-set] Train features should be a 2D array")
+        return None
+
+    #Shards should not be too small, thread synchronization would dominate
+    workers = min(workers,max(1,n_pool//block_size))
+    step = int(np.ceil(n_pool/workers))
+    shards = [(s,min(s+step,n_pool)) for s in range(0,n_pool,step)]
+    executor = ThreadPoolExecutor(max_workers=len(shards)) if len(shards) > 1 else None
+
+    pool_sq = np.empty(n_pool,dtype=np.float32)
+    min_distances = np.full(n_pool,np.inf,dtype=np.float32)
+    def init_shard(s,e):
+        pool_sq[s:e] = __sq_norms(pool_features[s:e],block_size)
+        if not train_features is None:
+            min_distances[s:e] = __init_min_distances(pool_features[s:e],pool_sq[s:e],train_features,block_size)
+        return None
+    __shard_run(executor,shards,init_shard)
+
+    def update_shard(s,e,ind,c,c_sq):
+        __update_distances(min_distances[s:e],pool_features[s:e],pool_sq[s:e],c,c_sq)
+        # Selected points are marked so they can't be picked again, even if the pool
+        # holds duplicates (zero distance to every center)
+        if s <= ind < e:
+            min_distances[ind] = -1.0
+        local = np.argmax(min_distances[s:e])
+        return (min_distances[s+local],s+local)
+    
+    new_batch = []
+    if train_features is None:
+        # Initialize centers with a randomly selected datapoint
+        ind = np.random.choice(np.arange(n_pool))
+    else:
+        ind = np.argmax(min_distances)
         
-    min_distances = None
+    for _ in range(min(N,n_pool)):
+        new_batch.append(ind)
+        c = pool_features[ind]
+        c_sq = pool_sq[ind]
+        local_max = __shard_run(executor,shards,lambda s,e: update_shard(s,e,ind,c,c_sq))
+        ind = max(local_max,key=lambda t: t[0])[1]
+
+    if not executor is None:
+        executor.shutdown()
+
+    print('Maximum distance from cluster centers is %0.4f'
+              % np.sqrt(max(min_distances.max(),0.0)))
+
+    return np.asarray(new_batch)
+
+
+def __nearest_centers(P,P_sq,C,block_size):
+    """
+    Index of the nearest row of C for every row of P, computed in blocks.
+    """
+    C_sq = np.einsum('ij,ij->i',C,C)
+    assign = np.empty(P.shape[0],dtype=np.int32)
+    for i in range(0,P.shape[0],block_size):
+      dist = np.dot(P[i:i+block_size],C.T)
+      dist *= -2.0
+      dist += C_sq[None,:]
+      assign[i:i+block_size] = np.argmin(dist,axis=1)
+    return assign
+
+def cs_approx_select_batch(train_features, pool_features, N, **kwargs):
+    """
+    Approximate k-Center-Greedy, for pools that are too big for the exact version.
+
+    Pool features are reduced by a Gaussian random projection and grouped in coarse cells
+    (random pivots plus one centroid update). Each cell keeps its centroid, its radius and the
+    largest min-distance among its members. After a center is picked, only cells that the
+    triangle inequality can't rule out are updated, so most of the pool is skipped as the
+    selection progresses. With dim=0 distances are exact and the selection matches cs_select_batch.
 
-    cluster_centers = kwargs.get('cluster_centers',[])
+    Args:
+      train_features: features of data already selected
+      pool_features: features of data not selected
+      N: batch size
+
+    Optional keyword arguments:
+      dim: random projection dimension, 0 keeps the original features (Default: 32)
+      cells: number of coarse cells, 0 means sqrt(pool size) (Default: 0)
+      audit: pool sample size used to report the exact covering radius (Default: 2000)
+      block_size: rows processed at a time in distance computations (Default: 4096)
+      workers: number of threads used to compute distances to train features (Default: 1)
+
+    Returns:
+      indices of points selected to minimize distance to cluster centers
+    """
+    from concurrent.futures import ThreadPoolExecutor
     
-    if not train_features is None:
-        if len(train_features.shape) != 2:
-            print("[core-set] Train features should be a 2D array")
-            return None
-        min_distances = __update_distances(cluster_centers,
-                                               min_distances=min_distances,
-                                               pool_features = pool_features,
-                                               sel_features = train_features,
-                                               already_selected = [],
-                                               only_new=False,
-                                               reset_dist=True,
-                                               initialize=True)
+    dim = kwargs.get('dim',32)
+    workers = max(1,kwargs.get('workers',1))
+    cells = kwargs.get('cells',0)
+    audit = kwargs.get('audit',2000)
+    block_size = kwargs.get('block_size',4096)
+
+    if not train_features is None and len(train_features.shape) != 2:
+        print("[core-set] Train features should be a 2D array")
+        return None
 
+    n_pool = pool_features.shape[0]
+    N = min(N,n_pool)
 
+    #Random projection to a compact representation
+    if dim > 0 and dim < pool_features.shape[1]:
+        R = np.random.normal(0.0,1.0/np.sqrt(dim),size=(pool_features.shape[1],dim)).astype(np.float32)
+        project = lambda X: np.vstack([np.dot(np.asarray(X[i:i+block_size],dtype=np.float32),R)
+                                        for i in range(0,X.shape[0],block_size)])
+    else:
+        project = lambda X: np.ascontiguousarray(X,dtype=np.float32)
+    P = project(pool_features)
+    P_sq = __sq_norms(P,block_size)
+
+    #Coarse partitioning: random pivots, followed by a centroid update
+    if cells <= 0:
+        cells = int(np.ceil(np.sqrt(n_pool)))
+    cells = max(1,min(cells,n_pool))
+    C = P[np.random.choice(n_pool,cells,replace=False)]
+    assign = __nearest_centers(P,P_sq,C,block_size)
+    counts = np.bincount(assign,minlength=cells)
+    C = np.zeros_like(C)
+    np.add.at(C,assign,P)
+    C = C[counts > 0] / counts[counts > 0,None].astype(np.float32)
+    assign = __nearest_centers(P,P_sq,C,block_size)
+
+    #Members of a cell are made contiguous
+    order = np.argsort(assign,kind='stable')
+    P = P[order]
+    P_sq = P_sq[order]
+    assign = assign[order]
+    bounds = np.searchsorted(assign,np.arange(C.shape[0]+1))
+    C_sq = np.einsum('ij,ij->i',C,C)
+    radius = np.zeros(C.shape[0],dtype=np.float32)
+    for i in range(0,n_pool,block_size):
+      diff = P[i:i+block_size] - C[assign[i:i+block_size]]
+      np.maximum.at(radius,assign[i:i+block_size],np.sqrt(np.einsum('ij,ij->i',diff,diff)))
+
+    #Min distances (not squared, triangle inequality is needed)
+    if train_features is None:
+        min_distances = np.full(n_pool,np.inf,dtype=np.float32)
+    else:
+        T = project(train_features)
+        step = int(np.ceil(n_pool/workers))
+        shards = [(s,min(s+step,n_pool)) for s in range(0,n_pool,step)]
+        executor = ThreadPoolExecutor(max_workers=len(shards)) if len(shards) > 1 else None
+        min_distances = np.concatenate(__shard_run(executor,shards,
+                                                       lambda s,e: __init_min_distances(P[s:e],P_sq[s:e],T,block_size)))
+        np.sqrt(min_distances,out=min_distances)
+        if not executor is None:
+            executor.shutdown()
+
+    def cell_update(j,c,c_sq):
+        s,e = bounds[j],bounds[j+1]
+        dist = np.dot(P[s:e],c)
+        dist *= -2.0
+        dist += P_sq[s:e]
+        dist += c_sq
+        np.maximum(dist,0.0,out=dist)
+        np.minimum(min_distances[s:e],np.sqrt(dist),out=min_distances[s:e])
+
+    cell_max = np.asarray([min_distances[bounds[j]:bounds[j+1]].max() for j in range(C.shape[0])],dtype=np.float32)
     new_batch = []
-
-    for _ in range(N):
-        if train_features is None:
-            # Initialize centers with a randomly selected datapoint
-            ind = np.random.choice(np.arange(pool_features.shape[0]))
+    updated = 0
+    for k in range(N):
+        if k == 0 and train_features is None:
+            ind = np.random.choice(n_pool)
         else:
-            ind = np.argmax(min_distances)
-        # New examples should not be already selected since those points
-        # should have min_distance of zero to a cluster center.
-        if ind in new_batch:
-            continue
-
-        min_distances = __update_distances([ind],
-                                               min_distances=min_distances,
-                                               pool_features = pool_features,
-                                               sel_features = train_features,
-                                               already_selected = new_batch,
-                                               only_new=True,
-                                               reset_dist=False)
+            j = np.argmax(cell_max)
+            ind = bounds[j] + np.argmax(min_distances[bounds[j]:bounds[j+1]])
+
+        c = P[ind]
+        c_sq = P_sq[ind]
+        dc = C_sq - 2.0*np.dot(C,c) + c_sq
+        np.maximum(dc,0.0,out=dc)
+        active = np.nonzero(np.sqrt(dc) - radius < cell_max)[0]
+        updated += int(np.sum(bounds[active+1]-bounds[active]))
+        for j in active:
+            cell_update(j,c,c_sq)
+        min_distances[ind] = -1.0
+        cell_j = assign[ind]
+        for j in set(active.tolist()) | {cell_j}:
+            cell_max[j] = min_distances[bounds[j]:bounds[j+1]].max()
         new_batch.append(ind)
-    print('Maximum distance from cluster centers is %0.4f'
-              % max(min_distances))
 
-    return np.asarray(new_batch)
+    new_batch = order[np.asarray(new_batch,dtype=np.int64)]
+    approx_r = float(max(cell_max.max(),0.0))
+    print('Maximum distance from cluster centers (approximate) is %0.4f' % approx_r)
+    print('[core-set] Distance evaluations: {} ({:.2f}% of exact greedy), {} cells'.format(updated,100*updated/(n_pool*max(N,1)),C.shape[0]))
+
+    #Covering radius audit, exact distances in the original feature space
+    if audit > 0 and N > 0:
+        sample = np.random.choice(n_pool,min(audit,n_pool),replace=False)
+        sample = sample[~np.isin(sample,new_batch)]
+        if sample.shape[0] > 0:
+            centers = pool_features[new_batch]
+            if not train_features is None:
+                centers = np.concatenate((train_features,centers),axis=0)
+            S = np.ascontiguousarray(pool_features[sample],dtype=np.float32)
+            exact_r = np.sqrt(__init_min_distances(S,__sq_norms(S,block_size),centers,block_size).max())
+            inv = np.empty(n_pool,dtype=np.int64)
+            inv[order] = np.arange(n_pool)
+            est_r = min_distances[inv[sample]].max()
+            print('[core-set] Covering radius on a {} items sample: approximate {:.4f}; exact {:.4f} (ratio {:.3f})'.format(sample.shape[0],
+                      est_r,exact_r,est_r/exact_r if exact_r > 0 else 1.0))
+
+    return new_batch
 
 
 def core_set(bayesian_model,generator,data_size,**kwargs):
@@ -155,12 +354,11 @@ def core_set(bayesian_model,generator,data_size,**kwargs):
     train_gen <Iterator>: batch data generator
     sw_threads <thread Object>: if a thread object is passed, you must wait its conclusion before loading weights
     """
-    from sklearn.decomposition import PCA
     import importlib
     import copy
     import time
     from datetime import timedelta
-    from Utils import CacheManager
+    from Utils import CacheManager,WeightsRegistry
 
     cache_m = CacheManager()
     
@@ -192,8 +390,11 @@ def core_set(bayesian_model,generator,data_size,**kwargs):
         print("[core_set] Training data is needed by core_set. Set train_gen kw argument")
         return None
     
-    #Models that take to long to save weights might not have finished
-    if 'sw_thread' in kwargs:
+    #Models that take to long to save weights might not have finished (unless weights are in memory)
+    in_memory = not WeightsRegistry().get(model.get_weights_cache()) is None
+    if in_memory:
+        pass
+    elif 'sw_thread' in kwargs:
         last_thread = None
         if isinstance(kwargs['sw_thread'],list):
             last_thread = kwargs['sw_thread'][-1]
@@ -206,7 +407,7 @@ def core_set(bayesian_model,generator,data_size,**kwargs):
     elif config.info:
         print("[core_set] Weights thread not available...trying to load weights")
 
-    if not model.is_ensemble() and not (os.path.isfile(model.get_weights_cache()) or not os.path.isfile(model.get_mgpu_weights_cache())):
+    if not model.is_ensemble() and not in_memory and not (os.path.isfile(model.get_weights_cache()) or not os.path.isfile(model.get_mgpu_weights_cache())):
         if config.info:
             print("[core_set] No trained model or weights file found (H5).")
         return None    
@@ -220,7 +421,7 @@ def core_set(bayesian_model,generator,data_size,**kwargs):
         return None
 
     if not model.is_ensemble():
-        pred_model = load_model_weights(config,model,single_m,parallel_m)
+        pred_model = load_model_weights(config,model,(single_m,parallel_m))
     else:
         generator.set_input_n(config.emodels)
         train_gen.set_input_n(config.emodels)
@@ -232,12 +433,21 @@ def core_set(bayesian_model,generator,data_size,**kwargs):
     #Extract features for all images in the pool
     if config.info:
         print("Starting feature extraction ({} batches)...".format(len(generator)))
-    pool_features = pred_model.predict_generator(generator,
+    if config.pca > 0 or not config.fstore is None:
+        #Pool and training features are projected to the same space, batch by batch
+        projector = get_projector(config,model)
+        store = open_feature_store(config,model)
+        pred_function = lambda inp: [pred_model.predict_on_batch(inp)]
+        pool_features = extract_features_cached(pred_function,generator,store,projector)
+        train_features = extract_features_cached(pred_function,train_gen,store,projector)
+        save_projector(config,model,projector)
+    else:
+        pool_features = pred_model.predict_generator(generator,
                                             workers=4*cpu_count,
                                             max_queue_size=100*gpu_count,
                                             verbose=0)
 
-    train_features = pred_model.predict_generator(train_gen,
+        train_features = pred_model.predict_generator(train_gen,
                                             workers=4*cpu_count,
                                             max_queue_size=100*gpu_count,
                                             verbose=0)
@@ -251,25 +461,23 @@ def core_set(bayesian_model,generator,data_size,**kwargs):
     pool_features = pool_features.reshape(pool_features.shape[0],np.prod(pool_features.shape[1:]))
     train_features = train_features.reshape(train_features.shape[0],np.prod(train_features.shape[1:]))
     
+    report_output(kwargs,'features',pool_features)
+    report_output(kwargs,'train_features',train_features)
+    
     if config.info:
         print("Pool feature vector shape: {}".format(pool_features.shape))
         print("Train data feature vector shape: {}".format(train_features.shape))
         
-    if config.pca > 0:
-        if config.info:
-            print("Starting PCA decomposition ({} features)...".format(config.pca))
-
-        pca = PCA(n_components = config.pca)
-        pool_features = pca.fit_transform(pool_features)
-        train_features = pca.fit_transform(train_features)
-
     stime = None
     etime = None
     if config.verbose > 0:
         print("Done extraction...starting CoreSet")
         stime = time.time()
 
-    acquired = cs_select_batch(train_features, pool_features, query)
+    if config.cs_approx:
+        acquired = cs_approx_select_batch(train_features, pool_features, query,dim=config.cs_dim,cells=config.cs_cells,workers=cpu_count)
+    else:
+        acquired = cs_select_batch(train_features, pool_features, query,workers=cpu_count)
 
     print("Acquired ({}): {}".format(acquired.shape,acquired))
 
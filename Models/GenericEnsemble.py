@@ -24,7 +24,7 @@ from keras import backend as K
 from keras.models import Model
 
 #Locals
-from Utils import CacheManager
+from Utils import CacheManager,WeightsRegistry,load_flat
 from Models.GenericModel import GenericModel
 from AL.Common import load_model_weights
 
@@ -100,6 +100,38 @@ class GenericEnsemble(GenericModel):
         preload_w: return model with weights already loaded? True -> Yes
         parallel: return parallel model (overrides gpu_count avaliation)? True -> Yes
         """
+        graph = self._extractor_graph(**kwargs)
+        if graph is None:
+            return None
+        
+        model,x = graph
+        return K.function(model.inputs, [x])
+
+    def build_scoring_function(self,**kwargs):
+        """
+        Builds a function that runs a single forward pass and returns each ensemble member's softmax output
+        followed by the feature layer activations: [p_0,...,p_(M-1),features].
+
+        Returns: Keras backend function
+
+        Key word arguments: same as build_extractor, model should be a dict of trained models
+        """
+        if not isinstance(kwargs.get('model',None),dict):
+            print("[GenericEnsemble] Scoring function needs a dict of trained models as the model argument")
+            return None
+
+        graph = self._extractor_graph(**kwargs)
+        if graph is None:
+            return None
+
+        model,x = graph
+        outputs = [self.tmodels[e].outputs[0] for e in sorted(self.tmodels.keys())]
+        return K.function(model.inputs, outputs + [x])
+    
+    def _extractor_graph(self,**kwargs):
+        """
+        Returns the (model,feature tensor) pair used to build extraction functions.
+        """
         #Weight loading for the feature extraction is done latter by requesting party
         model = None
         parallel = kwargs.get('parallel',False)
@@ -120,7 +152,6 @@ class GenericEnsemble(GenericModel):
             else:
                 model = s_model
 
-        f = None
         if self.is_ensemble():
             if parallel:
                  p_features = [model.get_layer('EM{}-{}'.format(e,self.name)) for e in range(self._config.emodels)]
@@ -128,12 +159,10 @@ class GenericEnsemble(GenericModel):
             else:
                  layers = [model.get_layer('EM{}-{}'.format(e,'feature')).output for e in range(self._config.emodels)]
             x = Concatenate()(layers)
-            f = K.function(model.inputs, [x])
         else:
-            layer = model.get_layer('feature')
-            f = K.function(model.inputs, [layer.output])
+            x = model.get_layer('feature').output
 
-        return f
+        return (model,x)
         
     def build_ensemble(self,**kwargs):
         """
@@ -264,6 +293,21 @@ class GenericEnsemble(GenericModel):
 
     def _load_weights(self,single,parallel,npfile,m='',sw_thread=None):
 
+        #Weights of members trained in this process are kept in memory
+        registry = WeightsRegistry()
+        if not parallel is None:
+            weights = registry.get(self.get_mgpu_weights_cache())
+            if not weights is None:
+                for layer in parallel.layers:
+                    layer.name = 'EM{}-{}'.format(m,layer.name)
+                parallel.set_weights(weights)
+                return single,parallel
+        else:
+            weights = registry.get(self.get_weights_cache())
+            if not weights is None:
+                single.set_weights(weights)
+                return single,parallel
+            
         if not sw_thread is None:
             last_thread = None
             if isinstance(sw_thread,list):
@@ -275,6 +319,17 @@ class GenericEnsemble(GenericModel):
                     print("[GenericEnsemble] Waiting for model weights to become available...")
                 last_thread.join()
             
+        #Flat weight files are memory mapped and applied directly
+        if getattr(self._config,'wflat',False):
+            if not parallel is None and not self.get_flatmgpu_weights_cache() is None and os.path.isfile(self.get_flatmgpu_weights_cache()):
+                for layer in parallel.layers:
+                    layer.name = 'EM{}-{}'.format(m,layer.name)
+                parallel.set_weights(load_flat(self.get_flatmgpu_weights_cache()))
+                return single,parallel
+            elif parallel is None and os.path.isfile(self.get_flatweights_cache()):
+                single.set_weights(load_flat(self.get_flatweights_cache()))
+                return single,parallel
+            
         if not parallel is None:
             #Updates all layer names to avoid repeated name error
             for layer in parallel.layers:
@@ -3,6 +3,7 @@
 
 from abc import ABC,abstractmethod
 import math
+import os
 import numpy as np
 
 class GenericModel(ABC):
@@ -61,6 +62,20 @@ class GenericModel(ABC):
     def get_mgpu_weights_cache(self):
         pass
     
+    def get_flatweights_cache(self):
+        """
+        Returns path to flat weights file (Utils.FlatWeights format), next to the weights cache.
+        """
+        path = self.get_weights_cache()
+        return None if path is None else "{}.fw".format(os.path.splitext(path)[0])
+
+    def get_flatmgpu_weights_cache(self):
+        """
+        Returns path to flat multi-GPU weights file (Utils.FlatWeights format).
+        """
+        path = self.get_mgpu_weights_cache()
+        return None if path is None else "{}.fw".format(os.path.splitext(path)[0])
+    
     @abstractmethod
     def _build(self,**kwargs):
         pass
@@ -116,7 +131,20 @@ class GenericModel(ABC):
         self._phi = phi
 
     def setName(self,name):
+        """
+        Cache files are named after the network, so they are registered again under the new name. Renamed
+        copies of a network (proxy, student, test network) do not overwrite the original's weights.
+        """
         self.name = name
+        if not hasattr(self,'cache_m'):
+            return
+        self._modelCache = "{0}-model.h5".format(self.name)
+        self._weightsCache = "{0}-weights.h5".format(self.name)
+        self.cache_m.registerFile(os.path.join(self._config.model_path,self._modelCache),self._modelCache)
+        self.cache_m.registerFile(os.path.join(self._config.weights_path,self._weightsCache),self._weightsCache)
+        if hasattr(self,'_mgpu_weightsCache'):
+            self._mgpu_weightsCache = "{0}-mgpu-weights.h5".format(self.name)
+            self.cache_m.registerFile(os.path.join(self._config.weights_path,self._mgpu_weightsCache),self._mgpu_weightsCache)
 
     def getName(self):
         return self.name
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import numpy as np
+
+from .GenericModel import GenericModel
+from Utils import CacheManager
+
+__doc__ = """
+Structured channel pruning (see -prune).
+
+Whole filters are removed from Conv2D layers whose outputs only reach (through channel-wise layers:
+activations, batch normalization, pooling, dropout, padding) other Conv2D layers or Dense layers (after
+Flatten/global pooling). Filters are ranked by kernel L1 norm ('l1') or by mean absolute activation over a
+calibration batch ('act'); each prunable layer keeps its top (1-ratio) filters. Convolutions that feed
+merges (Add, Concatenate), nested models or the model output are kept whole.
+
+A pruning plan maps Conv2D positions (order in model.layers) to kept filter indexes, so it applies to any
+build of the same architecture (e.g. the MC dropout model built by acquisition functions). PrunedModel is a
+GenericModel that builds the base architecture and applies the plan.
+"""
+
+CHANNELWISE = ('Activation','BatchNormalization','MaxPooling2D','AveragePooling2D','Dropout','SpatialDropout2D',
+                   'ZeroPadding2D','LeakyReLU','ReLU','GaussianNoise','GaussianDropout')
+
+def _cls(layer):
+    return layer.__class__.__name__
+
+def _convs(model):
+    return [l for l in model.layers if _cls(l) == 'Conv2D']
+
+def _consumers(model):
+    """
+    Maps tensor names to the model nodes that consume them.
+    """
+    consumers = {}
+    for depth in model._nodes_by_depth:
+        for node in model._nodes_by_depth[depth]:
+            for t in node.input_tensors:
+                consumers.setdefault(t.name,[]).append(node)
+    return consumers
+
+def _reaches_safely(t,consumers,outputs,flat=False):
+    """
+    True if all paths from tensor t end in layers whose inputs can be sliced along the channel axis.
+    """
+    cons = consumers.get(t.name,[])
+    if t.name in outputs or len(cons) == 0:
+        return False
+    for node in cons:
+        layer = node.outbound_layer
+        cls = _cls(layer)
+        if len(node.input_tensors) != 1 or len(layer._inbound_nodes) != 1:
+            return False
+        if cls == 'Dense' or (cls == 'Conv2D' and not flat):
+            continue
+        elif cls == 'BatchNormalization' and not layer.axis in (-1,len(layer.input_shape)-1):
+            return False
+        elif cls in CHANNELWISE:
+            if not _reaches_safely(node.output_tensors[0],consumers,outputs,flat):
+                return False
+        elif cls in ('Flatten','GlobalAveragePooling2D','GlobalMaxPooling2D') and not flat:
+            if not _reaches_safely(node.output_tensors[0],consumers,outputs,True):
+                return False
+        else:
+            return False
+    return True
+
+def prunable(model):
+    """
+    Returns the positions (in the list of Conv2D layers) of convolutions that can be pruned.
+    """
+    consumers = _consumers(model)
+    outputs = set([t.name for t in model.outputs])
+    pos = []
+    for k,l in enumerate(_convs(model)):
+        if len(l._inbound_nodes) == 1 and l.data_format == 'channels_last' and _reaches_safely(l.output,consumers,outputs):
+            pos.append(k)
+    return pos
+
+def channel_plan(model,ratio,criterion='l1',calibration=None):
+    """
+    Ranks filters of every prunable convolution. Returns the plan: {conv position: kept filter indexes (sorted)}.
+
+    @param ratio <float>: fraction of filters removed from each layer
+    @param criterion <str>: 'l1' (kernel magnitude) or 'act' (mean absolute activation over calibration)
+    @param calibration <np.array>: input batch, needed by 'act'
+    """
+    from keras.models import Model
+
+    convs = _convs(model)
+    pos = prunable(model)
+    if len(pos) == 0:
+        return {}
+
+    if criterion == 'act' and not calibration is None:
+        probe = Model(inputs=model.inputs,outputs=[convs[k].output for k in pos])
+        acts = probe.predict_on_batch(calibration)
+        acts = acts if isinstance(acts,list) else [acts]
+        ranks = [np.mean(np.abs(a),axis=(0,1,2)) for a in acts]
+    else:
+        ranks = [np.sum(np.abs(convs[k].get_weights()[0]),axis=(0,1,2)) for k in pos]
+
+    plan = {}
+    for k,r in zip(pos,ranks):
+        keep = max(1,int(round(r.shape[0]*(1.0-ratio))))
+        plan[k] = np.sort(np.argsort(r)[-keep:])
+    return plan
+
+def _slice_weights(layer,weights,in_idx,out_idx):
+    cls = _cls(layer)
+    if cls == 'Conv2D':
+        kernel = weights[0]
+        if not in_idx is None:
+            kernel = kernel[:,:,in_idx,:]
+        if not out_idx is None:
+            kernel = kernel[...,out_idx]
+        bias = weights[1:] if out_idx is None else [b[out_idx] for b in weights[1:]]
+        return [kernel] + bias
+    elif cls == 'Dense':
+        return [weights[0][in_idx]] + weights[1:]
+    elif cls == 'BatchNormalization':
+        return [w[in_idx] for w in weights]
+    return weights
+
+def apply_plan(model,plan):
+    """
+    Returns a new (uncompiled) keras.Model with the filters removed. Layers that are not changed are shared
+    with model.
+    """
+    from keras import backend as K
+    from keras.models import Model
+    from keras.layers import Input,InputLayer
+
+    convs = _convs(model)
+    planned = {id(convs[k]):idx for k,idx in plan.items()}
+
+    new_inputs = [Input(batch_shape=K.int_shape(x)) for x in model.inputs]
+    tensor_map = dict(zip(model.inputs,new_inputs))
+    #Kept channel indexes of each tensor (None: all)
+    kept = {}
+    for depth in sorted(model._nodes_by_depth.keys(),reverse=True):
+        for node in model._nodes_by_depth[depth]:
+            layer = node.outbound_layer
+            if isinstance(layer,InputLayer):
+                continue
+            computed = [tensor_map[x] for x in node.input_tensors if x in tensor_map]
+            if len(computed) != len(node.input_tensors):
+                continue
+            kwargs = dict(node.arguments) if node.arguments else {}
+            in_idx = kept.get(node.input_tensors[0].name,None) if len(node.input_tensors) == 1 else None
+            out_idx = planned.get(id(layer),None)
+            cls = _cls(layer)
+
+            if in_idx is None and out_idx is None:
+                new_layer = layer
+            else:
+                config = layer.get_config()
+                if not out_idx is None:
+                    config['filters'] = out_idx.shape[0]
+                new_layer = layer.__class__.from_config(config)
+
+            out = new_layer(computed[0] if len(computed) == 1 else computed,**kwargs)
+            out = out if isinstance(out,list) else [out]
+            if not new_layer is layer:
+                new_layer.set_weights(_slice_weights(layer,layer.get_weights(),in_idx,out_idx))
+
+            #Channel indexes carried to the outputs
+            if not out_idx is None:
+                carried = out_idx
+            elif in_idx is None or cls in ('Conv2D','Dense'):
+                carried = None
+            elif cls == 'Flatten':
+                shape = K.int_shape(node.input_tensors[0])
+                carried = (np.arange(int(np.prod(shape[1:-1])))[:,None]*shape[-1] + in_idx[None,:]).flatten()
+            else:
+                carried = in_idx
+            for x,y in zip(node.output_tensors,out):
+                tensor_map[x] = y
+                if not carried is None:
+                    kept[x.name] = carried
+
+    return Model(inputs=new_inputs,outputs=[tensor_map[x] for x in model.outputs],name=model.name)
+
+def conv_flops(model):
+    """
+    Multiply-accumulate operations of all Conv2D layers for one input.
+    """
+    total = 0
+    for l in _convs(model):
+        kh,kw,cin,cout = l.get_weights()[0].shape
+        _,h,w,_ = l.output_shape
+        total += h*w*kh*kw*cin*cout
+    return total
+
+class PrunedModel(GenericModel):
+    """
+    Builds the base model's architecture with a pruning plan applied. Weights are kept in
+    <weights_path>/<base name>-Pruned-weights.h5.
+    """
+    def __init__(self,base,plan):
+        super().__init__(base._config,base.get_ds(),"{}-Pruned".format(base.name))
+        self.base = base
+        self.plan = plan
+        self._phi = base._phi
+        self._modelCache = "{0}-model.h5".format(self.name)
+        self._weightsCache = "{0}-weights.h5".format(self.name)
+
+        self.cache_m = CacheManager()
+        self.cache_m.registerFile(os.path.join(self._config.model_path,self._modelCache),self._modelCache)
+        self.cache_m.registerFile(os.path.join(self._config.weights_path,self._weightsCache),self._weightsCache)
+
+    def rescaleEnabled(self):
+        return self.base.rescaleEnabled()
+
+    def check_input_shape(self):
+        return self.base.check_input_shape()
+
+    def get_model_cache(self):
+        return self.cache_m.fileLocation(self._modelCache)
+
+    def get_weights_cache(self):
+        return self.cache_m.fileLocation(self._weightsCache)
+
+    def get_mgpu_weights_cache(self):
+        return None
+
+    def _build(self,width,height,channels,**kwargs):
+        """
+        Multi-GPU models are not pruned (pruned weights are single tower).
+        """
+        kwargs['keep_model'] = False
+        kwargs['allocated_gpus'] = 1
+        single,_ = self.base.build(**kwargs)
+        return (apply_plan(single,self.plan),None)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+from skimage.color import rgb2gray
+from skimage.transform import resize
+
+from Utils import multiprocess_run,CacheManager,sample_key
+
+__doc__ = """
+Near-duplicate detection of image tiles through perceptual hashing.
+
+Each tile is reduced to a 64 bit difference hash (dHash): grayscale image is resized to 8x9 and each bit
+tells if a pixel is brighter than its right neighbour. Near-duplicates (overlapping tiles, repeated scans)
+have hashes within a small Hamming distance.
+
+Groups are formed with a multi-index Hamming search: hashes are split into threshold+1 chunks, so
+any pair within the threshold distance is equal in at least one chunk (pigeonhole principle). Only pairs
+sharing a chunk are compared, pairs within threshold are joined by union-find.
+"""
+
+HASH_SIZE = 8
+
+def dhash(data,hash_size=HASH_SIZE):
+    """
+    Returns the difference hash of an image as an uint64.
+
+    @param data <np.array>: image (H,W,C) or (H,W)
+    """
+    data = np.asarray(data,dtype=np.float32)
+    if data.ndim == 3 and data.shape[-1] >= 3:
+        data = rgb2gray(data[:,:,:3])
+    elif data.ndim == 3:
+        data = data[:,:,0]
+    small = resize(data,(hash_size,hash_size+1),anti_aliasing=True,mode='reflect')
+    bits = (small[:,1:] > small[:,:-1]).flatten()
+    return np.uint64(np.packbits(bits).view('>u8')[0])
+
+def _hash_items(data,hash_size):
+    """
+    Worker function for multiprocess_run
+    """
+    hashes = []
+    for item in data:
+        #readImage arguments differ between SegImage subclasses, dhash converts to float
+        hashes.append(dhash(item.readImage(),hash_size))
+    return (hashes,)
+
+def hash_items(items,cpu_count=1,pbar=False,verbose=0,cache=True):
+    """
+    Computes (in parallel) perceptual hashes of all items. Hashes are cached by sample ID, only new
+    items are read.
+
+    @param items <np.array>: PImage objects
+    @param cache <boolean>: keep hashes in cache file (phash-cache.pik)
+    Returns: np.array of uint64
+    """
+    cache_m = CacheManager()
+    fid = 'phash-cache.pik'
+    known = {}
+    if cache and cache_m.checkFileExistence(fid):
+        known = cache_m.load(fid)
+
+    keys = [sample_key(it) for it in items]
+    missing = [i for i in range(len(keys)) if not keys[i] in known]
+    if len(missing) > 0:
+        if verbose > 0:
+            print("[PerceptualHash] Hashing {} tiles ({} from cache)".format(len(missing),len(keys)-len(missing)))
+        step = max(1,min(500,int(np.ceil(len(missing)/cpu_count))))
+        hashes = multiprocess_run(_hash_items,(HASH_SIZE,),[items[i] for i in missing],
+                                      cpu_count,pbar,step_size=step,output_dim=1,txt_label='perceptual hashing',verbose=verbose)
+        for i,h in zip(missing,hashes[0]):
+            known[keys[i]] = h
+        if cache:
+            cache_m.dump(known,fid)
+
+    return np.array([known[k] for k in keys],dtype=np.uint64)
+
+def _popcount(x):
+    return np.unpackbits(x.view(np.uint8).reshape(-1,8),axis=1).sum(axis=1)
+
+def _find(parent,i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def near_duplicate_groups(hashes,threshold):
+    """
+    Groups hashes within threshold Hamming distance (transitively).
+
+    @param hashes <np.array>: uint64 hashes
+    @param threshold <int>: maximum Hamming distance (0 groups exact duplicates only)
+    Returns: group label of each hash (group labels are the index of the group's first item)
+    """
+    hashes = np.asarray(hashes,dtype=np.uint64)
+    #Exact duplicates are collapsed first
+    uhashes,inverse = np.unique(hashes,return_inverse=True)
+    n = uhashes.shape[0]
+    parent = np.arange(n)
+
+    if threshold > 0 and n > 1:
+        chunks = min(threshold+1,64)
+        bounds = np.linspace(0,64,chunks+1).astype(np.uint64)
+        for c in range(chunks):
+            width = int(bounds[c+1] - bounds[c])
+            mask = np.uint64((1 << width) - 1)
+            keys = (uhashes >> bounds[c]) & mask
+            order = np.argsort(keys,kind='stable')
+            skeys = keys[order]
+            starts = np.flatnonzero(np.concatenate(([True],skeys[1:] != skeys[:-1])))
+            ends = np.concatenate((starts[1:],[n]))
+            for s,e in zip(starts,ends):
+                if e - s < 2:
+                    continue
+                bucket = order[s:e]
+                for j in range(bucket.shape[0]-1):
+                    a = bucket[j]
+                    others = bucket[j+1:]
+                    close = others[_popcount(uhashes[others] ^ uhashes[a]) <= threshold]
+                    ra = _find(parent,a)
+                    for b in close:
+                        rb = _find(parent,b)
+                        if ra != rb:
+                            parent[rb] = ra
+
+    roots = np.array([_find(parent,i) for i in range(n)])[inverse]
+    #Label groups by their first item
+    _,first,glabels = np.unique(roots,return_index=True,return_inverse=True)
+    return first[glabels]
+
+def deduplicate(items,threshold,cpu_count=1,pbar=False,verbose=0):
+    """
+    Returns (representatives,labels): indexes of one item per near-duplicate group and the group label
+    (representative index) of every item.
+    """
+    hashes = hash_items(items,cpu_count,pbar,verbose)
+    labels = near_duplicate_groups(hashes,threshold)
+    representatives = np.unique(labels)
+    if verbose > 0:
+        print("[PerceptualHash] {} near-duplicate groups in {} tiles (threshold: {})".format(representatives.shape[0],
+                                                                                         len(items),threshold))
+    return representatives,labels
@@ -6,3 +6,4 @@ from .PImage import PImage
 from .NPImage import NPImage
 
 from .Preprocess import background,white_ratio
+from .PerceptualHash import deduplicate,hash_items,near_duplicate_groups
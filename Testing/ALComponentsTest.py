@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+__doc__ = """
+Behaviour tests for AL components that do not need a trained model or a dataset.
+
+Every test_* function raises AssertionError on failure. Run with -t -tmode 5 (or any test runner that
+collects test_* functions).
+"""
+
+def _kcenter_reference(train,pool,N):
+    """
+    Baseline k-center greedy loop: full pairwise distances, one center at a time.
+    """
+    from sklearn.metrics import pairwise_distances
+
+    min_distances = pairwise_distances(pool,train).min(axis=1)
+    selected = []
+    for _ in range(N):
+        ind = int(np.argmax(min_distances))
+        selected.append(ind)
+        min_distances = np.minimum(min_distances,pairwise_distances(pool,pool[ind:ind+1]).ravel())
+    return np.asarray(selected)
+
+def test_coreset_matches_reference():
+    from AL.gCoreSet import cs_select_batch
+
+    rng = np.random.RandomState(7)
+    train = rng.normal(size=(40,12)).astype(np.float32)
+    pool = rng.normal(size=(500,12)).astype(np.float32)
+    expected = _kcenter_reference(train,pool,25)
+    for block_size,workers in ((4096,1),(32,1),(32,4)):
+        sel = cs_select_batch(train,pool,25,block_size=block_size,workers=workers)
+        assert np.array_equal(sel,expected),"core-set (block {},workers {}) differs from reference".format(block_size,workers)
+
+def test_coreset_approx_exact_distances():
+    from AL.gCoreSet import cs_approx_select_batch
+
+    rng = np.random.RandomState(11)
+    train = rng.normal(size=(30,8)).astype(np.float32)
+    pool = rng.normal(size=(400,8)).astype(np.float32)
+    sel = cs_approx_select_batch(train,pool,20,dim=0,audit=0)
+    assert np.array_equal(sel,_kcenter_reference(train,pool,20)),"approximate core-set with dim=0 differs from reference"
+
+def test_coreset_duplicates():
+    from AL.gCoreSet import cs_select_batch,cs_approx_select_batch
+
+    pool = np.repeat(np.eye(3,dtype=np.float32),10,axis=0)
+    for fn in (cs_select_batch,cs_approx_select_batch):
+        sel = fn(None,pool,8)
+        assert np.unique(sel).shape[0] == 8,"{} selected the same item twice".format(fn.__name__)
+
+def _acq_reference(clusters,un_clusters,query):
+    """
+    Baseline km_uncert round robin loop.
+    """
+    un_clusters = {k:list(un_clusters[k]) for k in un_clusters}
+    acquired,j = [],0
+    while len(acquired) < query:
+        q = un_clusters[(len(acquired)+j) % clusters]
+        if len(q) > 0:
+            acquired.append(q.pop(0))
+        else:
+            j += 1
+    return np.asarray(acquired)
+
+def _acq_ng_reference(posa,clusters,un_clusters,query):
+    """
+    Baseline kmng_uncert loop, valid while no cluster is exhausted.
+    """
+    cmean = np.asarray([np.mean(posa[k]) for k in range(clusters)])
+    frac = (np.sum(cmean)/cmean)/np.sum(np.sum(cmean)/cmean)
+    acquired,n = [],0
+    sel = np.zeros(clusters,dtype=np.int32)
+    while len(acquired) < query:
+        cln = n % clusters
+        cl_aq = int(np.ceil(frac[cln]*query))
+        assert len(un_clusters[cln]) >= sel[cln] + cl_aq,"reference loop only covers non exhausted clusters"
+        acquired.extend(un_clusters[cln][sel[cln]:sel[cln]+cl_aq])
+        sel[cln] += cl_aq
+        n += 1
+    return np.asarray(acquired[:query])
+
+def _clustered_pool(rng,size,clusters):
+    un_indexes = rng.permutation(size)
+    labels = rng.randint(0,clusters,size)[un_indexes]
+    rank_order = np.argsort(labels,kind='stable')
+    bounds = np.searchsorted(labels[rank_order],np.arange(clusters+1))
+    un_clusters = {k:un_indexes[rank_order[bounds[k]:bounds[k+1]]] for k in range(clusters)}
+    posa = {k:rank_order[bounds[k]:bounds[k+1]] for k in range(clusters)}
+    return un_clusters,posa
+
+def test_km_selection_matches_reference():
+    from types import SimpleNamespace
+    from AL.KMUncert import _acq_logic,_acq_ng_logic
+
+    config = SimpleNamespace(recluster=0,debug=False)
+    rng = np.random.RandomState(3)
+    un_clusters,posa = _clustered_pool(rng,2000,10)
+    for query in (1,7,50,400):
+        sel = _acq_logic(10,un_clusters,query,config,0,None,None)
+        assert np.array_equal(sel,_acq_reference(10,un_clusters,query)),"km_uncert selection differs (query {})".format(query)
+        if query == 1:
+            #Baseline gives zero sized shares to all clusters but one
+            continue
+        posq = {k:posa[k][:query] for k in posa}
+        sel = _acq_ng_logic(posq,10,un_clusters,query,config,0,None,None)
+        assert np.array_equal(sel,_acq_ng_reference(posq,10,un_clusters,query)),"kmng_uncert selection differs (query {})".format(query)
+
+def test_km_selection_degenerate_clusters():
+    from types import SimpleNamespace
+    from AL.KMUncert import _acq_logic,_acq_ng_logic
+
+    config = SimpleNamespace(recluster=0,debug=False)
+    un_clusters = {0:np.arange(5),1:np.zeros(0,dtype=np.int64),2:np.arange(5,8)}
+    posa = {0:np.arange(5),1:np.zeros(0,dtype=np.int64),2:np.arange(5,8)}
+    for fn,args in ((_acq_logic,(3,un_clusters)),(_acq_ng_logic,(posa,3,un_clusters))):
+        for query in (4,8,20):
+            sel = fn(*(args + (query,config,0,None,None)))
+            assert sel.shape[0] == min(query,8),"{} returned {} items for query {}".format(fn.__name__,sel.shape[0],query)
+            assert np.unique(sel).shape[0] == sel.shape[0],"{} selected duplicates".format(fn.__name__)
+
+def test_sample_key_unique():
+    from Utils import sample_key
+    from Preprocessing.NPImage import NPImage
+
+    data = np.zeros((3,4,4,1),dtype=np.float32)
+    items = [NPImage('mnist.npz',data[i],True,'x_train',i) for i in range(3)]
+    items.append(NPImage('mnist.npz',data[0],True,'x_test',0))
+    keys = [sample_key(x) for x in items]
+    assert len(set(keys)) == len(items),"items from the same file share a sample key: {}".format(keys)
+    assert sample_key(NPImage('mnist.npz',data[1],True,'x_train',1)) == keys[1],"sample key is not stable"
+
+def test_flat_weights_roundtrip():
+    import os
+    import tempfile
+    from Utils import save_flat,load_flat
+
+    weights = [np.array(3.5,dtype=np.float32),
+                   np.array(7,dtype=np.int64),
+                   np.arange(1,dtype=np.float32),
+                   np.zeros((0,4),dtype=np.float32),
+                   np.asfortranarray(np.random.normal(size=(3,5))).astype(np.float16),
+                   np.random.normal(size=(3,3,2,8)).astype(np.float32)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp,'weights.flat')
+        save_flat(path,weights,names=["w{}".format(i) for i in range(len(weights))])
+        loaded,names = load_flat(path,names=True)
+        assert names == ["w{}".format(i) for i in range(len(weights))],"tensor names differ"
+        for w,l in zip(weights,loaded):
+            assert l.shape == w.shape and l.dtype == w.dtype,"shape/dtype {} {} loaded as {} {}".format(w.shape,w.dtype,l.shape,l.dtype)
+            assert np.array_equal(l,w),"tensor values differ"
+        del(loaded)
+
+def test_stale_scores_with_narrowed_candidates():
+    import tempfile
+    from types import SimpleNamespace
+    from Utils import CacheManager
+    from AL.StaleScores import StaleScoreTracker
+
+    CacheManager(locations={})
+    with tempfile.TemporaryDirectory() as tmp:
+        config = SimpleNamespace(sscore=3,sskeep=0.1,ssexp=0.0,acquire=5,info=False,logdir=tmp)
+        tracker = StaleScoreTracker(config,fid='test-stale-scores.pik')
+        pool = np.asarray(["wsi{}/p{}.png".format(i%4,i) for i in range(200)])
+        assert tracker.candidates(pool,0) is None,"first round should be a full rescore"
+        #A later stage (e.g. -cand_budget) narrowed the full round to half of the pool
+        narrowed = np.arange(0,200,2)
+        tracker.update(pool,narrowed,np.random.random(narrowed.shape[0]),0,full=True)
+        cand = tracker.candidates(pool,1)
+        assert not cand is None,"stale score pruning not enabled after a narrowed full round"
+        assert cand.shape[0] < pool.shape[0],"stale score pruning kept the whole pool"
+        tracker.update(pool,cand,np.random.random(cand.shape[0]),1,full=False)
+        assert tracker.candidates(pool,3) is None,"full rescore period not respected"
+
+def _groups_reference(hashes,threshold):
+    """
+    Transitive grouping by all pairs Hamming distances.
+    """
+    n = hashes.shape[0]
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1,8),axis=1)
+    close = (bits[:,None,:] != bits[None,:,:]).sum(axis=2) <= threshold
+    labels = np.arange(n)
+    changed = True
+    while changed:
+        new = np.min(np.where(close,labels[None,:],n),axis=1)
+        changed = not np.array_equal(new,labels)
+        labels = new
+    return labels
+
+def test_phash_grouping():
+    from Preprocessing.PerceptualHash import near_duplicate_groups
+
+    rng = np.random.RandomState(5)
+    base = rng.randint(0,2**62,size=40,dtype=np.int64).astype(np.uint64)
+    #Near-duplicates: copies with a few flipped bits, plus exact duplicates
+    flips = [base[i] ^ np.uint64(1 << int(b)) for i,b in zip(rng.randint(0,40,60),rng.randint(0,64,60))]
+    hashes = np.concatenate((base,np.asarray(flips,dtype=np.uint64),base[:5]))
+    for threshold in (0,1,3,8):
+        labels = near_duplicate_groups(hashes,threshold)
+        expected = _groups_reference(hashes,threshold)
+        assert np.array_equal(labels,expected),"near-duplicate groups differ from reference (threshold {})".format(threshold)
+        assert np.all(labels <= np.arange(hashes.shape[0])),"group label is not the group's first item"
+
+def test_phash_item_types():
+    from Preprocessing.NPImage import NPImage
+    from Preprocessing.PerceptualHash import _hash_items
+
+    rng = np.random.RandomState(9)
+    gray = rng.random_sample((28,28,1)).astype(np.float32)
+    rgb = (rng.random_sample((32,32,3))*255).astype(np.uint8)
+    items = [NPImage('mnist.npz',gray,True,'x_train',0),NPImage('mnist.npz',gray.copy(),True,'x_train',1),
+                 NPImage('tiles.npz',rgb,True,'x_train',0)]
+    hashes = _hash_items(items,8)[0]
+    assert hashes[0] == hashes[1],"equal images hash differently"
+    assert hashes[0] != hashes[2],"different images share a hash"
+
+def test_renamed_model_cache_paths():
+    import os
+    from types import SimpleNamespace
+    from Utils import CacheManager
+    from Models.GenericModel import GenericModel
+
+    class _Net(GenericModel):
+        #Same cache setup as the networks in Models
+        def __init__(self,config,ds,name=None):
+            super().__init__(config,ds,name="Net" if name is None else name)
+            self._modelCache = "{0}-model.h5".format(self.name)
+            self._weightsCache = "{0}-weights.h5".format(self.name)
+            self._mgpu_weightsCache = "{0}-mgpu-weights.h5".format(self.name)
+            self.cache_m = CacheManager()
+            self.cache_m.registerFile(os.path.join(config.model_path,self._modelCache),self._modelCache)
+            self.cache_m.registerFile(os.path.join(config.weights_path,self._weightsCache),self._weightsCache)
+            self.cache_m.registerFile(os.path.join(config.weights_path,self._mgpu_weightsCache),self._mgpu_weightsCache)
+        def get_model_cache(self):
+            return self.cache_m.fileLocation(self._modelCache)
+        def get_weights_cache(self):
+            return self.cache_m.fileLocation(self._weightsCache)
+        def get_mgpu_weights_cache(self):
+            return self.cache_m.fileLocation(self._mgpu_weightsCache)
+        def _build(self,**kwargs):
+            return None
+
+    CacheManager(locations={})
+    config = SimpleNamespace(phi=1,model_path='models',weights_path='weights')
+    target,student = _Net(config,None),_Net(config,None)
+    student.setName("{}-Student".format(student.getName()))
+    for fn in ('get_model_cache','get_weights_cache','get_mgpu_weights_cache'):
+        a,b = getattr(target,fn)(),getattr(student,fn)()
+        assert a != b,"renamed network shares {} with the original: {}".format(fn,a)
+        assert os.path.basename(b).startswith('Net-Student'),"{} not renamed: {}".format(fn,b)
+
+class _ArrayGenerator(object):
+    """
+    Minimal pool generator: items are sample IDs, batches are rows of a feature array.
+    """
+    def __init__(self,items,data,batch_size=16,classes=3):
+        self.items = np.asarray(items)
+        self.data = data
+        self.batch_size = batch_size
+        self.classes = classes
+
+    def __len__(self):
+        return int(np.ceil(self.items.shape[0]/self.batch_size))
+
+    def __getitem__(self,i):
+        return self.data[i*self.batch_size:(i+1)*self.batch_size],None
+
+    def returnDataAsArray(self):
+        return (self.items,np.zeros(self.items.shape[0],dtype=np.int32))
+
+def test_checkpoint_pool_fingerprint():
+    from AL.Checkpoint import _pool_fingerprint
+
+    items = ["wsi/p{}.png".format(i) for i in range(5000)]
+    changed = list(items)
+    changed[2500] = "wsi/other.png"
+    fp = _pool_fingerprint(_ArrayGenerator(items,None))
+    assert fp == _pool_fingerprint(_ArrayGenerator(list(items),None)),"same pool, different fingerprints"
+    assert fp != _pool_fingerprint(_ArrayGenerator(changed,None)),"different pools share a fingerprint"
+    assert fp != _pool_fingerprint(_ArrayGenerator(items[::-1],None)),"pool order is not fingerprinted"
+
+def _checkpoint_config(tmp):
+    from types import SimpleNamespace
+    return SimpleNamespace(ckpt=1e-9,info=False,cache=tmp,ac_function='ensemble_bald',ffeat=None,emodels=1)
+
+class _FixedModel(object):
+    """
+    GenericModel stand in: no weights files, so the extractor fingerprint only depends on the pool.
+    """
+    def is_ensemble(self):
+        return False
+    def get_weights_cache(self):
+        return None
+    def get_mgpu_weights_cache(self):
+        return None
+
+class _RegisteredModel(_FixedModel):
+    """
+    GenericModel stand in whose weights are only in the WeightsRegistry (weights file not written yet).
+    """
+    def get_weights_cache(self):
+        return "ALComponentsTest-unwritten-weights.h5"
+
+def test_extractor_fingerprint_registry_weights():
+    from types import SimpleNamespace
+    from Utils import WeightsRegistry
+    from AL.Projection import extractor_fingerprint
+
+    config = SimpleNamespace(ffeat=None,emodels=1)
+    model = _RegisteredModel()
+    registry = WeightsRegistry()
+    weights = [np.ones((4,3),dtype=np.float32),np.zeros(3,dtype=np.float32)]
+    registry.register(model.get_weights_cache(),weights)
+    fp = extractor_fingerprint(config,model)
+    registry.register(model.get_weights_cache(),[w+1 for w in weights])
+    assert fp != extractor_fingerprint(config,model),"new registry weights, same extractor fingerprint"
+    registry.register(model.get_weights_cache(),[w.copy() for w in weights])
+    assert fp == extractor_fingerprint(config,model),"same weights, different extractor fingerprints"
+
+def test_checkpoint_resume():
+    import tempfile
+    from AL.Accumulators import BALDAccumulator
+    from AL.Checkpoint import ScoringCheckpoint,checkpoint_exists
+    from AL.Common import iterate_batches
+
+    rng = np.random.RandomState(13)
+    size,classes,members = 100,3,4
+    probs = rng.dirichlet(np.ones(classes),size=(members,size)).astype(np.float32)
+    generator = _ArrayGenerator(["p{}".format(i) for i in range(size)],np.arange(size))
+
+    def score(config,stop=None):
+        acc = BALDAccumulator(size,classes,members)
+        ckpt = ScoringCheckpoint(config,_FixedModel(),generator)
+        start = ckpt.restore(acc)
+        for b,(rows,inp) in enumerate(iterate_batches(generator,2,start=start)):
+            if not stop is None and start+b == stop:
+                return None
+            for m in range(members):
+                acc.update(rows,probs[m,inp])
+            ckpt.step(acc)
+        ckpt.clear()
+        return acc.scores()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = _checkpoint_config(tmp)
+        expected = score(config)
+        assert not checkpoint_exists(config),"checkpoint left after complete scoring"
+        assert score(config,stop=4) is None
+        assert checkpoint_exists(config),"interrupted scoring left no checkpoint"
+        assert np.allclose(score(config),expected),"resumed scores differ from uninterrupted scoring"
+        #Checkpoints of another pool are not resumed
+        score(config,stop=4)
+        other = _ArrayGenerator(["q{}".format(i) for i in range(size)],np.arange(size))
+        acc = BALDAccumulator(size,classes,members)
+        assert ScoringCheckpoint(config,_FixedModel(),other).restore(acc) == 0,"checkpoint of another pool was resumed"
+
+class _MetadataSource(object):
+    """
+    Datasource stand in: fixed item IDs and labels.
+    """
+    def __init__(self,X,Y):
+        self.X,self.Y = X,Y
+
+    def load_metadata(self):
+        return self.X,self.Y
+
+    def check_paths(self,imgs,search_path):
+        pass
+
+def test_restore_resumes_scoring():
+    import os
+    import pickle
+    import tempfile
+    from Trainers.ALTrainer import ActiveLearningTrainer
+    from AL.Accumulators import BALDAccumulator
+    from AL.Checkpoint import ScoringCheckpoint,checkpoint_exists
+    from AL.Common import iterate_batches
+
+    rng = np.random.RandomState(29)
+    size,test,classes,members = 260,30,3,4
+    X = np.asarray(["wsi/p{}.png".format(i) for i in range(size)])
+    Y = rng.randint(0,classes,size)
+    row = {x:i for i,x in enumerate(X)}
+    probs = rng.dirichlet(np.ones(classes),size=(members,size)).astype(np.float32)
+
+    #Interrupted run: round 3 sets (with acquisitions) and its pool, reordered by earlier pool operations
+    data = np.arange(size-test)
+    perm = rng.permutation(data)
+    train,val = perm[:40],perm[40:60]
+    pool = np.delete(data,np.concatenate((train,val)))
+    pool = pool[rng.permutation(pool.shape[0])]
+
+    def score(config,items,stop=None):
+        generator = _ArrayGenerator(X[items],items,classes=classes)
+        acc = BALDAccumulator(items.shape[0],classes,members)
+        ckpt = ScoringCheckpoint(config,_FixedModel(),generator)
+        start = ckpt.restore(acc)
+        for b,(rows,inp) in enumerate(iterate_batches(generator,2,start=start)):
+            if not stop is None and start+b == stop:
+                return start,None
+            for m in range(members):
+                acc.update(rows,probs[m,inp])
+            ckpt.step(acc)
+        ckpt.clear()
+        return start,acc.scores()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = _checkpoint_config(tmp)
+        for k,v in {'logdir':tmp,'predst':tmp,'restore':True,'sample':1.0,'spool':0,'balance':False,'load_train':False,
+                        'init_train':40,'split':(0.8,0.1,test),'dedup':0,'pred_size':0,'testdir':None,'wsi_split':0,
+                        'wsilist':None,'verbose':0,'epochs':10}.items():
+            setattr(config,k,v)
+        with open(os.path.join(tmp,'al-metadata-Net-r3.pik'),'wb') as fd:
+            pickle.dump(((X[train],Y[train]),(X[val],Y[val]),(X[-test:],Y[-test:])),fd)
+
+        _,expected = score(config,pool)
+        score(config,pool,stop=4)
+        assert checkpoint_exists(config),"interrupted scoring left no checkpoint"
+
+        trainer = ActiveLearningTrainer(config)
+        trainer._ds = _MetadataSource(X,Y)
+        trainer.configure_sets()
+        assert trainer.initial_acq == 3
+        assert np.array_equal(trainer.val_x,X[val]),"restored run did not keep the validation set"
+        assert np.array_equal(trainer.pool_x,X[pool]),"restored pool is not the interrupted one"
+        start,scores = score(config,np.asarray([row[x] for x in trainer.pool_x]))
+        assert start == 4,"restored run did not resume the interrupted scoring (cursor {})".format(start)
+        assert np.allclose(scores,expected),"resumed scores differ from uninterrupted scoring"
+
+class _DropoutModel(object):
+    """
+    Stand in for a dropout model: the n-th prediction of an item is probs[n,item], whatever the order
+    items are predicted in. Inputs are pool rows.
+    """
+    def __init__(self,probs):
+        self.probs = probs
+        self.calls = np.zeros(probs.shape[1],dtype=np.int32)
+
+    def predict_on_batch(self,inp):
+        proba = self.probs[self.calls[inp],inp]
+        self.calls[inp] += 1
+        return proba
+
+def _mc_dropout_reference(probs):
+    """
+    Baseline MC dropout scores: whole pool predictions, one dropout pass at a time.
+    """
+    from scipy.stats import mode
+
+    mc_dp = probs.shape[0]
+    classes = np.stack([p.argmax(axis=-1) for p in probs],axis=1)
+    varratios = np.array([1 - mode(classes[t])[1]/float(mc_dp) for t in range(classes.shape[0])]).ravel()
+
+    score_all = np.zeros(probs.shape[1:],dtype=np.float32)
+    entropy_all = np.zeros(probs.shape[1],dtype=np.float32)
+    for p in probs:
+        score_all = score_all + p
+        entropy_all = entropy_all + np.sum(- np.multiply(p,np.log2(p)),axis=1)
+    avg_pi = np.divide(score_all,mc_dp)
+    g_x = np.sum(- np.multiply(avg_pi,np.log2(avg_pi)),axis=1)
+    bald = g_x - np.divide(entropy_all,mc_dp)
+    return varratios,bald
+
+def test_mc_dropout_matches_reference():
+    import tempfile
+    from AL.Accumulators import BALDAccumulator,VarRatiosAccumulator
+    from AL.BayesianFunctions import _mc_dropout_sampling
+    from AL.Checkpoint import ScoringCheckpoint
+
+    rng = np.random.RandomState(17)
+    size,classes,mc_dp = 150,4,7
+    probs = rng.dirichlet(np.ones(classes),size=(mc_dp,size)).astype(np.float32)
+    generator = _ArrayGenerator(["p{}".format(i) for i in range(size)],np.arange(size),classes=classes)
+    varratios,bald = _mc_dropout_reference(probs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for period in (0,1e-9):
+            config = _checkpoint_config(tmp)
+            config.ac_function = 'bayesian_bald'
+            config.ckpt = period
+            config.progressbar = False
+            config.cpu_count = 1
+            for acc,expected in ((VarRatiosAccumulator(size,classes,mc_dp),varratios),
+                                 (BALDAccumulator(size,classes,mc_dp),bald)):
+                all_probs = np.zeros(probs.shape,dtype=np.float32)
+                ckpt = ScoringCheckpoint(config,_FixedModel(),generator)
+                _mc_dropout_sampling(_DropoutModel(probs),generator,acc,mc_dp,config,ckpt,{},all_probs)
+                assert np.allclose(acc.scores(),expected,atol=1e-5),"MC dropout scores differ from the baseline loop"
+                assert np.array_equal(all_probs,probs),"dropout iterations stored out of order"
+
+def test_shard_requeue_stale_claims():
+    import os
+    import time
+    import tempfile
+    from Trainers.Sharding import requeue_stale
+
+    with tempfile.TemporaryDirectory() as tmp:
+        names = ['r0-s0.pik','r0-s1.pik','r0-s10.pik']
+        for n,tag in zip(names,['dead-1','alive-2','dead-3']):
+            with open(os.path.join(tmp,'task-{}.{}'.format(n,tag)),'wb') as fd:
+                fd.write(b'task')
+        old = time.time() - 1000
+        os.utime(os.path.join(tmp,'task-r0-s0.pik.dead-1'),(old,old))
+        os.utime(os.path.join(tmp,'task-r0-s10.pik.dead-3'),(old,old))
+
+        assert requeue_stale(tmp,names[:2],600) == 1,"stale claims not requeued"
+        assert os.path.isfile(os.path.join(tmp,'task-r0-s0.pik')),"dead worker's task not back in queue"
+        assert os.path.isfile(os.path.join(tmp,'task-r0-s1.pik.alive-2')),"live claim was requeued"
+        assert os.path.isfile(os.path.join(tmp,'task-r0-s10.pik.dead-3')),"claim of another task was requeued"
+
+def run(config):
+    tests = [(name,fn) for name,fn in sorted(globals().items()) if name.startswith('test_') and callable(fn)]
+    failed = 0
+    for name,fn in tests:
+        try:
+            fn()
+            print("[ALComponentsTest] {}: OK".format(name))
+        except AssertionError as e:
+            failed += 1
+            print("[ALComponentsTest] {}: FAILED ({})".format(name,e))
+    print("[ALComponentsTest] {} of {} tests passed".format(len(tests)-failed,len(tests)))
+    return failed == 0
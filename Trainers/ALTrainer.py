@@ -18,6 +18,11 @@ from keras.preprocessing.image import ImageDataGenerator
 from .GenericTrainer import Trainer
 from .Predictions import Predictor
 from .DataSetup import split_test
+from .Sharding import SHARDABLE
+from AL.Checkpoint import save_round_state,load_round_state,register_resumed_weights,apply_pool_order
+
+#MC dropout functions, scored with a pruned model when -prune is set
+PRUNABLE = ('bayesian_varratios','bayesian_bald')
 
 #Module
 from Utils import Exitcodes,CacheManager
@@ -34,6 +39,70 @@ def run_training(config,locations=None):
     trainer = ActiveLearningTrainer(config)
     trainer.run()
     
+def _acquisition_worker(config,locations,pool,train,val,acquisition):
+    """
+    Runs an acquisition function in a separate process (pipelined AL, see -pipeline).
+
+    @param pool <tuple>: (pool_x,pool_y)
+    @param train <tuple>: (train_x,train_y)
+    @param val <tuple>: (val_x,val_y)
+    @param acquisition <int>: acquisition step
+    Returns: selected pool indexes
+    """
+    trainer,function,model,kwargs = worker_setup(config,locations,pool,train,val,acquisition)
+
+    return trainer._run_acquisition(function,model,**kwargs)
+
+def worker_setup(config,locations,pool,train,val,acquisition):
+    """
+    Prepares acquisition in a worker process (pipelined AL and sharded scoring). Model (or ensemble members)
+    are rebuilt here and weights are read from the files written by the training process.
+
+    Returns: (trainer,acquisition function,GenericModel,acquisition function kwargs)
+    """
+    from keras import backend as K
+    import tensorflow as tf
+    from AL.Common import load_model_weights
+    
+    if tf.__version__ >= '1.14.0':
+        tf = tf.compat.v1
+        
+    if not locations is None:
+        cache_m = CacheManager(locations=locations)
+
+    #Share GPUs with training process, limit CPU threads to the given budget
+    gpu_options = tf.GPUOptions(allow_growth=True)
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=config.cpu_count,
+        inter_op_parallelism_threads=config.cpu_count,
+        gpu_options=gpu_options)))
+    
+    trainer = ActiveLearningTrainer(config)
+    model = trainer.load_modules()
+    trainer.pool_x,trainer.pool_y = pool
+    trainer.train_x,trainer.train_y = train
+    trainer.val_x,trainer.val_y = val
+
+    acq = importlib.import_module('AL','AcquisitionFunctions')
+    function = getattr(acq,config.ac_function)
+
+    kwargs = {'config':config,'model':model,'acquisition':acquisition,'sw_thread':None}
+    bparams = {'data_size':train[0].shape[0],'allocated_gpus':config.gpu_count,'layer_freeze':config.lyf}
+    if model.is_ensemble():
+        tmodels = {}
+        for m in range(config.emodels):
+            model.register_ensemble(m)
+            single,parallel = model.build(**bparams)
+            load_model_weights(config,model,(single,parallel))
+            tmodels[m] = single if parallel is None else parallel
+        model.reset()
+        model.tmodels = tmodels
+        kwargs['emodels'] = tmodels
+    else:
+        load_model_weights(config,model,model.build(**bparams))
+
+    return trainer,function,model,kwargs
+    
 class ActiveLearningTrainer(Trainer):
     """
     Implements the structure of active learning:
@@ -59,6 +128,9 @@ class ActiveLearningTrainer(Trainer):
         self.test_x = None
         self.test_y = None
         self.initial_acq = 0
+        self._dup_members = None
+        self._warm_state = {}
+        self._new_from = None
         if self._config.spool > 0:
             self.superp_x = None
             self.superp_y = None
@@ -113,7 +185,7 @@ class ActiveLearningTrainer(Trainer):
 
     def _restore_last_train(self):
         """
-        Restore the last training set used in a previous experiment
+        Restore the last training and validation sets used in a previous experiment
         """
         cache_m = CacheManager()
         files = filter(lambda f:f.startswith('al-metadata'),os.listdir(self._config.logdir))
@@ -123,9 +195,9 @@ class ActiveLearningTrainer(Trainer):
             metadata[ac_id] = os.path.join(self._config.logdir,f)
         last = max(metadata.keys())
         name = os.path.basename(metadata[last]).split('.')[0].split('-')[2]
-        train,_,_ = cache_m.load_file(metadata[last])
+        train,val,_ = cache_m.load_file(metadata[last])
 
-        return train[0],train[1],name,last
+        return train[0],train[1],val,name,last
         
     def _restore_pools(self,sp):
         """
@@ -258,7 +330,7 @@ class ActiveLearningTrainer(Trainer):
         cache_m = CacheManager()
         if self._config.restore:
             train_idx = None
-            self.train_x, self.train_y, name, self.initial_acq = self._restore_last_train()
+            self.train_x, self.train_y, val, name, self.initial_acq = self._restore_last_train()
             if self._config.spool > 0:
                 self._restore_pools(sp=True)
                 self._refresh_pool(self.initial_acq,name)
@@ -276,17 +348,25 @@ class ActiveLearningTrainer(Trainer):
             cache_m.dump(train_idx,'initial_train.pik')
 
         #Validation element index definition
-        val_samples = int((self._config.init_train*self._config.split[1])/self._config.split[0])
-        val_samples = max(val_samples,100)
-        val_idx = np.random.choice(np.setdiff1d(np.arange(self.pool_x.shape[0]),train_idx),val_samples,replace=False)
+        if self._config.restore:
+            #Restored validation set (with its acquisitions) is removed from pool, not drawn again
+            pool_dct = {self.pool_x[k]:k for k in range(self.pool_x.shape[0])}
+            val_idx = np.asarray([pool_dct[s] for s in val[0] if s in pool_dct],dtype=np.int64)
+        else:
+            val_samples = int((self._config.init_train*self._config.split[1])/self._config.split[0])
+            val_samples = max(val_samples,100)
+            val_idx = np.random.choice(np.setdiff1d(np.arange(self.pool_x.shape[0]),train_idx),val_samples,replace=False)
 
         if not train_idx is None:
             self.train_x = self.pool_x[train_idx]
             self.train_y = self.pool_y[train_idx]
         
         #Initial validation set - keeps the same split ratio for train/val as defined in the configuration
-        self.val_x = self.pool_x[val_idx]
-        self.val_y = self.pool_y[val_idx]
+        if self._config.restore:
+            self.val_x,self.val_y = val
+        else:
+            self.val_x = self.pool_x[val_idx]
+            self.val_y = self.pool_y[val_idx]
 
         #Remove the selected items from pool and set superset indexes to be removed when regenerating
         remove = val_idx if train_idx is None else np.concatenate((train_idx,val_idx),axis=0) 
@@ -297,6 +377,74 @@ class ActiveLearningTrainer(Trainer):
         if self._config.sample != 1.0:
             self.sample_idx = np.delete(self.sample_idx,remove)
 
+        #Near-duplicates: only one representative per group is kept in the pool
+        if self._config.dedup > 0:
+            self._dedup_pool()
+
+        #Interrupted scoring (-ckpt) is resumed only over the same pool, in the same order
+        if self._config.restore:
+            self._restore_pool_order()
+
+    def _restore_pool_order(self):
+        self.pool_x,self.pool_y,order = apply_pool_order(self._config,self.pool_x,self.pool_y)
+        if order is None:
+            return
+        if self._config.sample != 1.0 and not self.sample_idx is None and self.sample_idx.shape[0] == order.shape[0]:
+            self.sample_idx = self.sample_idx[order]
+        if self._config.info:
+            print("[ALTrainer] Pool put in the order of the pending scoring checkpoint ({} items).".format(order.shape[0]))
+
+    def _dedup_pool(self):
+        """
+        Groups near-duplicate pool items (perceptual hashing) and keeps one representative per group in the
+        pool. Group membership is kept (representative -> duplicates) for label propagation.
+        """
+        from Preprocessing import deduplicate
+
+        if self._config.spool > 0:
+            if self._config.info:
+                print("[ALTrainer] Pool deduplication is not available with pool regeneration (spool).")
+            return
+
+        reps,labels = deduplicate(self.pool_x,self._config.dedup,self._config.cpu_count,
+                                      self._config.progressbar,self._config.verbose)
+        groups = {}
+        for m in np.setdiff1d(np.arange(labels.shape[0]),reps):
+            groups.setdefault(labels[m],[]).append(m)
+        self._dup_members = {self.pool_x[r]:(self.pool_x[idx],self.pool_y[idx]) for r,idx in groups.items()}
+        
+        cache_m = CacheManager()
+        fid = 'al-dedup-groups.pik'
+        cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
+        cache_m.dump(self._dup_members,fid)
+
+        if self._config.info:
+            print("[ALTrainer] Pool deduplication: {} items in pool, {} duplicates set aside ({} groups).".format(
+                reps.shape[0],self.pool_x.shape[0]-reps.shape[0],len(groups)))
+            
+        self.pool_x = self.pool_x[reps]
+        self.pool_y = self.pool_y[reps]
+
+    def _propagate_labels(self,pooled_idx):
+        """
+        Near-duplicates of acquired items are added to the training set with their representative's label.
+        """
+        if self._dup_members is None or not self._config.dprop:
+            return
+        
+        dx,dy = [],[]
+        for item,label in zip(self.pool_x[pooled_idx],self.pool_y[pooled_idx]):
+            if item in self._dup_members:
+                members,_ = self._dup_members.pop(item)
+                dx.append(members)
+                dy.append(np.full(members.shape[0],label,dtype=self.train_y.dtype))
+                
+        if len(dx) > 0:
+            self.train_x = np.concatenate([self.train_x]+dx,axis=0)
+            self.train_y = np.concatenate([self.train_y]+dy,axis=0)
+            if self._config.info:
+                print("[ALTrainer] Labels propagated to {} near-duplicates of acquired items.".format(sum([d.shape[0] for d in dx])))
+
 
     def run(self):
         """
@@ -355,17 +503,25 @@ class ActiveLearningTrainer(Trainer):
 
             #Track training time
             train_time = time.time()
-            tmodel,sw_thread,epad = self.train_model(model,(self.train_x,self.train_y),(self.val_x,self.val_y),save_numpy=True)
+            if self._resume_scoring(r):
+                tmodel,sw_thread,epad = self._resume_model(model)
+            else:
+                tmodel,sw_thread,epad = self.train_model(model,(self.train_x,self.train_y),(self.val_x,self.val_y),save_numpy=True,
+                                                             **self._warm_kwargs(r,model.get_weights_cache()))
+                self._keep_warm_state(model.get_weights_cache(),tmodel)
+                save_round_state(self._config,{'epad':epad,'epochs':self._config.epochs})
                                                              
             if self._config.info:
                 print("Training step took: {}".format(timedelta(seconds=time.time()-train_time)))
 
-            #Some models may take too long to save weights
-            if not sw_thread is None and sw_thread.is_alive():
-                if self._config.info:
-                    print("[ALTrainer] Waiting for model weights...")
-                sw_thread.join()
-                
+            #Pipelined AL: pool scoring runs in a worker process while target net is trained/tested here
+            last = r == (self._config.acquisition_steps - 1)
+            pending = None
+            if self._config.pipeline > 0 and not last:
+                pending = self._dispatch_acquisition(model,acquisition=r,sw_thread=sw_thread)
+
+            #Trained weights are handed to acquisition/prediction in memory (WeightsRegistry),
+            #weights files are written in background
             run_pred = self.test_target(predictor,r,end_train)
 
             #Epoch adjustment
@@ -373,8 +529,17 @@ class ActiveLearningTrainer(Trainer):
                 ne = int(self._config.epochs * epad) if epad < 0 else int((1-epad)*self._config.epochs)
                 print("Adjusting epochs ({} -> {}).".format(self._config.epochs,ne))
                 self._config.epochs = max(min(ne,100),self.min_epochs)
+
+            if not pending is None:
+                if not run_pred:
+                    predictor.run(self.test_x,self.test_y,load_full=False,net_model=model,target=self._config.tnet is None,
+                                  calibration=(self.train_x,self.train_y))
+                    run_pred = True
+                acquired = self._collect_acquisition(pending)
+            else:
+                acquired = not last and self.acquire(function,model,acquisition=r,sw_thread=sw_thread)
                 
-            if r == (self._config.acquisition_steps - 1) or not self.acquire(function,model,acquisition=r,sw_thread=sw_thread):
+            if not acquired:
                 if self._config.info:
                     print("[ALTrainer] No more acquisitions are in order")
                 end_train = True
@@ -382,7 +547,11 @@ class ActiveLearningTrainer(Trainer):
             #Set load_full to false so dropout is disabled
             #Test target network if needed
             if not run_pred:
-                predictor.run(self.test_x,self.test_y,load_full=end_train,net_model=model,target=self._config.tnet is None)
+                #Full model is loaded from file
+                if end_train and not sw_thread is None:
+                    sw_thread.join()
+                predictor.run(self.test_x,self.test_y,load_full=end_train,net_model=model,target=self._config.tnet is None,
+                                  calibration=(self.train_x,self.train_y))
             
             #Attempt to free GPU memory
             K.clear_session()
@@ -395,6 +564,66 @@ class ActiveLearningTrainer(Trainer):
             if end_train:
                 return None
 
+    def _warm_kwargs(self,r,key):
+        """
+        Warm start (-warm): train_model kwargs to fine-tune the network from the previous round's weights and
+        optimizer state for config.warm epochs. Every config.wsfull rounds the network is trained from scratch.
+        Fine-tuning rounds use the replay schedule if config.replay > 0.
+
+        @param key <str>: model (or ensemble member) weights cache
+        """
+        if self._config.warm <= 0 or not key in self._warm_state:
+            return {}
+        if self._config.wsfull > 0 and ((r - self.initial_acq) % self._config.wsfull) == 0:
+            if self._config.info:
+                print("[ALTrainer] Warm start: full retrain in round {}".format(r))
+            return {}
+        weights,opt_weights = self._warm_state[key]
+        warm = {'init_weights':weights,'opt_weights':opt_weights,'epochs':self._config.warm}
+        #Replay schedule (-replay): items acquired in the last round plus a sample of older ones
+        if self._config.replay > 0 and not self._new_from is None:
+            warm['new_idx'] = np.arange(self._new_from,self.train_x.shape[0])
+        return warm
+
+    def _keep_warm_state(self,key,tmodel):
+        """
+        Keeps trained weights and optimizer state in memory (sessions are cleared at the end of each round).
+        """
+        if self._config.warm > 0:
+            self._warm_state[key] = (tmodel.get_weights(),tmodel.optimizer.get_weights())
+
+    def _resume_scoring(self,r):
+        """
+        A restored run with a pending scoring checkpoint (-ckpt) reuses the weights of the interrupted round.
+        """
+        from AL.Checkpoint import checkpoint_exists
+        
+        return self._config.restore and r == self.initial_acq and checkpoint_exists(self._config)
+
+    def _resume_model(self,model):
+        """
+        Builds the model and loads the interrupted round's weights from disk instead of training.
+        Returns the same as train_model, with the interrupted round's epoch adjustment.
+        """
+        from AL.Common import load_model_weights
+        
+        if self._config.info:
+            print("[ALTrainer] Scoring checkpoint found, training skipped (weights loaded from disk).")
+        single,parallel = model.build(data_size=self.train_x.shape[0],allocated_gpus=self._config.gpu_count,layer_freeze=self._config.lyf)
+        load_model_weights(self._config,model,(single,parallel))
+        register_resumed_weights(model,single,parallel)
+        return (single if parallel is None else parallel),None,self._resume_epad(0)
+
+    def _resume_epad(self,default):
+        """
+        Restores the epochs of the interrupted round and returns its epoch adjustment (default if not saved).
+        """
+        state = load_round_state(self._config)
+        if state is None:
+            return default
+        self._config.epochs = state['epochs']
+        return state['epad']
+    
     def acquire(self,function,model,**kwargs):
         """
         Adds items to training and validation sets, according to split ratio defined in configuration. 
@@ -402,24 +631,21 @@ class ActiveLearningTrainer(Trainer):
 
         Returns True if acquisition was sucessful
         """
-        from Trainers import ThreadedGenerator
-        import gc
-
         if kwargs is None:
             kwargs = {}
 
-        kwargs['config'] = self._config
+        if not self._prepare_acquisition(model,kwargs):
+            return False
 
-        #Some acquisition functions may need access to GenericModel
-        kwargs['model'] = model
+        pooled_idx = self._run_acquisition(function,model,**kwargs)
+        self._apply_acquisition(pooled_idx)
 
-        tmodels = kwargs.get('emodels',None)
-        
-        #An acquisition function should return a NP array with the indexes of all items from the pool that 
-        #should be inserted into training and validation sets
-        if self.pool_x.shape[0] < self._config.acquire:
-            return False
+        return True
 
+    def _generator_params(self,model):
+        """
+        Returns the parameters of pool/train data generators used by acquisition functions
+        """
         fix_dim = model.check_input_shape()
 
         #Pools are big, use a data generator
@@ -437,6 +663,26 @@ class ActiveLearningTrainer(Trainer):
             'shuffle':False, #DO NOT SET TRUE!
             'verbose':self._config.verbose}
 
+        return generator_params
+    
+    def _prepare_acquisition(self,model,kwargs):
+        """
+        Checks pool size and regenerates the pool if defined. Returns False if no acquisition is possible.
+
+        @param kwargs <dict>: acquisition function keyword arguments (config and model are set here)
+        """
+        import gc
+        
+        kwargs['config'] = self._config
+
+        #Some acquisition functions may need access to GenericModel
+        kwargs['model'] = model
+
+        #An acquisition function should return a NP array with the indexes of all items from the pool that 
+        #should be inserted into training and validation sets
+        if self.pool_x.shape[0] < self._config.acquire:
+            return False
+
         #Regenerate pool if defined
         if self._config.spool > 0 and kwargs['acquisition'] > 0 and ((kwargs['acquisition'] + 1) % (self._config.spool)) == 0:
             if self._config.spool_f is None:
@@ -445,22 +691,76 @@ class ActiveLearningTrainer(Trainer):
                 acq = importlib.import_module('Trainers')
                 spool_f = getattr(getattr(acq,'DataSetup'),self._config.spool_f)
                 kwargs['space'] = 2
-                params = (self.pool_size,generator_params,kwargs)
+                params = (self.pool_size,self._generator_params(model),kwargs)
                 self._refresh_pool(kwargs['acquisition'],model.name,regen_f=spool_f,regen_p=params)
             
         #Clear some memory before acquisitions
         gc.collect()
 
+        return True
+
+    def _run_acquisition(self,function,model,**kwargs):
+        """
+        Runs the acquisition function over current pool. Returns the selected pool indexes (or None).
+        """
+        from Trainers import ThreadedGenerator
+
+        tmodels = kwargs.get('emodels',None)
+        generator_params = self._generator_params(model)
+
+        #Acquisition functions report per item scores to observers (Common.report_output)
+        observed = {}
+        def _observe(name,data):
+            observed[name] = data
+        kwargs['observers'] = kwargs.get('observers',[]) + [_observe]
+        
+        #Scoring outputs are recorded for offline replay (Utils/ALReplay.py)
+        recorder = None
+        if self._config.record:
+            from AL.Recorder import RoundRecorder
+            recorder = RoundRecorder(self._config,kwargs['acquisition'])
+            kwargs['observers'].append(recorder.observe)
+            
+        #Stale-score pruning: only promising candidates are rescored, except every sscore rounds
+        tracker,cand = None,None
+        if self._config.sscore > 0:
+            from AL.StaleScores import StaleScoreTracker
+            tracker = StaleScoreTracker(self._config)
+            cand = tracker.candidates(self.pool_x,kwargs['acquisition'])
+        #Full rescore rounds are decided by the tracker, before other stages narrow the candidates
+        tracked_full = cand is None
+
+        #Per slide budgeted candidate sampling
+        if self._config.wsi_cap > 0 or self._config.cand_budget > 0:
+            from .DataSetup import wsi_candidates
+            cand = wsi_candidates(self._config,self.pool_x,cand)
+
+        #Cheap-proxy cascade: only items that pass the proxy stage are scored by the acquisition function
+        passed,audit = None,None
+        if not self._config.proxy is None:
+            cand,passed,audit = self._proxy_stage(cand)
+
+        #Structured channel pruning: MC dropout scoring runs on a smaller model (not in sharded scoring)
+        sharded = self._config.shards > 1 and function.__name__ in SHARDABLE
+        if self._config.prune > 0 and function.__name__ in PRUNABLE and not sharded:
+            kwargs['model'] = self._prune_model(model,kwargs.get('sw_thread',None))
+        
         #Set pool generator
-        generator_params['dps'] = (self.pool_x,self.pool_y)
+        if cand is None:
+            generator_params['dps'] = (self.pool_x,self.pool_y)
+        else:
+            generator_params['dps'] = (self.pool_x[cand],self.pool_y[cand])
         generator = ThreadedGenerator(**generator_params)
+        data_size = generator_params['dps'][0].shape[0]
 
         #For functions that need to access train data
         generator_params['dps'] = (self.train_x,self.train_y)
         train_gen = ThreadedGenerator(**generator_params)
         kwargs['train_gen'] = train_gen
 
-        if not tmodels is None:
+        if 'student' in kwargs:
+            pred_model = kwargs['student']
+        elif not tmodels is None:
             pred_model = tmodels
         elif self._config.gpu_count > 1:
             pred_model = model.parallel
@@ -475,14 +775,199 @@ class ActiveLearningTrainer(Trainer):
 
         #Track acquisition time
         ac_time = time.time()
-        pooled_idx = function(pred_model,generator,self.pool_x.shape[0],**kwargs)
+        if sharded:
+            pooled_idx = self._sharded_acquisition(cand,observed,**kwargs)
+        else:
+            if self._config.shards > 1 and self._config.info:
+                print("[ALTrainer] {} can not be sharded, running in a single process.".format(function.__name__))
+            pooled_idx = function(pred_model,generator,data_size,**kwargs)
         if self._config.info:
             print("Acquisition step took: {}".format(timedelta(seconds=time.time() - ac_time)))
 
+        if not recorder is None:
+            items,labels = (self.pool_x,self.pool_y) if cand is None else (self.pool_x[cand],self.pool_y[cand])
+            rpath = recorder.save(items,labels,pooled_idx,function.__name__,self._config.acquire)
+            if self._config.info:
+                print("[ALTrainer] Scoring outputs recorded: {}".format(rpath))
+        if not tracker is None:
+            tracker.update(self.pool_x,cand,observed.get('scores',None),kwargs['acquisition'],full=tracked_full)
+        if not audit is None:
+            self._proxy_audit(cand,passed,audit,observed.get('scores',None))
+        if not cand is None and not pooled_idx is None:
+            pooled_idx = cand[pooled_idx]
+            
+        del(generator)
+        return pooled_idx
+
+    def _sharded_acquisition(self,cand,observed,**kwargs):
+        """
+        Pool (or candidates) is scored in shards by worker processes (see Trainers.Sharding). Selection is
+        done here, the same way scoring functions do it.
+        """
+        from .Sharding import ShardCoordinator
+        
+        #Workers have their own memory, weights must be on disk
+        sw_thread = kwargs.get('sw_thread',None)
+        if not sw_thread is None:
+            for t in (sw_thread if isinstance(sw_thread,list) else [sw_thread]):
+                t.join()
+
+        a_1d = ShardCoordinator(self._config).score(self,cand,kwargs['acquisition'])
+        if a_1d is None:
+            return None
+        observed['scores'] = a_1d
+        pooled_idx = a_1d.argsort()[-self._config.acquire:][::-1]
+
+        if self._config.save_var:
+            cache_m = CacheManager()
+            fid = 'al-uncertainty-{1}-r{0}.pik'.format(kwargs['acquisition'],self._config.ac_function)
+            cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
+            cache_m.dump((pooled_idx,a_1d),fid)
+            
+        return pooled_idx
+
+    def _prune_model(self,model,sw_thread=None):
+        """
+        Removes filters from the trained model (see Models.Pruning) and fine-tunes it for prune_ft epochs on the
+        training set. Returns a PrunedModel, or model itself if nothing can be pruned.
+        """
+        from keras import optimizers
+        from AL.Common import load_model_weights
+        from Models.Pruning import PrunedModel,channel_plan,apply_plan,conv_flops
+        from Utils import WeightsRegistry
+
+        if self._config.gpu_count > 1:
+            if self._config.info:
+                print("[ALTrainer] Multi-GPU models are not pruned.")
+            return model
+
+        ptime = time.time()
+        single,_ = model.build(data_size=self.train_x.shape[0],allocated_gpus=1,keep_model=False)
+        single = load_model_weights(self._config,model,single,sw_thread)
+        train_generator,val_generator = self._choose_generator((self.train_x,self.train_y),(self.val_x,self.val_y),
+                                                                   model.check_input_shape())
+
+        plan = channel_plan(single,self._config.prune,self._config.prune_crit,train_generator[0][0])
+        if len(plan) == 0:
+            if self._config.info:
+                print("[ALTrainer] No prunable convolutions in {}.".format(model.name))
+            return model
+
+        pruned = apply_plan(single,plan)
+        opt = optimizers.get({'class_name':single.optimizer.__class__.__name__,'config':single.optimizer.get_config()})
+        pruned.compile(loss='categorical_crossentropy',optimizer=opt,metrics=['accuracy'])
+        if self._config.prune_ft > 0:
+            pruned.fit_generator(
+                generator = train_generator,
+                steps_per_epoch = len(train_generator),
+                epochs = self._config.prune_ft,
+                validation_data = val_generator,
+                validation_steps = len(val_generator),
+                verbose = self._verbose,
+                use_multiprocessing = False,
+                workers=self._config.cpu_count*2,
+                max_queue_size=self._config.batch_size*3)
+
+        pmodel = PrunedModel(model,plan)
+        WeightsRegistry().register(pmodel.get_weights_cache(),pruned.get_weights())
+        pruned.save_weights(pmodel.get_weights_cache())
+
+        if self._config.info:
+            print("[ALTrainer] Pruning took: {}. {} convolutions pruned; parameters: {} -> {}; conv MACs per item: {:.3g} -> {:.3g}".format(
+                timedelta(seconds=time.time()-ptime),len(plan),single.count_params(),pruned.count_params(),
+                conv_flops(single),conv_flops(pruned)))
+        return pmodel
+
+    def _proxy_stage(self,cand):
+        """
+        Cheap-proxy cascade: a small network (config.proxy), trained on the current training set, scores the
+        pool (predictive entropy). Its top proxy_m items and a random fraction (proxy_rnd) of the remaining ones
+        pass to the acquisition function. If proxy_audit > 0, a random sample of that size is also passed, so
+        proxy recall can be measured against the acquisition function's scores (see _proxy_audit).
+
+        @param cand <np.array>: pool indexes to consider (None: whole pool)
+        Returns: (candidate pool indexes, pool indexes passed by the proxy, audit pool indexes); all sorted
+        """
+        from Trainers import ThreadedGenerator
+        from AL.Common import iterate_batches
+        
+        idx = np.arange(self.pool_x.shape[0]) if cand is None else cand
+        if idx.shape[0] <= self._config.proxy_m:
+            return cand,None,None
+
+        pmodel = self.load_modules(self._config.proxy)
+        pmodel.setName("{}-Proxy".format(pmodel.getName()))
+        if pmodel.rescaleEnabled() and self._config.proxy_phi > 1:
+            pmodel.setPhi(self._config.proxy_phi)
+
+        if self._config.info:
+            print("\n[ALTrainer] Training proxy network ({})...".format(pmodel.getName()))
+        ptime = time.time()
+        tm,_,_ = self.train_model(pmodel,(self.train_x,self.train_y),(self.val_x,self.val_y),
+                                     set_session=False,stats=False,summary=False,
+                                     clear_sess=False,save_numpy=False)
+
+        generator_params = self._generator_params(pmodel)
+        generator_params['dps'] = (self.pool_x[idx],self.pool_y[idx])
+        generator = ThreadedGenerator(**generator_params)
+        pscores = np.zeros(idx.shape[0],dtype=np.float32)
+        for rows,inp in iterate_batches(generator,self._config.cpu_count):
+            proba = np.clip(tm.predict_on_batch(inp),1e-12,1.0)
+            pscores[rows] = np.sum(- np.multiply(proba,np.log2(proba)),axis=1)
+
+        order = np.argsort(-pscores,kind='stable')
+        rest = order[self._config.proxy_m:]
+        n_rnd = int(self._config.proxy_rnd*rest.shape[0])
+        passed = order[:self._config.proxy_m]
+        if n_rnd > 0:
+            passed = np.union1d(passed,np.random.choice(rest,n_rnd,replace=False))
+        else:
+            passed = np.sort(passed)
+
+        audit = None
+        selected = passed
+        if self._config.proxy_audit > 0:
+            audit = np.sort(np.random.choice(idx.shape[0],min(self._config.proxy_audit,idx.shape[0]),replace=False))
+            selected = np.union1d(passed,audit)
+            audit = idx[audit]
+
+        if self._config.info:
+            print("[ALTrainer] Proxy stage took: {}. {} of {} pool items passed to acquisition function (top: {}; random: {}; audit: {})".format(
+                timedelta(seconds=time.time()-ptime),selected.shape[0],idx.shape[0],min(self._config.proxy_m,idx.shape[0]),n_rnd,
+                0 if audit is None else audit.shape[0]))
+            
+        return idx[selected],idx[passed],audit
+
+    def _proxy_audit(self,cand,passed,audit,scores):
+        """
+        Recall of the proxy stage: fraction of the audit sample's top items, according to the acquisition function,
+        that the proxy stage passed on its own. Top items are the same fraction of the audit sample as acquire is
+        of the pool.
+        """
+        if scores is None:
+            if self._config.info:
+                print("[ALTrainer] Proxy audit requires an acquisition function that reports item scores.")
+            return
+
+        ascores = scores[np.searchsorted(cand,audit)]
+        k = max(1,int(np.ceil(audit.shape[0]*self._config.acquire/self.pool_x.shape[0])))
+        top = audit[np.argsort(ascores)[-k:]]
+        recall = np.isin(top,passed).mean()
+
+        if self._config.info:
+            print("[ALTrainer] Proxy audit: recall of top-{} audit items (of {}): {:.4f}".format(k,audit.shape[0],recall))
+
+    def _apply_acquisition(self,pooled_idx):
+        """
+        Moves acquired items from pool to training set.
+        """
         if pooled_idx is None:
             if self._config.info:
                 print("[ALTrainer] No indexes returned. Something is wrong.")
             sys.exit(1)
+
+        #Items from this position on are new to the next training round
+        self._new_from = self.train_x.shape[0]
             
         #Store acquired patches indexes in pool set
         if self._config.spool > 0:
@@ -491,16 +976,98 @@ class ActiveLearningTrainer(Trainer):
             else:
                 self.acq_idx = np.concatenate((self.acq_idx,self.sample_idx[pooled_idx]),axis=0)
             self.sample_idx = np.delete(self.sample_idx,pooled_idx)
- 
-        del(generator)
-        
+
+        self._propagate_labels(pooled_idx)
         self.train_x = np.concatenate((self.train_x,self.pool_x[pooled_idx]),axis=0)
         self.train_y = np.concatenate((self.train_y,self.pool_y[pooled_idx]),axis=0)
         self.pool_x = np.delete(self.pool_x,pooled_idx)
         self.pool_y = np.delete(self.pool_y,pooled_idx)
 
-        return True
+    def _dispatch_acquisition(self,model,**kwargs):
+        """
+        Pipelined AL: starts acquisition in a worker process, so pool scoring runs while this process
+        trains/tests the target network. The worker gets config.pipeline CPU cores, this process keeps the
+        remaining ones (its TF session thread pools are limited to them) until the end of the round.
+
+        Returns a handle for _collect_acquisition or None if no acquisition is possible.
+        """
+        import copy
+        import multiprocessing as mp
+
+        if not self._prepare_acquisition(model,kwargs):
+            return None
+
+        #Worker process has its own memory, weights must be on disk
+        sw_thread = kwargs.get('sw_thread',None)
+        if not sw_thread is None:
+            for t in (sw_thread if isinstance(sw_thread,list) else [sw_thread]):
+                t.join()
 
+        wconfig = copy.copy(self._config)
+        wconfig.cpu_count = self._config.pipeline
+        cpu_count = self._config.cpu_count
+        
+        ctx = mp.get_context('spawn')
+        pool = ctx.Pool(processes=1)
+        result = pool.apply_async(_acquisition_worker,(wconfig,CacheManager().getLocations(),(self.pool_x,self.pool_y),
+                                                           (self.train_x,self.train_y),(self.val_x,self.val_y),kwargs['acquisition']))
+        pool.close()
+        self._config.cpu_count = max(1,cpu_count - self._config.pipeline)
+        self._limit_session(self._config.cpu_count)
+        
+        if self._config.info:
+            print("[ALTrainer] Acquisition dispatched to worker process ({} cores; {} cores left for target network)".format(
+                wconfig.cpu_count,self._config.cpu_count))
+            
+        return (pool,result,cpu_count,time.time())
+
+    def _limit_session(self,threads):
+        """
+        TF thread pools are fixed when a session is created: the Keras session is replaced by one limited to
+        threads (same graph), holding the current variable values. The default session is created again after
+        K.clear_session, at the end of the AL round.
+
+        Weight saving threads must have finished (they read variables through the Keras session).
+        """
+        from keras import backend as K
+        import tensorflow as tf
+
+        if tf.__version__ >= '1.14.0':
+            tf = tf.compat.v1
+
+        old = K.get_session()
+        with old.graph.as_default():
+            variables = tf.global_variables()
+            initialized = old.run([tf.is_variable_initialized(v) for v in variables]) if variables else []
+            variables = [v for v,i in zip(variables,initialized) if i]
+            values = old.run(variables) if variables else []
+            gpu_options = tf.GPUOptions(allow_growth=True)
+            session = tf.Session(graph=old.graph,config=tf.ConfigProto(
+                intra_op_parallelism_threads=threads,
+                inter_op_parallelism_threads=threads,
+                gpu_options=gpu_options))
+            K.set_session(session)
+            K.batch_set_value(list(zip(variables,values)))
+        old.close()
+
+    def _collect_acquisition(self,handle):
+        """
+        Waits for a dispatched acquisition and applies its results. Returns True if acquisition was sucessful.
+        """
+        pool,result,cpu_count,dtime = handle
+        wtime = time.time()
+        try:
+            pooled_idx = result.get()
+        finally:
+            pool.join()
+            self._config.cpu_count = cpu_count
+
+        if self._config.info:
+            print("[ALTrainer] Waited {} for acquisition worker (dispatched {} before)".format(
+                timedelta(seconds=time.time()-wtime),timedelta(seconds=time.time()-dtime)))
+            
+        self._apply_acquisition(pooled_idx)
+        return True
 
     def _target_net_train(self,model):
         """
@@ -533,14 +1100,9 @@ class ActiveLearningTrainer(Trainer):
         
         tm,st,_ = self._target_net_train(model)
 
-        #Some models may take too long to save weights
-        if not st is None and st[-1].is_alive():
-            if self._config.info:
-                print("[ALTrainer] Waiting for model weights...")
-            st[-1].join()
-                    
         #Set load_full to false so dropout is disabled
-        predictor.run(self.test_x,self.test_y,load_full=model.is_ensemble(),net_model=model,target=True)        
+        predictor.run(self.test_x,self.test_y,load_full=model.is_ensemble(),net_model=model,target=True,
+                      calibration=(self.train_x,self.train_y))
 
         if self._config.info:
              print("Target net evaluation took: {}".format(timedelta(seconds=time.time() - intime)))
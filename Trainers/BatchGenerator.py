@@ -225,6 +225,62 @@ class SingleGenerator(GenericIterator):
         output = (batch_x, keras.utils.to_categorical(y, self.classes))
         return output         
 
+class ReplayGenerator(keras.utils.Sequence):
+    """
+    Replay training schedule: every epoch iterates over all new items plus a class balanced sample of older
+    items, drawn anew at each epoch. Batches are produced by an iterator over the full training set.
+
+    # Arguments
+    generator: iterator over the training set (implements _get_batches_of_transformed_samples)
+    labels: training set labels
+    new_idx: indexes of new items in the training set
+    replay: number of older items sampled per epoch
+    seed: Random seed for sampling.
+    """
+    def __init__(self,generator,labels,new_idx,replay,seed=None):
+        self.generator = generator
+        self.batch_size = generator.batch_size
+        self.new_idx = np.asarray(new_idx,dtype=np.int64)
+        labels = np.asarray(labels)
+        old = np.setdiff1d(np.arange(labels.shape[0]),self.new_idx)
+        self.old_by_class = [old[labels[old] == c] for c in np.unique(labels[old])]
+        self.replay = min(replay,old.shape[0])
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def _sample_old(self):
+        """
+        Equal share for each class; shares of classes with fewer items are filled with items from other classes.
+        """
+        if self.replay == 0:
+            return np.zeros(0,dtype=np.int64)
+        quota = self.replay // len(self.old_by_class)
+        picked,rest = [],[]
+        for items in self.old_by_class:
+            perm = self.rng.permutation(items)
+            picked.append(perm[:quota])
+            rest.append(perm[quota:])
+        picked,rest = np.concatenate(picked),np.concatenate(rest)
+        missing = self.replay - picked.shape[0]
+        if missing > 0:
+            picked = np.concatenate((picked,self.rng.choice(rest,missing,replace=False)))
+        return picked
+
+    def __len__(self):
+        return int(np.ceil(self.index.shape[0]/self.batch_size))
+
+    def __getitem__(self,i):
+        return self.generator._get_batches_of_transformed_samples(self.index[i*self.batch_size:(i+1)*self.batch_size])
+
+    def on_epoch_end(self):
+        self.index = self.rng.permutation(np.concatenate((self.new_idx,self._sample_old())))
+
+    def returnDataSize(self):
+        """
+        Returns the number of examples per epoch
+        """
+        return self.index.shape[0]
+
 class ThreadedGenerator(GenericIterator):
     """
     Generates batches of images, applies augmentation, resizing, centering...the whole shebang.
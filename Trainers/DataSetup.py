@@ -107,6 +107,70 @@ def split_test(config,ds):
 
     return test_x,test_y,X,Y
 
+def _fill_budget(sizes,budget):
+    """
+    Distributes budget among groups as evenly as possible (water filling), no group gets more than its size.
+    """
+    alloc = np.zeros(sizes.shape[0],dtype=np.int64)
+    remaining = budget
+    order = np.argsort(sizes,kind='stable')
+    for i,g in enumerate(order):
+        alloc[g] = min(sizes[g],remaining // (order.shape[0] - i))
+        remaining -= alloc[g]
+    #Integer division leftovers
+    for g in order[::-1]:
+        if remaining <= 0:
+            break
+        if alloc[g] < sizes[g]:
+            alloc[g] += 1
+            remaining -= 1
+    return alloc
+
+def wsi_candidates(config,pool_x,cand=None):
+    """
+    Stratified candidate sampling by origin slide (getOrigin): at most wsi_cap items of each slide
+    and at most cand_budget items in total (budget is split evenly among slides, unused shares of small
+    slides go to larger ones). Items without origin information are treated as one slide.
+
+    @param config <argparse>: uses wsi_cap, cand_budget (0 means no limit) and acquire
+    @param pool_x <np.array>: pool items
+    @param cand <np.array>: pool indexes to sample from (None: whole pool)
+    Returns: sorted pool indexes or cand if no sampling was done
+    """
+    idx = np.arange(pool_x.shape[0]) if cand is None else cand
+    
+    groups = {}
+    for i in idx:
+        w = pool_x[i].getOrigin() if hasattr(pool_x[i],'getOrigin') else None
+        groups.setdefault(w,[]).append(i)
+    origins = list(groups.keys())
+    sizes = np.array([len(groups[w]) for w in origins],dtype=np.int64)
+    if config.wsi_cap > 0:
+        sizes = np.minimum(sizes,config.wsi_cap)
+    budget = int(sizes.sum())
+    if config.cand_budget > 0:
+        budget = min(budget,config.cand_budget)
+    alloc = _fill_budget(sizes,budget)
+
+    if budget >= idx.shape[0] or budget < config.acquire:
+        if config.info and budget < config.acquire:
+            print("[DataSetup] Candidate sampling would leave fewer than {} items, using all candidates.".format(config.acquire))
+        return cand
+    
+    selected = []
+    for w,n in zip(origins,alloc):
+        if n > 0:
+            selected.append(np.random.choice(groups[w],n,replace=False))
+    selected = np.sort(np.concatenate(selected))
+
+    if config.info:
+        print("[DataSetup] Candidate sampling: {} of {} items from {} slides (largest slide share: {})".format(
+            selected.shape[0],idx.shape[0],len(origins),alloc.max()))
+    if config.verbose > 1:
+        print("\n".join(["{}: {} of {}".format(w,n,len(groups[w])) for w,n in zip(origins,alloc)]))
+            
+    return selected
+
 def csregen(superp,pool_size,generator_params,kwargs):
     """
     Regenerates the pool extracting pool_size elements from superpool.
@@ -125,13 +189,14 @@ def csregen(superp,pool_size,generator_params,kwargs):
     - clusters <int>: clusters space in this many groups
     """
     from sklearn.cluster import KMeans,MiniBatchKMeans
-    from sklearn.decomposition import PCA
     from sklearn.metrics import pairwise_distances_argmin_min
     from datetime import timedelta
     import time
     from Trainers import ThreadedGenerator
-    from AL.Common import extract_feature_from_function,load_model_weights
-    from AL import cs_select_batch
+    from AL.Common import extract_features_cached,open_feature_store,load_model_weights
+    from AL.Projection import get_projector,save_projector
+    from AL.Clustering import warm_kmeans,space_fingerprint
+    from AL import cs_select_batch,cs_approx_select_batch
 
     
     #Checks params
@@ -185,20 +250,20 @@ def csregen(superp,pool_size,generator_params,kwargs):
         model.register_ensemble(m)
         load_model_weights(config,model,tmodels[m],sw_thread)
         
-    features = extract_feature_from_function(pred_model,generator)
+    projector = get_projector(config,model)
+    features = extract_features_cached(pred_model,generator,open_feature_store(config,model),projector)
+    save_projector(config,model,projector)
 
     del(pred_model)
     del(generator)
     
-    if config.pca > 0:
-        if config.info:
-            print("[csregen] Starting PCA decomposition ({} features)...".format(config.pca))
-
-        pca = PCA(n_components = config.pca)
-        features = pca.fit_transform(features)
-        
     #Third - Runs KMeans and divides feature space in k clusters (same as given by config - default 20)
-    if pool_size < 10000:
+    if config.kmwarm:
+        fid = 'kmwarm-{}-csregen.pik'.format(model.name)
+        cache_m = CacheManager()
+        cache_m.registerFile(os.path.join(config.cache,fid),fid)
+        km = warm_kmeans(features,space[0],clusters,fid,space_fingerprint(config,model),workers=cpu_count,verbose=config.verbose)
+    elif pool_size < 10000:
         km = KMeans(n_clusters = clusters, init='k-means++',n_jobs=max(int(cpu_count/2),1)).fit(features)
     else:
         km = MiniBatchKMeans(n_clusters = clusters, init='k-means++',batch_size=500).fit(features)
@@ -211,7 +276,10 @@ def csregen(superp,pool_size,generator_params,kwargs):
     #Fourth - CoreSet extracts pool_size samples from space (pass space features and cluster center features - already selected)
     mask = np.ones(features.shape[0],dtype=bool)
     mask[centers] = False
-    acquired = cs_select_batch(features[centers],features[mask],pool_size,cluster_centers=centers)
+    if config.cs_approx:
+        acquired = cs_approx_select_batch(features[centers],features[mask],pool_size,dim=config.cs_dim,cells=config.cs_cells,workers=cpu_count)
+    else:
+        acquired = cs_select_batch(features[centers],features[mask],pool_size,workers=cpu_count)
     del(features)
     
     if config.verbose > 0:
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import time
+import numpy as np
+from datetime import timedelta
+
+import keras
+from keras.models import Model
+from keras.layers import Dense
+from keras import optimizers
+
+from AL.Common import iterate_batches
+from AL.Accumulators import accumulator_for
+from Utils import WeightsRegistry
+
+__doc__ = """
+Ensemble to student distillation (see -student).
+
+After ensemble training, a single (small) student network is trained over a transfer set (training set
+plus a random pool sample) to reproduce:
+- the ensemble's mean probabilities (softmax output, cross entropy against soft targets);
+- the ensemble's disagreement, as defined by the acquisition function (BALD or variation ratios), through
+an extra regression head on the student's last feature layer.
+
+Student acquisition (AL.distilled_uncert) ranks the pool by the disagreement head, so pool scoring costs one
+forward pass instead of one per ensemble member.
+"""
+
+class DistillSequence(keras.utils.Sequence):
+    """
+    Transfer set batches: images decoded by a (non shuffling) ThreadedGenerator, targets are the ensemble
+    mean probabilities and disagreement. Batches are reshuffled every epoch.
+    """
+    def __init__(self,generator,targets,disagreement):
+        self.generator = generator
+        self.targets = targets
+        self.disagreement = disagreement.reshape(-1,1)
+        self.batch_size = generator.batch_size
+        self.order = np.random.permutation(targets.shape[0])
+
+    def __len__(self):
+        return int(np.ceil(self.targets.shape[0]/self.batch_size))
+
+    def __getitem__(self,i):
+        idx = self.order[i*self.batch_size:(i+1)*self.batch_size]
+        x,_ = self.generator._get_batches_of_transformed_samples(idx)
+        return x,[self.targets[idx],self.disagreement[idx]]
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.order)
+
+def ensemble_targets(config,members,generator,data_size):
+    """
+    Runs all ensemble members over generator. Returns (mean probabilities,disagreement).
+
+    @param members <list>: keras models with member weights loaded
+    @param generator <ThreadedGenerator>: transfer set generator (shuffle should be False)
+    """
+    acc = accumulator_for(config.ac_function,data_size,generator.classes,len(members))
+    if acc is None:
+        acc = accumulator_for('bald',data_size,generator.classes,len(members))
+    mean = np.zeros((data_size,generator.classes),dtype=np.float32)
+    for rows,inp in iterate_batches(generator,5*config.cpu_count):
+        for m in members:
+            proba = m.predict_on_batch(inp)
+            mean[rows] += proba
+            acc.update(rows,proba)
+    mean /= len(members)
+    return mean,np.nan_to_num(acc.scores())
+
+def _feature_tensor(single,classes):
+    """
+    Last 2D (flat) layer output before the classification layer(s).
+    """
+    for l in reversed(single.layers[:-1]):
+        shape = l.output_shape
+        if isinstance(shape,tuple) and len(shape) == 2 and shape[-1] != classes:
+            return l.output
+    return single.layers[-1].input
+
+def student_heads(single,classes):
+    """
+    Returns a keras.Model sharing single's layers, with outputs [probabilities,disagreement].
+    """
+    dis = Dense(1,activation='relu',name='disagreement')(_feature_tensor(single,classes))
+    return Model(inputs=single.inputs,outputs=[single.outputs[0],dis])
+
+def train_student(config,student,generator,targets,disagreement):
+    """
+    Builds and trains the student. Weights of the classification network are registered in the WeightsRegistry
+    (under the student's weights cache), so it can be used for prediction as any network trained in this process.
+
+    @param student <GenericModel>: student network
+    @param generator <ThreadedGenerator>: transfer set generator
+    Returns: two headed keras.Model (see student_heads)
+    """
+    stime = time.time()
+    single,_ = student.build(data_size=targets.shape[0],allocated_gpus=1,preload_w=config.plw)
+    net = student_heads(single,generator.classes)
+    net.compile(loss=['categorical_crossentropy','mse'],
+                    loss_weights=[1.0,1.0],
+                    optimizer=optimizers.Adam(lr=config.learn_r))
+
+    seq = DistillSequence(generator,targets,disagreement)
+    hist = net.fit_generator(generator=seq,
+                                 steps_per_epoch=len(seq),
+                                 epochs=config.epochs,
+                                 verbose=config.verbose,
+                                 use_multiprocessing=False,
+                                 workers=config.cpu_count,
+                                 max_queue_size=config.batch_size*3)
+    WeightsRegistry().register(student.get_weights_cache(),single.get_weights())
+
+    if config.info:
+        print("[Distillation] Student ({}) trained on {} items in {}; final loss: {:.4f}".format(student.getName(),
+                  targets.shape[0],timedelta(seconds=time.time()-stime),hist.history['loss'][-1]))
+    return net
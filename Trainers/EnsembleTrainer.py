@@ -25,7 +25,9 @@ if tf.__version__ >= '1.14.0':
     
 #Local
 from .ALTrainer import ActiveLearningTrainer
+from AL.Checkpoint import save_round_state,register_resumed_weights
 from .Predictions import Predictor
+from .BatchGenerator import ThreadedGenerator
 
 #Module
 from Utils import Exitcodes,CacheManager
@@ -112,6 +114,7 @@ class EnsembleALTrainer(ActiveLearningTrainer):
         Coordenates the AL process
         """
         from keras import backend as K
+        from AL import distilled_uncert
 
         stime = None
         etime = None
@@ -140,17 +143,30 @@ class EnsembleALTrainer(ActiveLearningTrainer):
             #Track training time
             train_time = time.time()
 
-            t_models,sw_thread,cpad = self._target_net_train(model,reset=True)
+            if self._resume_scoring(r):
+                t_models,sw_thread,cpad = self._resume_model(model)
+            else:
+                t_models,sw_thread,cpad = self._target_net_train(model,reset=True,r=r)
+                save_round_state(self._config,{'epad':cpad,'epochs':self._config.epochs})
                 
             if self._config.info:
                 print("Training step took: {}".format(timedelta(seconds=time.time()-train_time)))
 
-            #If sw_thread was provided, we should check the availability of model weights
-            if not sw_thread is None:
-                for k in range(len(sw_thread)):
-                    if sw_thread[k].is_alive():
-                        print("Waiting ensemble model {} weights' to become available...".format(k))
-                        sw_thread[k].join()
+            last = r == (self._config.acquisition_steps - 1)
+
+            #Ensemble to student distillation: student acquires and predicts, except in audit rounds
+            student,snet,audit = None,None,False
+            if not self._config.student is None and not last:
+                student,snet = self._distill_student(model,t_models,sw_thread)
+                audit = self._config.student_audit > 0 and ((r + 1) % self._config.student_audit) == 0
+                
+            #Pipelined AL: pool scoring runs in a worker process while target net is trained/tested here
+            pending = None
+            if self._config.pipeline > 0 and not last and student is None:
+                pending = self._dispatch_acquisition(model,acquisition=r,emodels=t_models,sw_thread=sw_thread)
+                
+            #Member weights are handed to acquisition/prediction in memory (WeightsRegistry),
+            #weights files are written in background
 
             run_pred = self.test_target(predictor,r,end_train)
 
@@ -160,8 +176,22 @@ class EnsembleALTrainer(ActiveLearningTrainer):
                 ne = int(self._config.epochs * epad)
                 print("Adjusting epochs ({}): {}".format(self._config.epochs,ne))
                 self._config.epochs = max(min(ne,100),self.min_epochs)
+
+            if not pending is None:
+                if not run_pred:
+                    predictor.run(self.test_x,self.test_y,load_full=False,net_model=model,target=self._config.tnet is None,
+                                  calibration=(self.train_x,self.train_y))
+                    run_pred = True
+                acquired = self._collect_acquisition(pending)
+            elif audit:
+                acquired = self.acquire(function,model,acquisition=r,emodels=t_models,sw_thread=sw_thread,
+                                            observers=[self._student_audit(snet,student,r)])
+            elif not student is None:
+                acquired = self.acquire(distilled_uncert,student,acquisition=r,student=snet)
+            else:
+                acquired = not last and self.acquire(function,model,acquisition=r,emodels=t_models,sw_thread=sw_thread)
                 
-            if r == (self._config.acquisition_steps - 1) or not self.acquire(function,model,acquisition=r,emodels=t_models,sw_thread=sw_thread):
+            if not acquired:
                 if self._config.info:
                     print("[EnsembleTrainer] No more acquisitions are in order")
                 end_train = True
@@ -170,8 +200,14 @@ class EnsembleALTrainer(ActiveLearningTrainer):
                 
             #Set load_full loads a full model stored in file
             #Test target network if needed
-            if not run_pred:
-                predictor.run(self.test_x,self.test_y,load_full=end_train,net_model=model,target=self._config.tnet is None)
+            if not run_pred and not student is None and not end_train:
+                if self._config.info:
+                    print("[EnsembleTrainer] Intermediate test predictions made by student ({})".format(student.getName()))
+                Predictor(self._config,keepImg=False).run(self.test_x,self.test_y,load_full=False,net_model=student,target=False,
+                                                          calibration=(self.train_x,self.train_y))
+            elif not run_pred:
+                predictor.run(self.test_x,self.test_y,load_full=end_train,net_model=model,target=self._config.tnet is None,
+                                  calibration=(self.train_x,self.train_y))
 
             #Attempt to free GPU memory
             K.clear_session()
@@ -185,18 +221,101 @@ class EnsembleALTrainer(ActiveLearningTrainer):
                 return None
 
         
-    def _target_net_train(self,model,reset=True):
+    def _distill_student(self,model,t_models,sw_thread):
+        """
+        Trains the student network (config.student) to reproduce the ensemble over a transfer set: training set
+        plus a random sample of student_m pool items (see Trainers.Distillation).
+
+        Returns: (student GenericModel,two headed keras.Model)
+        """
+        from AL.EnsembleFunctions import _load_members
+        from .Distillation import ensemble_targets,train_student
+
+        sample = np.random.choice(self.pool_x.shape[0],min(self._config.student_m,self.pool_x.shape[0]),replace=False)
+        tx = np.concatenate((self.train_x,self.pool_x[sample]),axis=0)
+        ty = np.concatenate((self.train_y,self.pool_y[sample]),axis=0)
+
+        generator_params = self._generator_params(model)
+        generator_params['dps'] = (tx,ty)
+        generator = ThreadedGenerator(**generator_params)
+
+        if self._config.info:
+            print("\n[EnsembleTrainer] Computing ensemble targets for {} transfer items...".format(tx.shape[0]))
+        ttime = time.time()
+        members = _load_members(self._config,model,t_models,sw_thread,range(self._config.emodels),False)
+        targets,disagreement = ensemble_targets(self._config,members,generator,tx.shape[0])
+        del(members)
+        if self._config.info:
+            print("[EnsembleTrainer] Ensemble targets took: {}".format(timedelta(seconds=time.time()-ttime)))
+
+        student = self.load_modules(self._config.student)
+        student.setName("{}-Student".format(student.getName()))
+        if student.rescaleEnabled() and self._config.student_phi > 1:
+            student.setPhi(self._config.student_phi)
+        snet = train_student(self._config,student,generator,targets,disagreement)
+        return student,snet
+
+    def _student_audit(self,snet,student,r):
+        """
+        Audit round: the ensemble acquires, the student scores the same pool beforehand. Returns an observer
+        for the ensemble acquisition function that reports overlap of both selections and rank correlation
+        of their scores.
+        """
+        from AL import distilled_uncert
+        from AL.StaleScores import _rank
+
+        generator_params = self._generator_params(student)
+        generator_params['dps'] = (self.pool_x,self.pool_y)
+        observed = {}
+        def _observe(name,data):
+            observed[name] = data
+        distilled_uncert(snet,ThreadedGenerator(**generator_params),self.pool_x.shape[0],config=self._config,
+                             acquisition=r,observers=[_observe])
+        pool_ref,s_scores = self.pool_x,observed['scores']
+        
+        def _audit(name,data):
+            if name != 'scores':
+                return
+            if not self.pool_x is pool_ref or data.shape[0] != s_scores.shape[0]:
+                if self._config.info:
+                    print("[EnsembleTrainer] Student audit needs the whole (unchanged) pool to be scored, skipped.")
+                return
+            k = min(self._config.acquire,data.shape[0])
+            overlap = np.intersect1d(np.argsort(data)[-k:],np.argsort(s_scores)[-k:]).shape[0]/k
+            rho = np.corrcoef(_rank(data),_rank(s_scores))[0,1]
+            if self._config.info:
+                print("[EnsembleTrainer] Student audit (round {}): top-{} overlap with ensemble selection {:.4f}; rank correlation {:.4f}".format(
+                    r,k,overlap,rho))
+        return _audit
+        
+    def _resume_model(self,model):
+        """
+        Builds ensemble members and loads the interrupted round's weights from disk instead of training.
+        Returns the same as _target_net_train, with the interrupted round's epoch adjustments.
+        """
+        from AL.Common import load_model_weights
+        
+        if self._config.info:
+            print("[EnsembleTrainer] Scoring checkpoint found, training skipped (weights loaded from disk).")
+        t_models = {}
+        for m in range(self._config.emodels):
+            model.register_ensemble(m)
+            single,parallel = model.build(data_size=self.train_x.shape[0],allocated_gpus=self._config.gpu_count,layer_freeze=self._config.lyf)
+            load_model_weights(self._config,model,(single,parallel))
+            register_resumed_weights(model,single,parallel)
+            t_models[m] = single if parallel is None else parallel
+
+        model.reset()
+        model.tmodels = t_models
+        return t_models,None,self._resume_epad([1]*self._config.emodels)
+        
+    def _target_net_train(self,model,reset=True,r=None):
+        """
+        Trains all ensemble members. If r (AL round) is given, members are warm started (see -warm).
+        """
 
         t_models, sw_thread,cpad = {},[],[]
         for m in range(self._config.emodels):
-            #Some models may take too long to save weights
-            while True:
-                if len(sw_thread) > 0 and sw_thread[-1].is_alive():
-                    print("[EnsembleTrainer] Waiting for model weights.")
-                    sw_thread[-1].join(60.0)
-                else:
-                    break
-                    
             if hasattr(model,'register_ensemble'):
                 model.register_ensemble(m)
             else:
@@ -206,9 +325,12 @@ class EnsembleALTrainer(ActiveLearningTrainer):
             if self._config.info:
                 print("[EnsembleTrainer] Starting model {} training".format(m))
                     
+            warm = {} if r is None else self._warm_kwargs(r,model.get_weights_cache())
             tm,st,epad = self.train_model(model,(self.train_x,self.train_y),(self.val_x,self.val_y),
                                          set_session=False,stats=False,summary=False,
-                                         clear_sess=False,save_numpy=True)
+                                         clear_sess=False,save_numpy=True,**warm)
+            if not r is None:
+                self._keep_warm_state(model.get_weights_cache(),tm)
             t_models[m] = tm
             sw_thread.append(st)
             cpad.append(epad)
@@ -15,7 +15,7 @@ warnings.filterwarnings('ignore')
     
 from Datasources.CellRep import CellRep
 from Utils import SaveLRCallback,CalculateF1Score,EnsembleModelCallback
-from Utils import Exitcodes,CacheManager
+from Utils import Exitcodes,CacheManager,WeightsRegistry,save_flat
 from .DataSetup import split_test
 
 #Keras
@@ -210,6 +210,11 @@ class Trainer(object):
         @param clear_sess <boolean>: clears session and frees GPU memory
         @param allocated_gpus <int>: currently not used
         @param save_numpy <boolean>: save weights in numpy format instead of HDF5
+        @param init_weights <list>: start from these weights (as returned by training model's get_weights)
+        @param opt_weights <list>: restore this optimizer state before training
+        @param epochs <int>: train for this number of epochs instead of config.epochs
+        @param new_idx <ndarray>: indexes of new items in train_data. If given (and config.replay > 0), each epoch uses
+        the new items plus config.replay older ones (see BatchGenerator.ReplayGenerator)
         """
         rcomp = re.compile(self._rex)
 
@@ -279,8 +284,6 @@ class Trainer(object):
             print("Train set: {0} items".format(len(train_data[0])))
             print("Validate set: {0} items".format(len(val_data[0])))
 
-        train_generator,val_generator = self._choose_generator(train_data,val_data,model.check_input_shape())
-        
         single,parallel = model.build(data_size=len(train_data[0]),allocated_gpus=allocated_gpus,preload_w=self._config.plw,layer_freeze=self._config.lyf)
         if not parallel is None:
             training_model = parallel
@@ -314,12 +317,67 @@ class Trainer(object):
                 if self._verbose > 1:
                     print(e)
                 
+        ## Warm start: continue from given weights (e.g. previous AL round)
+        init_weights = kwargs.get('init_weights',None)
+        if not init_weights is None:
+            training_model.set_weights(init_weights)
+            if self._verbose > 0:
+                print("Training started from previous round's weights.")
+            
         wf_header = "{0}-t{1}".format(model.name,old_e_offset+1)
 
+        #Frozen trunk: train the top layers over cached trunk activations (after weights are loaded)
+        tcache = None
+        if getattr(self._config,'lyf_cache',False) and self._config.lyf > 0 and parallel is None:
+            if self._config.augment:
+                if self._config.info:
+                    print("[GenericTrainer] Trunk activation cache not used with data augmentation.")
+            else:
+                from .TrunkCache import open_trunk_cache
+                tcache = open_trunk_cache(self._config,single,model.name)
+
+        #Top layer training has no full model or image validation generator for these callbacks
+        if not tcache is None:
+            skipped = []
+            if self._config.save_w:
+                skipped.append("intermediate weights (ModelCheckpoint)")
+            if self._config.f1period > 0:
+                skipped.append("F1 calculation (-f1)")
+            if skipped:
+                print("[GenericTrainer] Trunk activation cache in use, not running: {}".format(", ".join(skipped)))
+
+        if tcache is None:
+            train_generator,val_generator = self._choose_generator(train_data,val_data,model.check_input_shape())
+            fit_model = training_model
+        else:
+            train_generator,val_generator = self._trunk_generators(tcache,train_data,val_data,model.check_input_shape())
+            fit_model = tcache[1]
+            fit_model.compile(loss=single.loss,optimizer=single.optimizer,metrics=['accuracy'])
+
+        ## Replay schedule: new items plus a sample of older ones each epoch
+        new_idx = kwargs.get('new_idx',None)
+        if not new_idx is None and getattr(self._config,'replay',0) > 0:
+            from .BatchGenerator import ReplayGenerator
+            train_generator = ReplayGenerator(train_generator,train_data[1],new_idx,self._config.replay)
+            if self._config.info:
+                print("[GenericTrainer] Replay schedule: {} new + {} replayed items per epoch (training set: {})".format(
+                    train_generator.new_idx.shape[0],train_generator.replay,len(train_data[0])))
+
+        opt_weights = kwargs.get('opt_weights',None)
+        if opt_weights:
+            #Optimizer weights are only created with the train function
+            fit_model._make_train_function()
+            try:
+                fit_model.optimizer.set_weights(opt_weights)
+            except ValueError as e:
+                print("[ALERT] Could not restore optimizer state, starting with a fresh optimizer")
+                if self._verbose > 1:
+                    print(e)
+
         ### Define special behaviour CALLBACKS
         callbacks = []
         ## ModelCheckpoint
-        if self._config.save_w:
+        if self._config.save_w and tcache is None:
             callbacks.append(ModelCheckpoint(os.path.join(
                 self._config.weights_path, wf_header + "e{epoch:02d}.h5"), 
                 save_weights_only=True, period=5,save_best_only=True,monitor='val_acc'))
@@ -332,7 +390,7 @@ class Trainer(object):
         ##EarlyStopping
         #callbacks.append(EarlyStopping(monitor='acc',mode='max',min_delta=0.01,patience=5,baseline=0.9,verbose=1))
         ## CalculateF1Score
-        if self._config.f1period > 0:
+        if self._config.f1period > 0 and tcache is None:
             callbacks.append(CalculateF1Score(val_generator,self._config.f1period,self._config.batch_size,self._config.info))
 
         if self._config.info and summary:
@@ -341,10 +399,10 @@ class Trainer(object):
             print("Model parameters: {}".format(single.count_params()))
             print("Model layers: {}".format(len(single.layers)))
 
-        hist = training_model.fit_generator(
+        hist = fit_model.fit_generator(
             generator = train_generator,
             steps_per_epoch = len(train_generator), #// self._config.batch_size,
-            epochs = self._config.epochs,
+            epochs = kwargs.get('epochs',self._config.epochs),
             validation_data = val_generator,
             validation_steps = len(val_generator), #//self._config.batch_size,
             verbose = self._verbose,
@@ -357,6 +415,10 @@ class Trainer(object):
         if self._verbose > 1:
             print("Done training model: {0}".format(hex(id(training_model))))
 
+        if self._config.info and not new_idx is None and 'val_loss' in hist.history:
+            print("[GenericTrainer] Replay schedule validation: loss {:.4f}, accuracy {:.4f}".format(hist.history['val_loss'][-1],
+                      hist.history.get('val_acc',[np.nan])[-1]))
+
         if self._config.dye:
             epad = ((np.mean(hist.history['loss']) - hist.history['loss'][-1]) + (np.mean(hist.history['acc']) - hist.history['acc'][-1]))/ \
             (np.std(hist.history['loss'])+np.std(hist.history['acc']))
@@ -383,29 +445,80 @@ class Trainer(object):
         if self._verbose > 0:
             print("Epoch correction index: {}".format(epad))
 
-        sw_thread = threading.Thread(target=self._save_weights,name='save_weights',args=(model,single,parallel,clear_sess,save_numpy))
+        #Trained weights are available in memory right away, disk files are written in background.
+        #Paths are resolved now: ensemble members change them (register_ensemble) before the thread ends
+        paths = self._weights_paths(model)
+        registry = WeightsRegistry()
+        registry.register(paths['single'],single.get_weights())
+        if not parallel is None and not paths['mgpu'] is None:
+            registry.register(paths['mgpu'],parallel.get_weights())
+            
+        sw_thread = threading.Thread(target=self._save_weights,name='save_weights',args=(model,single,parallel,clear_sess,save_numpy,paths))
         sw_thread.start()
         return (training_model,sw_thread,epad)
+
+    def _trunk_generators(self,tcache,train_data,val_data,fix_dim):
+        """
+        Returns a tuple with two batch generators over cached trunk activations: (train_generator,val_generator)
+        """
+        from .TrunkCache import cache_activations,CachedActivations
+
+        trunk,_,store = tcache
+        params = {'classes':self._ds.nclasses,
+                      'dim':fix_dim,
+                      'batch_size':self._config.batch_size,
+                      'image_generator':ImageDataGenerator(samplewise_center=self._config.batch_norm,
+                                                               samplewise_std_normalization=self._config.batch_norm),
+                      'extra_aug':False,
+                      'shuffle':False,
+                      'verbose':self._verbose,
+                      'keep':self._config.keepimg}
+        train_keys = cache_activations(self._config,trunk,store,train_data,dict(params))
+        val_keys = cache_activations(self._config,trunk,store,val_data,dict(params))
+        train_generator = CachedActivations(store,train_keys,train_data[1],self._ds.nclasses,self._config.batch_size,shuffle=True)
+        val_generator = CachedActivations(store,val_keys,val_data[1],self._ds.nclasses,self._config.batch_size,shuffle=False)
+        return (train_generator,val_generator)
+
+    def _weights_paths(self,model):
+        return {'single':model.get_weights_cache(),
+                'mgpu':model.get_mgpu_weights_cache(),
+                'model':model.get_model_cache(),
+                'npsingle':model.get_npweights_cache() if hasattr(model,'get_npweights_cache') else None,
+                'npmgpu':model.get_npmgpu_weights_cache() if hasattr(model,'get_npmgpu_weights_cache') else None,
+                'flsingle':model.get_flatweights_cache(),
+                'flmgpu':model.get_flatmgpu_weights_cache()}
         
-    def _save_weights(self,model,single,parallel,clear_sess,save_numpy):
+    def _save_weights(self,model,single,parallel,clear_sess,save_numpy,paths=None):
         #Save weights for single tower model and for multigpu model (if defined)
         cache_m = CacheManager()
+        registry = WeightsRegistry()
         stime = None
         if self._config.info:
             stime = time.time()
             print("Saving weights, this could take a while...")
+
+        if paths is None:
+            paths = self._weights_paths(model)
             
-        if save_numpy and hasattr(model,'get_npweights_cache'):
-            np.save(model.get_npweights_cache(),single.get_weights())
+        if save_numpy and self._config.wflat:
+            weights = registry.get(paths['single'])
+            save_flat(paths['flsingle'],single.get_weights() if weights is None else weights,[w.name for w in single.weights])
+        elif save_numpy and not paths['npsingle'] is None:
+            weights = registry.get(paths['single'])
+            np.save(paths['npsingle'],single.get_weights() if weights is None else weights)
         else:
-            single.save_weights(model.get_weights_cache())
-            single.save(model.get_model_cache())
+            single.save_weights(paths['single'])
+            single.save(paths['model'])
             
-        if not parallel is None and not model.get_mgpu_weights_cache() is None:
-            if save_numpy and hasattr(model,'get_npmgpu_weights_cache'):
-                np.save(model.get_npmgpu_weights_cache(),parallel.get_weights())
+        if not parallel is None and not paths['mgpu'] is None:
+            if save_numpy and self._config.wflat:
+                weights = registry.get(paths['mgpu'])
+                save_flat(paths['flmgpu'],parallel.get_weights() if weights is None else weights,[w.name for w in parallel.weights])
+            elif save_numpy and not paths['npmgpu'] is None:
+                weights = registry.get(paths['mgpu'])
+                np.save(paths['npmgpu'],parallel.get_weights() if weights is None else weights)
             else:
-                parallel.save_weights(model.get_mgpu_weights_cache())
+                parallel.save_weights(paths['mgpu'])
 
         if self._config.info:
                 etime = time.time()
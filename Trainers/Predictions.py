@@ -117,7 +117,7 @@ class Predictor(object):
         else:
             self._ensemble = False
 
-    def run(self,x_test=None,y_test=None,load_full=True,net_model=None,target=True):
+    def run(self,x_test=None,y_test=None,load_full=True,net_model=None,target=True,**kwargs):
         """
         Checks configurations, loads correct module, loads data
         Trains!
@@ -130,6 +130,9 @@ class Predictor(object):
         @param load_full <boolean>: loads full model with load_model function. If ensemble, load individual model weights
         @param net_model <GenericModel subclass>: performs predictions with this model
         @param target <boolean>: Target network predicitons?
+
+        Optional keyword arguments:
+        @param calibration <tuple>: (items,labels) used for calibration of int8 models (see -quantize)
         """
         net_name = self._config.network
         if net_name is None or net_name == '':
@@ -155,9 +158,9 @@ class Predictor(object):
         if x_test is None or y_test is None:
             x_test,y_test,_,_ = split_test(self._config,self._ds)
 
-        self.run_test(net_model,x_test,y_test,load_full,target)
+        self.run_test(net_model,x_test,y_test,load_full,target,**kwargs)
         
-    def run_test(self,model,x_test,y_test,load_full=True,target=True):
+    def run_test(self,model,x_test,y_test,load_full=True,target=True,**kwargs):
         """
         This should be executed after a model has been trained
         """
@@ -233,6 +236,21 @@ class Predictor(object):
         image_generator = ImageDataGenerator(samplewise_center=self._config.batch_norm, 
                                             samplewise_std_normalization=self._config.batch_norm)
 
+        #Int8 CPU inference, calibrated on training data
+        calibration = kwargs.get('calibration',None)
+        if getattr(self._config,'quantize',0) > 0 and not calibration is None:
+            from AL.Quantization import quantize_model
+            cal_generator = ThreadedGenerator(dps=calibration,
+                                                classes=self._ds.nclasses,
+                                                dim=model.check_input_shape(),
+                                                batch_size=bsize,
+                                                image_generator=image_generator,
+                                                shuffle=False,
+                                                verbose=self._verbose,
+                                                input_n=self._config.emodels if self._ensemble else 1,
+                                                keep=self._keep)
+            pred_model = quantize_model(self._config,pred_model,cal_generator,model.get_weights_cache())
+
         if self._ensemble or self._config.delay_load:
             fix_dim = model.check_input_shape()
 
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os,sys
+import copy
+import time
+import glob
+import pickle
+import socket
+import argparse
+import threading
+import numpy as np
+import multiprocessing as mp
+
+from Utils import CacheManager
+
+__doc__ = """
+Sharded pool scoring (see -shards).
+
+The pool is split into contiguous shards, each one scored by a worker process holding its own copy of the
+model (weights are read from disk). Workers return per item scores, which are concatenated in pool order,
+so selection is the same as a single process run.
+
+Workers are local processes or, if a shard directory is given (-shard_dir), any process polling that
+directory (shared filesystem protocol):
+- coordinator writes task-r<round>-s<shard>.pik files;
+- a worker claims a task by renaming it (atomic) and writes result-r<round>-s<shard>.pik when done;
+- while scoring, a worker touches its claimed file every HEARTBEAT seconds. Claims not touched for
+  -shard_timeout seconds (dead worker) are renamed back to task files, so another worker takes them.
+
+Workers on other nodes are started with:
+python3 -m Trainers.Sharding -dir <shard_dir> [-cpu <cores>]
+Local stand-in workers (-shard_local) run the same loop in processes of the coordinator's node.
+
+Only functions that score items independently can be sharded (SHARDABLE). Clustering and core-set functions
+(km_uncert, kmng_uncert, core_set...) select items from features of the whole pool; -shards is rejected for them.
+"""
+
+#Seconds between claim file updates of a working worker
+HEARTBEAT = 30.0
+
+#Functions whose per item scores can be computed in shards and concatenated
+SHARDABLE = ('bayesian_varratios','bayesian_bald','ensemble_varratios','ensemble_bald')
+
+def _worker_config(config,cpu_count):
+    """
+    Workers only score: candidate selection stages, pipelining and result saving are done by the coordinator.
+    """
+    wconfig = copy.copy(config)
+    wconfig.cpu_count = max(1,cpu_count)
+    wconfig.shards = 0
+    wconfig.pipeline = 0
+    wconfig.sscore = 0
+    wconfig.proxy = None
+    wconfig.wsi_cap = 0
+    wconfig.cand_budget = 0
+    wconfig.save_var = False
+    wconfig.debug = False
+    wconfig.ckpt = 0
+    wconfig.record = False
+    wconfig.prune = 0.0
+    return wconfig
+
+def score_shard(task):
+    """
+    Scores one shard. Returns {'shard':shard id,'scores':np.array (or None)}
+
+    @param task <dict>: config, locations, pool, train, val, acquisition and shard
+    """
+    from .ALTrainer import worker_setup
+
+    trainer,function,model,kwargs = worker_setup(task['config'],task['locations'],task['pool'],task['train'],
+                                                     task['val'],task['acquisition'])
+    observed = {}
+    def _observe(name,data):
+        observed[name] = data
+    kwargs['observers'] = [_observe]
+    trainer._run_acquisition(function,model,**kwargs)
+
+    return {'shard':task['shard'],'scores':observed.get('scores',None)}
+
+def _atomic_dump(obj,path):
+    tmp = "{}.tmp-{}".format(path,os.getpid())
+    with open(tmp,'wb') as fd:
+        pickle.dump(obj,fd,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp,path)
+
+def _heartbeat(path,stop,period):
+    while not stop.wait(period):
+        try:
+            os.utime(path)
+        except OSError:
+            return
+
+def requeue_stale(shard_dir,names,timeout):
+    """
+    Renames claims of the given tasks that were not updated for timeout seconds back to task files.
+    Returns the number of requeued tasks.
+
+    @param names <list>: task names (r<round>-s<shard>.pik)
+    """
+    requeued = 0
+    now = time.time()
+    for n in names:
+        for c in glob.glob(os.path.join(shard_dir,'task-{}.*'.format(glob.escape(n)))):
+            if '.tmp-' in c:
+                continue
+            try:
+                if now - os.path.getmtime(c) > timeout:
+                    os.rename(c,os.path.join(shard_dir,'task-'+n))
+                    requeued += 1
+                    break
+            except OSError:
+                continue
+    return requeued
+
+def fs_worker(shard_dir,cpu_count=None,poll=2.0,once=False,verbose=0):
+    """
+    Shared filesystem worker loop: claims and scores task files from shard_dir.
+
+    @param cpu_count <int>: overrides the coordinator's per worker core count
+    @param once <boolean>: return when no tasks are left (local stand-in), otherwise poll forever
+    """
+    tag = "{}-{}".format(socket.gethostname(),os.getpid())
+    while True:
+        tasks = sorted(glob.glob(os.path.join(shard_dir,'task-*.pik')))
+        claimed = None
+        for t in tasks:
+            cpath = "{}.{}".format(t,tag)
+            try:
+                os.rename(t,cpath)
+                os.utime(cpath)
+                claimed = (t,cpath)
+                break
+            except OSError:
+                continue
+
+        if claimed is None:
+            if once:
+                return
+            time.sleep(poll)
+            continue
+
+        with open(claimed[1],'rb') as fd:
+            task = pickle.load(fd)
+        if not cpu_count is None:
+            task['config'].cpu_count = cpu_count
+        if verbose > 0:
+            print("[Sharding] {} scoring shard {} ({} items)".format(tag,task['shard'],task['pool'][0].shape[0]))
+            sys.stdout.flush()
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat,args=(claimed[1],stop,HEARTBEAT),daemon=True)
+        beat.start()
+        try:
+            res = score_shard(task)
+        finally:
+            stop.set()
+            beat.join()
+        rpath = os.path.join(shard_dir,os.path.basename(claimed[0]).replace('task-','result-',1))
+        _atomic_dump(res,rpath)
+        #Claim may have been requeued (see requeue_stale)
+        if os.path.isfile(claimed[1]):
+            os.remove(claimed[1])
+        if once:
+            return
+
+class ShardCoordinator(object):
+    """
+    Partitions the pool, dispatches shards and merges per shard scores.
+    """
+    def __init__(self,config):
+        self._config = config
+        self.shards = config.shards
+
+    def score(self,trainer,cand,acquisition):
+        """
+        Returns scores of all candidate items (pool order) or None if scoring failed.
+
+        @param trainer <ActiveLearningTrainer>: holds pool, training and validation sets
+        @param cand <np.array>: pool indexes to score (None: whole pool)
+        """
+        pool_x,pool_y = (trainer.pool_x,trainer.pool_y) if cand is None else (trainer.pool_x[cand],trainer.pool_y[cand])
+        parts = [p for p in np.array_split(np.arange(pool_x.shape[0]),self.shards) if p.shape[0] > 0]
+        wconfig = _worker_config(self._config,self._config.cpu_count // len(parts))
+        locations = CacheManager().getLocations()
+        tasks = [{'config':wconfig,'locations':locations,'pool':(pool_x[p],pool_y[p]),
+                      'train':(trainer.train_x,trainer.train_y),'val':(trainer.val_x,trainer.val_y),
+                      'acquisition':acquisition,'shard':k} for k,p in enumerate(parts)]
+
+        stime = time.time()
+        if self._config.shard_dir is None:
+            results = self._run_local(tasks)
+        else:
+            results = self._run_fs(tasks,acquisition)
+
+        results = {r['shard']:r['scores'] for r in results}
+        if any([results.get(k,None) is None for k in range(len(parts))]):
+            print("[Sharding] Missing shard scores, the acquisition function should report item scores.")
+            return None
+
+        if self._config.info:
+            print("[Sharding] {} items scored in {} shards ({:.1f}s)".format(pool_x.shape[0],len(parts),time.time()-stime))
+        return np.concatenate([results[k] for k in range(len(parts))])
+
+    def _run_local(self,tasks):
+        ctx = mp.get_context('spawn')
+        pool = ctx.Pool(processes=len(tasks),maxtasksperchild=1)
+        try:
+            results = pool.map(score_shard,tasks,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def _run_fs(self,tasks,acquisition):
+        shard_dir = self._config.shard_dir
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+
+        names = ["r{}-s{}.pik".format(acquisition,t['shard']) for t in tasks]
+        for n in names:
+            rpath = os.path.join(shard_dir,'result-'+n)
+            if os.path.isfile(rpath):
+                os.remove(rpath)
+        for t,n in zip(tasks,names):
+            _atomic_dump(t,os.path.join(shard_dir,'task-'+n))
+
+        #Local stand-in workers
+        ctx = mp.get_context('spawn')
+        local = []
+        for i in range(self._config.shard_local):
+            p = ctx.Process(target=fs_worker,args=(shard_dir,),kwargs={'once':False,'verbose':self._config.verbose})
+            p.daemon = True
+            p.start()
+            local.append(p)
+
+        if self._config.info:
+            print("[Sharding] {} tasks written to {} ({} local workers)".format(len(tasks),shard_dir,len(local)))
+
+        results = []
+        pending = set(names)
+        timeout = max(getattr(self._config,'shard_timeout',300),2*HEARTBEAT)
+        last = time.time()
+        while len(pending) > 0:
+            for n in list(pending):
+                rpath = os.path.join(shard_dir,'result-'+n)
+                if os.path.isfile(rpath):
+                    with open(rpath,'rb') as fd:
+                        results.append(pickle.load(fd))
+                    os.remove(rpath)
+                    pending.remove(n)
+            if len(pending) > 0:
+                requeued = requeue_stale(shard_dir,pending,timeout)
+                if requeued > 0 and self._config.info:
+                    print("[Sharding] {} claimed tasks requeued (no worker update in {}s)".format(requeued,timeout))
+                time.sleep(1.0)
+                if self._config.info and time.time() - last > 60:
+                    print("[Sharding] Waiting for {} shards...".format(len(pending)))
+                    last = time.time()
+
+        for p in local:
+            p.terminate()
+            p.join()
+        return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sharded pool scoring worker (shared filesystem protocol).')
+    parser.add_argument('-dir', dest='shard_dir', type=str, required=True,
+        help='Shard directory, as given to the coordinator (-shard_dir).')
+    parser.add_argument('-cpu', dest='cpu_count', type=int, default=None,
+        help='Number of CPU cores to use (Default: as defined by coordinator).')
+    parser.add_argument('-poll', dest='poll', type=float, default=2.0,
+        help='Directory polling interval in seconds (Default: 2.0).')
+    parser.add_argument('-v', action='count', default=0, dest='verbose',
+        help='Amount of verbosity.')
+    config, unparsed = parser.parse_known_args()
+
+    fs_worker(config.shard_dir,config.cpu_count,config.poll,once=False,verbose=config.verbose)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import hashlib
+import numpy as np
+
+import keras
+from keras import backend as K
+from keras.models import Model
+from keras.layers import Input,InputLayer
+
+from Utils import FeatureStore,sample_key
+
+__doc__ = """
+Frozen-trunk activation cache (see -lyf_cache).
+
+When -lyf freezes the first layers of a network, the frozen trunk computes the same activations for a
+sample in every epoch and every AL round. The model is split at the deepest tensor that:
+- is produced by a layer sequence (model.layers order) with no trainable weights and no stochastic layers;
+- is the only tensor of that sequence used by the remaining layers.
+
+Trunk activations are stored in a FeatureStore (keyed by sample ID and a hash of the trunk weights), so only
+new samples (e.g. new acquisitions) go through the trunk. The remaining layers (top) are trained over the
+stored activations. Trunk layers always run in inference mode (batch normalization uses moving statistics).
+
+Not used with data augmentation (activations would differ at every epoch) or multi-GPU training.
+"""
+
+STOCHASTIC = ('Dropout','SpatialDropout1D','SpatialDropout2D','SpatialDropout3D','GaussianNoise','GaussianDropout',
+                  'AlphaDropout')
+
+def _frozen(layer):
+    return len(layer.trainable_weights) == 0 and not layer.__class__.__name__ in STOCHASTIC
+
+def find_cut(model):
+    """
+    Returns (trunk output tensor,index of the layer producing it) or (None,None) if there is no frozen trunk
+    with weights.
+    """
+    layers = model.layers
+    index = {id(l):i for i,l in enumerate(layers)}
+    #Last layer (index) that uses each tensor
+    last_use = {}
+    for l in layers:
+        for node in l._inbound_nodes:
+            for t in node.input_tensors:
+                last_use[t.name] = max(last_use.get(t.name,-1),index[id(l)])
+
+    cut,pos,open_t,weights = None,None,set(),False
+    for i,l in enumerate(layers):
+        if len(l._inbound_nodes) != 1 or not _frozen(l):
+            break
+        weights = weights or len(l.weights) > 0
+        if not isinstance(l,InputLayer):
+            open_t = set([t for t in open_t if last_use.get(t,-1) > i])
+        out = l.output
+        if last_use.get(out.name,-1) > i:
+            open_t.add(out.name)
+        if weights and open_t == set([out.name]) and not out.name in [o.name for o in model.outputs]:
+            cut,pos = out,i
+    return cut,pos
+
+def split_model(model,cut):
+    """
+    Returns (trunk,top): trunk maps model inputs to the cut tensor, top maps the cut tensor to model outputs.
+    Top reuses model layers, so training it trains model.
+    """
+    trunk = Model(inputs=model.inputs,outputs=cut)
+    top_in = Input(batch_shape=K.int_shape(cut))
+    tensor_map = {cut.name:top_in}
+    for depth in sorted(model._nodes_by_depth.keys(),reverse=True):
+        for node in model._nodes_by_depth[depth]:
+            layer = node.outbound_layer
+            if isinstance(layer,InputLayer):
+                continue
+            computed = [tensor_map[x.name] for x in node.input_tensors if x.name in tensor_map]
+            if len(computed) != len(node.input_tensors) or node.output_tensors[0].name in tensor_map:
+                continue
+            kwargs = dict(node.arguments) if node.arguments else {}
+            out = layer(computed[0] if len(computed) == 1 else computed,**kwargs)
+            out = out if isinstance(out,list) else [out]
+            for x,y in zip(node.output_tensors,out):
+                tensor_map[x.name] = y
+    top = Model(inputs=top_in,outputs=[tensor_map[x.name] for x in model.outputs])
+    return trunk,top
+
+def trunk_fingerprint(trunk):
+    fp = hashlib.md5()
+    fp.update(str(K.int_shape(trunk.output)).encode())
+    for w in trunk.get_weights():
+        fp.update(np.ascontiguousarray(w).tobytes())
+    return fp.hexdigest()
+
+class CachedActivations(keras.utils.Sequence):
+    """
+    Batches of stored trunk activations and one-hot labels.
+    """
+    def __init__(self,store,keys,labels,classes,batch_size,shuffle=True):
+        self.store = store
+        self.keys = keys
+        self.labels = keras.utils.to_categorical(labels,classes)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.random.permutation(len(keys)) if shuffle else np.arange(len(keys))
+
+    def __len__(self):
+        return int(np.ceil(len(self.keys)/self.batch_size))
+
+    def __getitem__(self,i):
+        return self._get_batches_of_transformed_samples(self.order[i*self.batch_size:(i+1)*self.batch_size])
+
+    def _get_batches_of_transformed_samples(self,index_array):
+        idx = np.sort(index_array)
+        return self.store.get([self.keys[k] for k in idx]),self.labels[idx]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+def cache_activations(config,trunk,store,data,generator_params):
+    """
+    Computes trunk activations of samples missing from store. Returns the sample keys.
+
+    @param data <tuple>: (items,labels)
+    @param generator_params <dict>: ThreadedGenerator parameters (non shuffling, no augmentation)
+    """
+    from Trainers import ThreadedGenerator
+    from AL.Common import extract_feature_from_function
+
+    keys = [sample_key(x) for x in data[0]]
+    miss = np.where(~store.contains(keys))[0]
+    if miss.shape[0] > 0:
+        generator_params['dps'] = (data[0][miss],data[1][miss])
+        generator = ThreadedGenerator(**generator_params)
+        function = K.function(trunk.inputs,[trunk.output])
+        store.add([keys[i] for i in miss],extract_feature_from_function(function,generator))
+    if config.info:
+        print("[TrunkCache] {} of {} samples served from cache".format(len(keys)-miss.shape[0],len(keys)))
+    return keys
+
+def open_trunk_cache(config,model,name):
+    """
+    Returns (trunk,top,store) or None if model has no frozen trunk.
+
+    @param name <str>: GenericModel name, networks sharing a cache dir (e.g. target and proxy) have separate stores
+    """
+    cut,pos = find_cut(model)
+    if cut is None:
+        return None
+    trunk,top = split_model(model,cut)
+    #Layer names change between builds, position in model.layers does not
+    layer = '{}-trunk{}'.format(name,pos)
+    store = FeatureStore(config.cache,trunk_fingerprint(trunk),layer,getattr(config,'fstore',None) or 'float32',config.verbose)
+    store.prune()
+    if config.info:
+        print("[TrunkCache] Frozen trunk output: {} {}".format(cut.name,K.int_shape(cut)[1:]))
+    return trunk,top,store
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os,sys
+import re
+import glob
+import json
+import time
+import pickle
+import argparse
+import itertools
+import numpy as np
+
+from AL.Accumulators import accumulator_for
+from AL.KMUncert import _acq_logic
+from AL.gCoreSet import cs_select_batch
+
+__doc__ = """
+Offline acquisition replay.
+
+Runs acquisition functions over the scoring outputs recorded in a previous experiment (-record), without
+loading models or images. For each recorded round, selections of every replayed function are compared
+to the selection actually made and to each other.
+
+Replay is possible when the needed outputs were recorded:
+- bayesian/ensemble bald and varratios: member probabilities;
+- core_set: pool and training features;
+- km_uncert, kmng_uncert: pool features and uncertainty (recorded or BALD over member probabilities);
+- random_sample: always.
+"""
+
+def load_round(path):
+    rec = np.load(path,allow_pickle=False)
+    data = {k:rec[k] for k in rec.files}
+    data['meta'] = json.loads(str(data['meta']))
+    return data
+
+def _uncertainty(rec):
+    if 'uncertainty' in rec:
+        return rec['uncertainty'].astype(np.float32)
+    if 'scores' in rec and rec['meta']['function'].endswith('bald'):
+        return rec['scores'].astype(np.float32)
+    if 'probs' in rec:
+        return _score(rec,'bald')
+    return None
+
+def _score(rec,function):
+    probs = rec['probs'].astype(np.float32)
+    members,size,classes = probs.shape
+    acc = accumulator_for(function,size,classes,members)
+    for m in range(members):
+        acc.update(slice(None),probs[m])
+    return np.nan_to_num(acc.scores())
+
+def _kmeans_select(rec,query,config,ng):
+    from sklearn.cluster import KMeans,MiniBatchKMeans
+
+    uncertainty = _uncertainty(rec)
+    if uncertainty is None or not 'features' in rec:
+        return None
+    features = rec['features'].astype(np.float32)
+    if features.shape[0] < 10000:
+        km = KMeans(n_clusters=config.clusters,init='k-means++').fit(features)
+    else:
+        km = MiniBatchKMeans(n_clusters=config.clusters,init='k-means++',batch_size=500).fit(features)
+
+    un_indexes = uncertainty.argsort()[::-1]
+    un_labels = km.labels_[un_indexes]
+    rank_order = np.argsort(un_labels,kind='stable')
+    bounds = np.searchsorted(un_labels[rank_order],np.arange(config.clusters+1))
+    un_clusters = {k:un_indexes[rank_order[bounds[k]:bounds[k+1]]] for k in range(config.clusters)}
+    if ng:
+        from AL.KMUncert import _acq_ng_logic
+        posa = {k:rank_order[bounds[k]:min(bounds[k+1],bounds[k]+query)] for k in range(config.clusters)}
+        return _acq_ng_logic(posa,config.clusters,un_clusters,query,config,config.verbose,None,km)
+    return _acq_logic(config.clusters,un_clusters,query,config,config.verbose,None,km)
+
+def replay(function,rec,query,config):
+    """
+    Returns the indexes function would select from the recorded round (or None if not replayable).
+
+    @param function <str>: acquisition function name
+    @param rec <dict>: recorded round (see load_round)
+    """
+    size = rec['keys'].shape[0]
+    query = min(query,size)
+    if function == 'random_sample':
+        return np.random.choice(size,query,replace=False)
+    elif function.endswith('bald') or function.endswith('varratios'):
+        if not 'probs' in rec:
+            return None
+        return _score(rec,function).argsort()[-query:][::-1]
+    elif function == 'core_set':
+        if not 'features' in rec or not 'train_features' in rec:
+            return None
+        return np.asarray(cs_select_batch(rec['train_features'].astype(np.float32),rec['features'].astype(np.float32),
+                                              query,workers=config.cpu_count))
+    elif function in ('km_uncert','kmng_uncert'):
+        return _kmeans_select(rec,query,config,function == 'kmng_uncert')
+    return None
+
+def _jaccard(a,b):
+    a,b = set(a.tolist()),set(b.tolist())
+    return len(a & b)/max(1,len(a | b))
+
+def run_replay(config):
+    files = glob.glob(os.path.join(config.logdir,'record','al-record-r*.npz'))
+    files.sort(key=lambda f:int(re.search(r'-r(\d+)\.npz$',f).group(1)))
+    if len(files) == 0:
+        print("[ALReplay] No recorded rounds in {}".format(os.path.join(config.logdir,'record')))
+        sys.exit(1)
+
+    selections = {}
+    for path in files:
+        rec = load_round(path)
+        r = rec['meta']['round']
+        query = config.acquire if config.acquire > 0 else rec['meta']['acquire']
+        recorded = rec['selected']
+        labels = rec['labels']
+        print("[ALReplay] Round {} ({} items; recorded function: {}; {} selected)".format(r,rec['keys'].shape[0],
+                                                                                     rec['meta']['function'],recorded.shape[0]))
+        sel = {}
+        for fn in config.functions:
+            np.random.seed(config.seed + r)
+            stime = time.time()
+            idx = replay(fn,rec,query,config)
+            if idx is None:
+                print(" - {}: not replayable from recorded outputs".format(fn))
+                continue
+            sel[fn] = np.asarray(idx,dtype=np.int64)
+            unique,count = np.unique(labels[sel[fn]],return_counts=True)
+            hist = ", ".join(["{}: {}".format(u,c) for u,c in zip(unique,count)])
+            print(" - {}: {} items ({:.2f}s); overlap with recorded: {:.3f}; classes: {}".format(fn,sel[fn].shape[0],
+                      time.time()-stime,np.isin(sel[fn],recorded).mean() if sel[fn].shape[0] > 0 else 0.0,hist))
+        for a,b in itertools.combinations(sorted(sel.keys()),2):
+            print(" - Jaccard {} x {}: {:.3f}".format(a,b,_jaccard(sel[a],sel[b])))
+        selections[r] = {fn:rec['keys'][sel[fn]] for fn in sel}
+
+    if not config.out is None:
+        with open(config.out,'wb') as fd:
+            pickle.dump(selections,fd)
+        print("[ALReplay] Selections (sample IDs) saved to {}".format(config.out))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replays acquisition functions over recorded scoring outputs (see -record).')
+    parser.add_argument('-logdir', dest='logdir', type=str,default='logs',
+        help='Log dir of the recorded experiment.')
+    parser.add_argument('-f', dest='functions', type=str, nargs='+',
+        default=['ensemble_bald','ensemble_varratios','random_sample'],
+        help='Acquisition functions to replay (Default: ensemble_bald ensemble_varratios random_sample).')
+    parser.add_argument('-acquire', dest='acquire', type=int,
+        help='Items to select per round (Default: 0, same as recorded).', default=0)
+    parser.add_argument('-clusters', dest='clusters', type=int,
+        help='Number of clusters for km_uncert/kmng_uncert (Default: 20).', default=20)
+    parser.add_argument('-cpu', dest='cpu_count', type=int,
+        help='Number of CPU cores available (Default: 1).', default=1)
+    parser.add_argument('-seed', dest='seed', type=int,
+        help='Random seed (Default: 1).', default=1)
+    parser.add_argument('-out', dest='out', type=str, default=None,
+        help='Save replayed selections (sample IDs per round and function) to this file.')
+    parser.add_argument('-v', action='count', default=0, dest='verbose',
+        help='Amount of verbosity.')
+    config, unparsed = parser.parse_known_args()
+
+    config.recluster = 0
+    config.debug = False
+    run_replay(config)
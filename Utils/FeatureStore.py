@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import pickle
+import numpy as np
+
+def sample_key(item):
+    """
+    Sample ID: image parent dir and file name (same information used to hash PImage objects). Items taken
+    from a shared file (NPImage, CVImage) also carry their origin and coordinates, as in NPImage.__hash__.
+    """
+    path = item.getPath() if hasattr(item,'getPath') else str(item)
+    key = "{}/{}".format(os.path.basename(os.path.dirname(path)),os.path.basename(path))
+    origin,coord = getattr(item,'_origin',None),getattr(item,'_coord',None)
+    if not (origin is None and coord is None):
+        key = "{}:{}:{}".format(key,origin,coord)
+    return key
+
+class FeatureStore(object):
+    """
+    Persistent storage of extracted features, keyed by (sample ID, extractor fingerprint, layer).
+
+    Each (fingerprint, layer) pair has its own directory, holding append-only .npy blocks (read as memory
+    maps) and a pickled index: sample ID -> (block, row). Only features of samples not yet in the index
+    need to be computed.
+    """
+    def __init__(self,root,fingerprint,layer='feature',dtype='float32',verbose=0):
+        """
+        @param root <str>: base directory (store directories are created under root/fstore)
+        @param fingerprint <str>: feature extractor state identifier
+        @param layer <str>: layer the features are extracted from
+        @param dtype <str>: float16 or float32
+        """
+        self.fingerprint = fingerprint
+        self.layer = layer
+        self.dtype = np.dtype(dtype)
+        self.verbose = verbose
+        self._base = os.path.join(root,'fstore')
+        self._dir = os.path.join(self._base,"{}-{}".format(layer,fingerprint))
+        self._index_file = os.path.join(self._dir,'index.pik')
+        self._blocks = {}
+
+        if os.path.isfile(self._index_file):
+            with open(self._index_file,'rb') as fd:
+                self._index,self._nblocks = pickle.load(fd)
+        else:
+            self._index = {}
+            self._nblocks = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def contains(self,keys):
+        """
+        Returns a boolean array, True for keys already stored.
+        """
+        return np.asarray([k in self._index for k in keys],dtype=bool)
+
+    def add(self,keys,features):
+        """
+        Stores features (first dimension aligned with keys) in a new block.
+        """
+        if len(keys) == 0:
+            return
+        if not os.path.isdir(self._dir):
+            os.makedirs(self._dir)
+        b = self._nblocks
+        np.save(os.path.join(self._dir,'block-{}.npy'.format(b)),np.asarray(features,dtype=self.dtype))
+        for r,k in enumerate(keys):
+            self._index[k] = (b,r)
+        self._nblocks += 1
+        self._save_index()
+
+    def get(self,keys):
+        """
+        Returns stored features for the given keys (all of them should be present), as float32.
+        """
+        loc = np.asarray([self._index[k] for k in keys],dtype=np.int64).reshape(-1,2)
+        features = None
+        for b in np.unique(loc[:,0]):
+            block = self._block(b)
+            sel = np.where(loc[:,0] == b)[0]
+            if features is None:
+                features = np.empty((len(keys),)+block.shape[1:],dtype=np.float32)
+            features[sel] = block[loc[sel,1]]
+        return features
+
+    def _block(self,b):
+        if not b in self._blocks:
+            self._blocks[b] = np.load(os.path.join(self._dir,'block-{}.npy'.format(b)),mmap_mode='r')
+        return self._blocks[b]
+
+    def _save_index(self):
+        tmp = self._index_file + '.tmp'
+        with open(tmp,'wb') as fd:
+            pickle.dump((self._index,self._nblocks),fd)
+        os.replace(tmp,self._index_file)
+
+    def prune(self):
+        """
+        Removes stores of the same layer that belong to other extractor states.
+        """
+        if not os.path.isdir(self._base):
+            return
+        for d in os.listdir(self._base):
+            path = os.path.join(self._base,d)
+            if d.rsplit('-',1)[0] == self.layer and path != self._dir and os.path.isdir(path):
+                if self.verbose > 0:
+                    print("[FeatureStore] Removing stale store: {}".format(d))
+                shutil.rmtree(path,ignore_errors=True)
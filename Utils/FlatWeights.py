@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import json
+import numpy as np
+
+__doc__ = """
+Flat weight files: all tensors of a model in one contiguous buffer.
+
+Layout:
+- magic (8 bytes) and header length (uint64, little endian);
+- JSON header: tensor names, shapes, dtypes and offsets;
+- tensor data, each tensor starting at a 64 byte aligned offset.
+
+Files are loaded through a memory map: returned arrays are views of the mapped file, so
+Keras set_weights reads them directly (no pickle, no intermediate copies).
+"""
+
+MAGIC = b'SGFWT001'
+ALIGN = 64
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def save_flat(path,weights,names=None):
+    """
+    Saves a list of arrays (as returned by Keras Model.get_weights()).
+    File is written to a temporary name and then renamed, so readers never see partial files.
+
+    @param names <list>: optional tensor names (Default: tensor position)
+    """
+    #np.require keeps 0-d tensors (e.g. optimizer iterations) 0-d, ascontiguousarray would make them (1,)
+    weights = [np.require(w,requirements='C') for w in weights]
+    if names is None:
+        names = [str(i) for i in range(len(weights))]
+
+    offsets = []
+    pos = 0
+    for w in weights:
+        offsets.append(pos)
+        pos = _aligned(pos + w.nbytes)
+    header = json.dumps({'names':list(names),
+                         'shapes':[list(w.shape) for w in weights],
+                         'dtypes':[w.dtype.str for w in weights],
+                         'offsets':offsets}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as fd:
+        fd.write(MAGIC)
+        fd.write(np.uint64(len(header)).tobytes())
+        fd.write(header)
+        for w,off in zip(weights,offsets):
+            fd.seek(data_start + off)
+            fd.write(w.tobytes())
+        fd.truncate(data_start + pos)
+    os.replace(tmp,path)
+
+def load_flat(path,names=False):
+    """
+    Returns a list of arrays (read only memory mapped views) or (arrays,names) if names is True.
+    """
+    with open(path,'rb') as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError("[FlatWeights] Not a flat weights file: {}".format(path))
+        hlen = int(np.frombuffer(fd.read(8),dtype=np.uint64)[0])
+        header = json.loads(fd.read(hlen).decode('utf-8'))
+    data_start = _aligned(len(MAGIC) + 8 + hlen)
+
+    buf = np.memmap(path,dtype=np.uint8,mode='r')
+    weights = [np.ndarray(shape=tuple(s),dtype=np.dtype(d),buffer=buf,offset=data_start+o)
+                   for s,d,o in zip(header['shapes'],header['dtypes'],header['offsets'])]
+    if names:
+        return weights,header['names']
+    return weights
@@ -11,9 +11,9 @@ import argparse
 import pickle
 import importlib
 from sklearn.cluster import MeanShift,estimate_bandwidth
-from sklearn.decomposition import PCA
 
-from AL.Common import load_model_weights
+from AL.Common import load_model_weights,extract_features_cached,open_feature_store
+from AL.Projection import get_projector,save_projector
 from Utils import CacheManager
 
 def load_modules(config):
@@ -89,22 +89,21 @@ def run_clustering(config,data,net_model,nclasses):
     #Extract features for all images in the pool
     if config.info:
         print("Starting feature extraction ({} batches)...".format(len(generator)))
-    features = pred_model.predict_generator(generator,
+    if config.pca > 0 or not config.fstore is None:
+        projector = get_projector(config,net_model)
+        features = extract_features_cached(lambda inp: [pred_model.predict_on_batch(inp)],generator,
+                                               open_feature_store(config,net_model),projector)
+        save_projector(config,net_model,projector)
+    else:
+        features = pred_model.predict_generator(generator,
                                             workers=4*config.cpu_count,
                                             max_queue_size=100*config.gpu_count,
                                             verbose=0)
 
-    features = features.reshape(features.shape[0],np.prod(features.shape[1:]))
+        features = features.reshape(features.shape[0],np.prod(features.shape[1:]))
 
     if config.info:
         print("Feature vector shape: {}".format(features.shape))
-            
-    if config.pca > 0:
-        if config.info:
-            print("Starting PCA decomposition ({} features)...".format(config.pca))
-
-        pca = PCA(n_components = config.pca)
-        features = pca.fit_transform(features)
 
     if config.bandwidth == 0:
         bw = estimate_bandwidth(features, quantile=0.3)
@@ -153,6 +152,10 @@ if __name__ == "__main__":
         help='Mean-shift bandwidth. Zero means use default estimator. (Default: 0).', default=0)
     parser.add_argument('-pca', dest='pca', type=int, 
         help='Apply PCA to extracted features before clustering (Default: 0 (not used)).',default=50)    
+    parser.add_argument('-fstore', dest='fstore', type=str, nargs='?', default=None, const='float32', choices=['float16','float32'],
+        help='Keep extracted features in a persistent store (float32 by default, float16 optional).')
+    parser.add_argument('-pca_sample', dest='pca_sample', type=int, 
+        help='Fit PCA on this many randomly chosen items (Default: 5000).',default=5000)
     parser.add_argument('-data',dest='data',type=str,help='Dataset name to train model.\n \
     Check documentation for available datasets.',default='')
     parser.add_argument('-lr', dest='learn_r', type=float, 
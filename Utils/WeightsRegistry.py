@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import threading
+
+class _WeightsRegistry(object):
+    """
+    Keeps the latest trained weights of each model (or ensemble member) in memory, keyed by
+    the model's weights cache path. Trainers register weights as soon as training ends; weight
+    loaders check here before waiting for weights to be written to disk.
+    """
+    __instance = None
+    def __new__(cls,*args,**kwds):
+        if _WeightsRegistry.__instance is None:
+            _WeightsRegistry.__instance = object.__new__(_WeightsRegistry)
+            _WeightsRegistry.__instance.__init__(*args,**kwds)
+            return _WeightsRegistry.__instance
+        else:
+            return _WeightsRegistry.__instance
+
+    def __init__(self,*args,**kwds):
+        if not hasattr(self,'_weights'):
+            self._weights = {}
+            self._lock = threading.Lock()
+
+    def register(self,key,weights):
+        """
+        Stores a list of weight arrays (as returned by Keras Model.get_weights()) under key.
+        """
+        if key is None:
+            return
+        with self._lock:
+            self._weights[key] = weights
+
+    def get(self,key):
+        """
+        Returns the weights registered under key or None.
+        """
+        with self._lock:
+            return self._weights.get(key,None)
+
+    def clear(self):
+        with self._lock:
+            self._weights.clear()
+
+def WeightsRegistry(*args,**kwds):
+    registry_singleton = _WeightsRegistry(*args,**kwds)
+
+    return registry_singleton
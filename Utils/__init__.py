@@ -7,3 +7,6 @@ from .CustomCallbacks import CalculateF1Score
 from .CustomCallbacks import EnsembleModelCallback
 from .ParallelUtils import multiprocess_run
 from .Output import PrintConfusionMatrix
+from .FeatureStore import FeatureStore,sample_key
+from .WeightsRegistry import WeightsRegistry
+from .FlatWeights import save_flat,load_flat
@@ -15,8 +15,9 @@ warnings.filterwarnings('ignore')
 #Project imports
 from Preprocessing import Preprocess
 from Utils import Exitcodes,CacheManager
-from Testing import TrainTest,DatasourcesTest,PredictionTest,ActiveLearningTest
+from Testing import TrainTest,DatasourcesTest,PredictionTest,ActiveLearningTest,ALComponentsTest
 from Trainers import GenericTrainer,Predictions,ALTrainer
+from Trainers.Sharding import SHARDABLE
     
 #Supported image types
 img_types = ['svs', 'dicom', 'nii','tif','tiff', 'png']
@@ -127,6 +128,8 @@ def main_exec(config):
             PredictionTest.run(config)
         elif config.tmode == 4:
             ActiveLearningTest.run(config)
+        elif config.tmode == 5:
+            ALComponentsTest.run(config)
 
     if not (config.preprocess or config.train or config.postproc or config.pred or config.runtest):
         print("The problem begins with choice: preprocess, train, postprocess or predict")
@@ -192,6 +195,8 @@ if __name__ == "__main__":
         help='Preload Imagenet weights after single model build.',default=False)
     train_args.add_argument('-lyf', dest='lyf', type=int, 
         help='Freeze this number of layers for training (Default=0).', default=0)
+    train_args.add_argument('-lyf_cache', action='store_true', dest='lyf_cache',
+        help='Train layers above the frozen ones (-lyf) over cached trunk activations, computed once per sample and kept across AL rounds. Not used with -aug or multi-GPU. Intermediate weights and F1 (-f1) callbacks are not run when the cache is used.',default=False)
     train_args.add_argument('-wpath', dest='weights_path',
         help='Use weights file contained in path - usefull for sequential training (Default: None).',
         default='ModelWeights')
@@ -241,6 +246,82 @@ if __name__ == "__main__":
         help='Use a fixed pre-trained model to extract features.',default=None)
     al_args.add_argument('-pca', dest='pca', type=int, 
         help='Apply PCA to extracted features before clustering (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-pca_sample', dest='pca_sample', type=int, 
+        help='Fit PCA once per feature extractor state on this many randomly chosen items (Default: 5000).',default=5000)
+    al_args.add_argument('-cs_approx', action='store_true', dest='cs_approx', default=False,
+        help='Use approximate k-center greedy selection (core_set and csregen).')
+    al_args.add_argument('-cs_dim', dest='cs_dim', type=int, 
+        help='Approximate core-set: random projection dimension, 0 keeps original features (Default: 32).',default=32)
+    al_args.add_argument('-cs_cells', dest='cs_cells', type=int, 
+        help='Approximate core-set: number of coarse cells, 0 means sqrt(pool size) (Default: 0).',default=0)
+    al_args.add_argument('-fstore', dest='fstore', type=str, nargs='?', default=None, const='float32', choices=['float16','float32'],
+        help='Keep extracted features in a persistent store, reused while the extractor is unchanged (float32 by default, float16 optional).')
+    al_args.add_argument('-wflat', action='store_true', dest='wflat', default=False,
+        help='Save/load trained weights as flat, memory mappable files instead of pickled numpy arrays.')
+    al_args.add_argument('-kmwarm', action='store_true', dest='kmwarm', default=False,
+        help='Warm start KMeans from previous acquisition clusters (km_uncert and csregen).')
+    al_args.add_argument('-dedup', dest='dedup', type=int, 
+        help='Keep one representative of each group of near-duplicate pool tiles (perceptual hash Hamming distance up to dedup) (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-dprop', action='store_true', dest='dprop', default=False,
+        help='Add near-duplicates of acquired items to the training set with the same label (requires -dedup).')
+    al_args.add_argument('-sscore', dest='sscore', type=int, 
+        help='Stale-score pruning: rescore only top/exploration candidates, full pool rescore every sscore acquisitions (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-sskeep', dest='sskeep', type=float, 
+        help='Stale-score pruning: fraction of the pool rescored from the previous ranking (Default: 0.2).',default=0.2)
+    al_args.add_argument('-ssexp', dest='ssexp', type=float, 
+        help='Stale-score pruning: random exploration fraction of the remaining pool (Default: 0.05).',default=0.05)
+    al_args.add_argument('-wsi_cap', dest='wsi_cap', type=int, 
+        help='Candidate sampling: score at most this many pool items of each origin slide per acquisition (Default: 0 (no cap)).',default=0)
+    al_args.add_argument('-cand_budget', dest='cand_budget', type=int, 
+        help='Candidate sampling: score at most this many pool items per acquisition, stratified by origin slide (Default: 0 (no budget)).',default=0)
+    al_args.add_argument('-proxy', dest='proxy', type=str,
+        help='Cheap-proxy cascade: network used to score the whole pool, only its top candidates go to the acquisition function (Default: None).',default=None)
+    al_args.add_argument('-proxy_m', dest='proxy_m', type=int, 
+        help='Cheap-proxy cascade: number of top proxy candidates (Default: 5000).',default=5000)
+    al_args.add_argument('-proxy_rnd', dest='proxy_rnd', type=float, 
+        help='Cheap-proxy cascade: random fraction of the remaining pool also passed to the acquisition function (Default: 0.05).',default=0.05)
+    al_args.add_argument('-proxy_audit', dest='proxy_audit', type=int, 
+        help='Cheap-proxy cascade: report proxy recall on a random audit sample of this size (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-proxy_phi', dest='proxy_phi', type=int, 
+        help='Cheap-proxy cascade: phi value for rescalable proxy networks (EFInception) (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-student', dest='student', type=str,
+        help='Ensemble training only: distill the ensemble into this network, used for acquisition and intermediate test predictions (Default: None).',default=None)
+    al_args.add_argument('-student_m', dest='student_m', type=int, 
+        help='Distillation: number of pool items added to the training set as transfer set (Default: 5000).',default=5000)
+    al_args.add_argument('-student_phi', dest='student_phi', type=int, 
+        help='Distillation: phi value for rescalable student networks (EFInception) (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-student_audit', dest='student_audit', type=int, 
+        help='Distillation: every student_audit acquisitions, the ensemble acquires and student selection is compared to it (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-ckpt', dest='ckpt', type=int, 
+        help='Checkpoint acquisition scoring every ckpt seconds; a restored run (-restore) resumes interrupted scoring. Resumed selections are exact for ensemble functions only: MC dropout masks can not be restored (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-shards', dest='shards', type=int, 
+        help='Score the pool in this many shards, each one in a worker process. Only per item uncertainty functions \
+        (bayesian_varratios, bayesian_bald, ensemble_varratios, ensemble_bald) are sharded; clustering and core-set functions \
+        (km_uncert, kmng_uncert, core_set...) can not be sharded (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-shard_dir', dest='shard_dir', type=str,
+        help='Dispatch shards through this shared directory (workers: python3 -m Trainers.Sharding -dir <dir>) instead of local processes (Default: None).',default=None)
+    al_args.add_argument('-shard_local', dest='shard_local', type=int, 
+        help='Number of local stand-in workers for -shard_dir (Default: 0).',default=0)
+    al_args.add_argument('-shard_timeout', dest='shard_timeout', type=int, 
+        help='Claimed -shard_dir tasks with no worker update for this many seconds are requeued (Default: 300).',default=300)
+    al_args.add_argument('-quantize', dest='quantize', type=int, 
+        help='Int8 CPU inference for pool scoring and predictions, calibrated on this many training items (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-prune', dest='prune', type=float, 
+        help='Structured pruning: fraction of filters removed from each prunable convolution of the MC dropout scoring model (Default: 0 (not used)).',default=0.0)
+    al_args.add_argument('-prune_crit', dest='prune_crit', type=str, choices=['l1','act'],
+        help='Structured pruning: filter ranking by kernel L1 norm (l1) or mean activation on a training batch (act) (Default: l1).',default='l1')
+    al_args.add_argument('-prune_ft', dest='prune_ft', type=int, 
+        help='Structured pruning: fine-tuning epochs of the pruned model (Default: 1).',default=1)
+    al_args.add_argument('-warm', dest='warm', type=int, 
+        help='Warm start: fine-tune the previous round\'s network (weights and optimizer state) for this many epochs instead of training from scratch (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-wsfull', dest='wsfull', type=int, 
+        help='Warm start: train from scratch (full epochs) every this many rounds (Default: 0 (never)).',default=0)
+    al_args.add_argument('-replay', dest='replay', type=int, 
+        help='Replay schedule for warm start rounds (requires -warm; full retrain rounds use the whole training set): each epoch uses the last acquired items plus a class balanced sample of this many older training items (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-record', action='store_true', dest='record', default=False,
+        help='Record acquisition scoring outputs (probabilities, scores, features) for offline replay (Utils/ALReplay.py).')
+    al_args.add_argument('-pipeline', dest='pipeline', type=int, 
+        help='Run acquisition in a worker process with this many CPU cores, concurrently with target network training and testing (Default: 0 (not used)).',default=0)
     al_args.add_argument('-load_train', dest='load_train', action='store_true', default=False,
         help='Use the same initial training set as produced by a previous experiment.')
     al_args.add_argument('-spool', dest='spool', type=int, 
@@ -336,12 +417,20 @@ if __name__ == "__main__":
         1 - Run training test; \n \
         2 - Run Datasources test; \n \
         3 - Run Prediction test; \n \
-        4 - Run AL test.',
-       choices=[0,1,2,3,4],default=0)
+        4 - Run AL test; \n \
+        5 - Run AL components test (no dataset needed).',
+       choices=[0,1,2,3,4,5],default=0)
     parser.add_argument('-tlocal', action='store_true', dest='local_test', default=False, 
         help='Test is local (assumes a small dataset).')
     
     config, unparsed = parser.parse_known_args()
+
+    if config.shards > 1 and config.al and not config.ac_function in SHARDABLE:
+        parser.error("-shards: {} can not be sharded (sharded functions: {})".format(config.ac_function,", ".join(SHARDABLE)))
+
+    #Replay schedule only applies to fine-tuning rounds; without -warm every round would train on the full set
+    if config.replay > 0 and config.warm <= 0:
+        parser.error("-replay needs warm start rounds (-warm)")
     
     files = {
         'datatree.pik':os.path.join(config.cache,'{}-datatree.pik'.format(config.data)),